@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Many concurrent async_tex2png() renders on one event loop, compared with
+sequential tex2png() calls. Also checks the images, the error of a bad
+formula and that cancelled renders leave no scratch directory behind.
+Runs on the fake toolchain of benchmarks/fake_tex unless --real-tex is given.
+Usage: python benchmarks/bench_aio.py [-n 200] [-c 32]
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess as pc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.tex2png import tex2png_image, RenderSession
+from gitex.aio import async_tex2png_image, async_tex2png_batch
+from gitex.imgsize import get_png_size
+from corpus import gen_formula
+
+
+def check(image):
+    assert get_png_size(image.data) == (image.width, image.height), \
+        'not a PNG of the reported size'
+
+
+async def render_all(formulas, concurrency, session):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *[async_tex2png_image(formula, dpi=200, semaphore=semaphore,
+                              session=session) for formula in formulas])
+
+
+async def check_error(session):
+    try:
+        await async_tex2png_image(r'\undefinedcs', session=session)
+        raise AssertionError('a bad formula must fail')
+    except pc.CalledProcessError:
+        pass
+
+
+async def check_cancel(formulas, scratch_dir):
+    # cancel renders in the middle of their latex run
+    with RenderSession(pool_size=0, scratch_root=scratch_dir) as session:
+        tasks = [asyncio.ensure_future(async_tex2png_image(formula,
+                                                           session=session))
+                 for formula in formulas]
+        await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    cancelled = sum(isinstance(result, asyncio.CancelledError)
+                    for result in results)
+    left = os.listdir(scratch_dir)
+    assert not left, 'scratch directories left behind: {}'.format(left)
+    return cancelled
+
+
+async def check_batch(formulas, folder):
+    jobs = [(formula, os.path.join(folder, 'batch_{}.png'.format(i)), 'inline')
+            for i, formula in enumerate(formulas)]
+    await async_tex2png_batch(jobs, dpi=200)
+    for _, output_file, _ in jobs:
+        with open(output_file, 'rb') as f:
+            assert get_png_size(f.read()), 'bad batch page ' + output_file
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_aio')
+    parser.add_argument('-n', '--formulas', type=int, default=200)
+    parser.add_argument('-c', '--concurrency', type=int, default=32,
+                        help='renders running at once')
+    parser.add_argument('-s', '--sequential', type=int, default=20,
+                        help='formulas rendered by the sequential baseline')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    args = parser.parse_args()
+
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = os.path.join(BENCH_DIR, 'fake_tex')
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+    work_dir = tempfile.mkdtemp('gitex-bench-aio')
+    formulas = [gen_formula(i) for i in range(args.formulas)]
+    try:
+        with RenderSession(pool_size=args.concurrency) as session:
+            start = time.perf_counter()
+            for formula in formulas[:args.sequential]:
+                check(tex2png_image(formula, dpi=200, session=session))
+            sequential = ((time.perf_counter() - start)
+                          / max(1, args.sequential))
+            print('sync   {:5d} formulas {:8.2f} ms/formula'.format(
+                args.sequential, sequential * 1000))
+
+            start = time.perf_counter()
+            images = asyncio.run(render_all(formulas, args.concurrency,
+                                            session))
+            elapsed = time.perf_counter() - start
+            for image in images:
+                check(image)
+            print('async  {:5d} formulas {:8.2f} ms/formula  {:5.1f}x, '
+                  'concurrency {}'.format(
+                      len(formulas), elapsed / len(formulas) * 1000,
+                      sequential * len(formulas) / elapsed, args.concurrency))
+            asyncio.run(check_error(session))
+
+        asyncio.run(check_batch(formulas[:10], work_dir))
+        scratch_dir = os.path.join(work_dir, 'scratch')
+        os.mkdir(scratch_dir)
+        cancelled = asyncio.run(check_cancel(formulas[:args.concurrency],
+                                             scratch_dir))
+        print('OK: {} images checked, {} renders cancelled cleanly'.format(
+            len(images), cancelled))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Compare the render backends of gitex.backends on tiny inline formulas:
+per-formula latency of each backend, and the image size and depth that each
+one renders, which must stay close to the TeX reference.
+Runs on the fake toolchain of benchmarks/fake_tex unless --real-tex is
+given. The fake dvipng sizes images from the length of the TeX source, so
+the sizes are only compared, and --check only accepted, with --real-tex.
+Usage: python benchmarks/bench_backends.py [-n 100] [--real-tex]
+         [--check 0.2] [-d 200]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.tex2png import RenderSession
+from gitex.backends import BACKENDS, resolve_backend
+
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+TEMPLATES = ['x', 'n^2', r'\alpha', 'x_{{{0}}}', 'a_{{{0}}} + b',
+             r'\beta^{{{0}}}', 'f(x) = {0}', r'\lambda_i \leq {0}', 'k+{0}',
+             r'x \in S_{{{0}}}']
+
+
+def formulas(n):
+    return [TEMPLATES[i % len(TEMPLATES)].format(i) for i in range(n)]
+
+
+def bench(name, formulas, dpi, session):
+    # seconds per formula, and the images
+    start = time.perf_counter()
+    images = [BACKENDS[name].render(formula, 'inline', dpi, '',
+                                    'rgb 0.0 0.0 0.0', 'rgb 1.0 1.0 1.0',
+                                    'png', session=session)
+              for formula in formulas]
+    return (time.perf_counter() - start) / len(formulas), images
+
+
+def compare(formulas, reference, images):
+    """
+    Largest relative difference of width and height from the `reference`
+    images, and largest difference of depth in pixels.
+    """
+    size_diff, depth_diff = 0, 0
+    for formula, ref, image in zip(formulas, reference, images):
+        diffs = [abs(image[key] - ref[key]) / max(1, ref[key])
+                 for key in ['width', 'height']]
+        size_diff = max(size_diff, *diffs)
+        if ref.depth is not None:
+            depth_diff = max(depth_diff, abs(image.depth - ref.depth))
+        print('  {:24s} {:>4}x{:<4} depth {:>3}  vs tex {:>4}x{:<4} '
+              'depth {:>3}'.format(formula, image.width, image.height,
+                                   image.depth, ref.width, ref.height,
+                                   ref.depth))
+    return size_diff, depth_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_backends')
+    parser.add_argument('-n', type=int, default=100,
+                        help='number of formulas')
+    parser.add_argument('-d', '--dpi', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    parser.add_argument('--check', type=float, metavar='MAX_DIFF',
+                        help='fail if a width or height differs from TeX by '
+                        'more than this fraction, or a depth by more than '
+                        '2 pixels')
+    args = parser.parse_args()
+    if args.check is not None and not args.real_tex:
+        parser.error('--check compares with the real TeX images, it needs '
+                     '--real-tex')
+
+    work_dir = tempfile.mkdtemp('gitex-bench')
+    # keep the DVI cache away from the user cache, and cold
+    os.environ['GITEX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+
+    all_formulas = formulas(args.n)
+    routed = [formula for formula in all_formulas
+              if resolve_backend('auto', formula, 'inline') != 'tex']
+    print('{} of {} formulas routed to an in-process backend'
+          .format(len(routed), len(all_formulas)))
+    if not routed:
+        print('No in-process backend available, install matplotlib.')
+        shutil.rmtree(work_dir)
+        return
+    try:
+        with RenderSession() as session:
+            tex_time, reference = bench('tex', routed, args.dpi, session)
+            print('{:9s} {:8.2f} ms/formula'.format('tex', tex_time * 1000))
+            failed = False
+            for name in BACKENDS:
+                accepted = [formula for formula in routed
+                            if resolve_backend(name, formula,
+                                               'inline') == name]
+                if name == 'tex' or not accepted:
+                    continue
+                elapsed, images = bench(name, accepted, args.dpi, session)
+                print('{:9s} {:8.2f} ms/formula, {:.0f}x faster'.format(
+                    name, elapsed * 1000, tex_time / elapsed))
+                size_diff, depth_diff = compare(
+                    accepted, [reference[routed.index(formula)]
+                               for formula in accepted], images)
+                print('{:9s} max size difference {:.0%}, max depth '
+                      'difference {} px{}'.format(
+                          name, size_diff, depth_diff,
+                          '' if args.real_tex else
+                          ' (fake TeX sizes, not comparable)'))
+                if args.check is not None and (size_diff > args.check
+                                               or depth_diff > 2):
+                    failed = True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failed:
+        sys.exit('Backend images differ from TeX.')
+
+
+if __name__ == '__main__':
+    main()
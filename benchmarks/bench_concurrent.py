@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Stress test of concurrent builds sharing one image folder, like the jobs of
+a CI matrix: N `gitex` processes compile the same generated document at
+once, while a reader keeps opening the images of the folder.
+Checks that every formula is rendered once over all processes (the others
+wait on its render lock, see gitex.atomic), that no reader ever sees half
+an image, that every output and image matches a single-process build, and
+that no lock or temporary file is left behind.
+Then each process builds a document of its own, sharing most formulas with
+the others, and the manifest and the build graph of the folder must list
+the images and the outputs of all of them.
+Runs on the fake toolchain of benchmarks/fake_tex unless --real-tex is
+given.
+Usage: python benchmarks/bench_concurrent.py [-p 4] [-k inline] [-n 200]
+         [--latency 0.02] [--args '-j 2']
+"""
+import os
+import re
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess as pc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.imgsize import get_image_size
+from gitex.manifest import Manifest
+from gitex.buildgraph import BuildGraph
+from corpus import KINDS, gen_corpus
+
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+# counters of the --stats report
+counter_re = re.compile(r'([\w.]+) (\d+)(?:,|$)', re.M)
+
+
+def start_build(folder, src_md, output_md, args):
+    env = dict(os.environ, PYTHONPATH=os.path.join(BENCH_DIR, '..'))
+    return pc.Popen([sys.executable, '-m', 'gitex.compile', src_md, output_md,
+                     '-i', 'img', '--stats', '1'] + args, cwd=folder,
+                    env=env, stdout=pc.PIPE, stderr=pc.STDOUT)
+
+
+def counters(output):
+    return {name: int(value) for name, value in counter_re.findall(output)}
+
+
+def read_images(folder, stopped, torn):
+    # open every image again and again, counting the unreadable ones
+    img = os.path.join(folder, 'img')
+    while not stopped.is_set():
+        for name in os.listdir(img):
+            if name.startswith('tex_') and name.endswith(('.png', '.svg')):
+                try:
+                    if get_image_size(os.path.join(img, name)) is None:
+                        torn.append(name)
+                except OSError:
+                    # replaced meanwhile
+                    pass
+
+
+def compare(folder, reference, outputs):
+    # names of the files that differ from the reference build
+    different = []
+    with open(os.path.join(reference, 'out.md'), 'rb') as f:
+        expected = f.read()
+    for output_md in outputs:
+        with open(os.path.join(folder, output_md), 'rb') as f:
+            if f.read() != expected:
+                different.append(output_md)
+    for name in os.listdir(os.path.join(reference, 'img')):
+        if not name.startswith('tex_'):
+            continue
+        with open(os.path.join(reference, 'img', name), 'rb') as f, \
+                open(os.path.join(folder, 'img', name), 'rb') as g:
+            if f.read() != g.read():
+                different.append(name)
+    return different
+
+
+def list_images(folder):
+    return [name for name in os.listdir(os.path.join(folder, 'img'))
+            if name.startswith('tex_') and name.endswith(('.png', '.svg'))]
+
+
+def check_folder(folder, outputs):
+    """
+    Problems of the shared image folder after the builds of `outputs`: the
+    build graph must list every output, the manifest every image, and no
+    lock or temporary file may be left behind.
+    """
+    problems = []
+    graph = BuildGraph(os.path.join(folder, 'img'))
+    # the builds ran in `folder`, see BuildGraph
+    missing = [output_md for output_md in outputs
+               if os.path.join(os.path.realpath(folder), output_md)
+               not in graph.outputs]
+    if missing:
+        problems.append('outputs missing from the build graph: {}'
+                        .format(missing))
+    manifest = Manifest(os.path.join(folder, 'img'))
+    untracked = [name for name in list_images(folder)
+                 if name not in manifest.entries]
+    if untracked:
+        problems.append('{} images missing from the manifest'
+                        .format(len(untracked)))
+    leftovers = [name for name in os.listdir(os.path.join(folder, 'img'))
+                 if name.endswith(('.lock', '.part'))]
+    if leftovers:
+        problems.append('left behind: {}'.format(leftovers[:5]))
+    return problems
+
+
+def run_builds(title, folder, pairs, build_args, unique=None):
+    """
+    Build every (src_md, output_md) of `pairs` at once in `folder`, while
+    images are read. Returns the problems found.
+    """
+    stopped = threading.Event()
+    torn = []
+    reader = threading.Thread(target=read_images,
+                              args=(folder, stopped, torn))
+    reader.start()
+    start = time.perf_counter()
+    # a cold DVI cache each, so that a duplicated render runs dvipng
+    builds = [start_build(folder, src_md, output_md,
+                          build_args + ['--no-dvi-cache'])
+              for src_md, output_md in pairs]
+    problems = []
+    stats = []
+    for build in builds:
+        output = build.communicate()[0].decode('utf-8', 'replace')
+        if build.returncode != 0:
+            problems.append('a build failed:\n' + output)
+        stats.append(counters(output))
+    elapsed = time.perf_counter() - start
+    stopped.set()
+    reader.join()
+
+    if unique is None:
+        unique = len(list_images(folder))
+    renders = sum(stat.get('subprocess.dvipng', 0) for stat in stats)
+    waited = sum(stat.get('lock.waited', 0) for stat in stats)
+    print('{}: {} processes, {} formulas: {:.2f}s, {} dvipng runs, {} waits '
+          'on another process, {} torn reads'.format(
+              title, len(pairs), unique, elapsed, renders, waited,
+              len(torn)))
+    batched = {'-b', '--batch', '-w', '--worker'} & set(build_args)
+    if not batched and renders > unique:
+        # a batch runs dvipng once for many formulas
+        problems.append('{} formulas rendered more than once'
+                        .format(renders - unique))
+    if torn:
+        problems.append('half-written images: {}'.format(torn[:5]))
+    return problems + check_folder(folder, [output_md
+                                            for _, output_md in pairs])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_concurrent')
+    parser.add_argument('-p', '--processes', type=int, default=4,
+                        help='number of concurrent gitex processes')
+    parser.add_argument('-k', '--kind', default='inline', choices=KINDS)
+    parser.add_argument('-n', type=int, default=200,
+                        help='number of formulas of the corpus')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    parser.add_argument('--args', default='',
+                        help='more gitex options of every build, e.g. '
+                        '"-b -j 2"')
+    args = parser.parse_args()
+    build_args = shlex.split(args.args)
+
+    work_dir = tempfile.mkdtemp('gitex-bench')
+    os.environ['GITEX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+    problems = []
+    try:
+        reference = os.path.join(work_dir, 'reference')
+        src_md = gen_corpus(reference, args.kind, args.n)
+        folder = os.path.join(work_dir, 'shared')
+        shutil.copytree(reference, folder)
+        os.makedirs(os.path.join(reference, 'img'))
+        os.makedirs(os.path.join(folder, 'img'))
+        build = start_build(reference, src_md, 'out.md',
+                            build_args + ['--no-dvi-cache'])
+        output = build.communicate()[0].decode('utf-8', 'replace')
+        assert build.returncode == 0, output
+        unique = len(list_images(reference))
+
+        # the same document
+        outputs = ['out{}.md'.format(i) for i in range(args.processes)]
+        problems += run_builds('same document', folder,
+                               [(src_md, output_md) for output_md in outputs],
+                               build_args, unique)
+        different = compare(folder, reference, outputs)
+        if different:
+            problems.append('different from a single build: {}'
+                            .format(different[:5]))
+
+        # a document each, sharing most formulas
+        folder = os.path.join(work_dir, 'distinct')
+        os.makedirs(os.path.join(folder, 'img'))
+        pairs = [(gen_corpus(folder, args.kind, args.n + i),
+                  'doc{}.md'.format(i)) for i in range(args.processes)]
+        problems += run_builds('distinct documents', folder, pairs,
+                               build_args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit('Concurrent builds are not safe.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Per-formula latency of tex2png() with and without a precompiled format.
+Runs on the fake toolchain of benchmarks/fake_tex unless --real-tex is
+given.
+Usage: python benchmarks/bench_precompile.py [-n 50] [-p packages]
+         [--latency 0.02] [--real-tex]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.tex2png import tex2png, dump_format
+
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+
+
+def formulas(n):
+    return [r'\sum_{{i=1}}^{{{0}}} x_i^{{{0}}} = \frac{{{0}}}{{\alpha}}'
+            .format(i) for i in range(n)]
+
+
+def bench(n, packages, precompile):
+    temp_dir = tempfile.mkdtemp('gitex-bench')
+    start = time.time()
+    for i, formula in enumerate(formulas(n)):
+        tex2png(formula, os.path.join(temp_dir, '{}.png'.format(i)),
+                packages=packages, precompile=precompile, dvi_cache=False)
+    elapsed = time.time() - start
+    shutil.rmtree(temp_dir)
+    return elapsed / n
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_precompile')
+    parser.add_argument('-n', type=int, default=50,
+                        help='number of formulas')
+    parser.add_argument('-p', '--packages', default='',
+                        help='extra LaTeX packages')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    args = parser.parse_args()
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+        # keep the fake format out of the real cache
+        os.environ['GITEX_CACHE_DIR'] = tempfile.mkdtemp('gitex-bench')
+
+    # the format is dumped once, don't count it in the per-formula latency
+    start = time.time()
+    dump_format(args.packages)
+    print('dump format: {:.1f} ms'.format((time.time() - start) * 1000))
+    before = bench(args.n, args.packages, precompile=False)
+    after = bench(args.n, args.packages, precompile=True)
+    print('full preamble: {:.1f} ms/formula'.format(before * 1000))
+    print('precompiled:   {:.1f} ms/formula'.format(after * 1000))
+    print('speedup:       {:.2f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Concurrent load test of `gitex serve`: latency, and correctness of the
+returned images and of request coalescing.
+The service runs in-process on the fake toolchain of benchmarks/fake_tex
+unless --real-tex is given, or --url points to a running service.
+Usage: python benchmarks/bench_serve.py [-n 50] [-r 8] [-c 32]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.imgsize import get_png_size
+from corpus import gen_formula
+
+
+def fetch(url, formula, **params):
+    query = urllib.parse.urlencode(dict(params, formula=formula))
+    start = time.perf_counter()
+    with urllib.request.urlopen('{}/render?{}'.format(url, query)) as resp:
+        data = resp.read()
+        headers = resp.headers
+    return time.perf_counter() - start, data, headers
+
+
+def check(formula, data, headers, seen):
+    """
+    The image must be a PNG of the advertised size, and identical requests
+    must get identical bytes.
+    """
+    size = get_png_size(data)
+    assert size is not None, 'not a PNG for `{}`'.format(formula)
+    assert size == (int(headers['X-Gitex-Width']),
+                    int(headers['X-Gitex-Height'])), \
+        'size header mismatch for `{}`'.format(formula)
+    expected = seen.setdefault(formula, data)
+    assert expected == data, 'different images for `{}`'.format(formula)
+
+
+def run_round(url, requests, concurrency, seen):
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda formula: (formula,) + fetch(url, formula),
+                                requests))
+    for formula, _, data, headers in results:
+        check(formula, data, headers, seen)
+    return [latency for _, latency, _, _ in results]
+
+
+def summary(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1,
+                                   int(q * len(latencies)))] * 1000
+    print('{:6s} {:5d} requests {:7.1f} req/s  p50 {:7.1f} ms  '
+          'p95 {:7.1f} ms  p99 {:7.1f} ms  max {:7.1f} ms'.format(
+              name, len(latencies), len(latencies) / elapsed,
+              statistics.median(latencies) * 1000, pick(0.95), pick(0.99),
+              latencies[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_serve')
+    parser.add_argument('-n', '--formulas', type=int, default=50,
+                        help='distinct formulas')
+    parser.add_argument('-r', '--repeat', type=int, default=8,
+                        help='requests per formula, sent concurrently')
+    parser.add_argument('-c', '--concurrency', type=int, default=32,
+                        help='client threads')
+    parser.add_argument('-j', '--max-renders', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    parser.add_argument('--url', help='test a running service instead')
+    args = parser.parse_args()
+
+    image_folder = tempfile.mkdtemp('gitex-bench-serve')
+    server = None
+    url = args.url
+    if url is None:
+        if not args.real_tex:
+            os.environ['GITEX_BIN_PATH'] = os.path.join(BENCH_DIR, 'fake_tex')
+            os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+        from gitex.server import make_server
+        server = make_server(image_folder=image_folder,
+                             max_renders=args.max_renders)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://{}:{}'.format(*server.server_address[:2])
+
+    formulas = [gen_formula(i) for i in range(args.formulas)]
+    requests = formulas * args.repeat
+    random.Random(0).shuffle(requests)
+    seen = {}
+    try:
+        start = time.perf_counter()
+        cold = run_round(url, requests, args.concurrency, seen)
+        summary('cold', cold, time.perf_counter() - start)
+        start = time.perf_counter()
+        warm = run_round(url, requests, args.concurrency, seen)
+        summary('warm', warm, time.perf_counter() - start)
+
+        # bad parameters are refused before anything renders
+        for params in [dict(foreground='rgb 1 2'), dict(background='nocolor'),
+                       dict(foreground='rgb red 0 0'), dict(dpi='high'),
+                       dict(math_mode='inlined')]:
+            try:
+                fetch(url, 'x', **params)
+                raise AssertionError('{} must be refused'.format(params))
+            except urllib.error.HTTPError as exc:
+                assert exc.code == 400, (params, exc.code)
+
+        # LaTeX errors come back as 422
+        try:
+            fetch(url, r'\undefinedcs')
+            raise AssertionError('a bad formula must fail')
+        except urllib.error.HTTPError as exc:
+            assert exc.code == 422, exc.code
+
+        with urllib.request.urlopen(url + '/stats') as resp:
+            stats = json.loads(resp.read().decode('utf-8'))
+        print('server: ' + ', '.join('{} {}'.format(key, value)
+                                     for key, value in sorted(stats.items())))
+        if server is not None:
+            # every formula is rendered exactly once despite the duplicates
+            assert stats['renders'] == len(formulas) + 1, stats
+        print('OK: {} images checked'.format(len(seen)))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.service.close()
+        shutil.rmtree(image_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Distributed rendering through a spool directory, with local processes: a
+`gitex --spool` coordinator and several `gitex worker` processes render a
+generated corpus. The output markdown and the images must be identical to
+those of a local build. With --kill, a first worker is killed in the middle
+of a render, and its claim must time out and go to another worker.
+Runs on the fake toolchain of benchmarks/fake_tex unless --real-tex is
+given.
+Usage: python benchmarks/bench_spool.py [-k inline] [-n 200] [-w 1,2,4]
+         [-j 2] [--latency 0.02] [--kill]
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess as pc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.compile import compile
+from corpus import KINDS, gen_corpus
+
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+
+
+def start_worker(folder, jobs, latency=None):
+    env = dict(os.environ, PYTHONPATH=os.path.join(BENCH_DIR, '..'))
+    if latency is not None:
+        env['FAKE_TEX_LATENCY'] = str(latency)
+    return pc.Popen([sys.executable, '-m', 'gitex.compile', 'worker', 'spool',
+                     '-j', str(jobs), '--idle-exit', '1', '--no-dvi-cache'],
+                    cwd=folder,
+                    env=env, stdout=pc.DEVNULL, stderr=pc.DEVNULL)
+
+
+def build(folder, src_md, **options):
+    # seconds to compile `src_md` in `folder`
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        os.makedirs('img', exist_ok=True)
+        start = time.perf_counter()
+        compile(src_md, 'out.md', image_folder='img', redraw=False, dpi=200,
+                **options)
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+
+def same_build(folder, reference):
+    # identical output markdown and images
+    images = [os.path.join('img', name)
+              for name in os.listdir(os.path.join(reference, 'img'))
+              if name.startswith('tex_')]
+    for path in ['out.md'] + images:
+        with open(os.path.join(folder, path), 'rb') as f, \
+                open(os.path.join(reference, path), 'rb') as g:
+            if f.read() != g.read():
+                return False
+    return True
+
+
+def bench_workers(work_dir, src_md, reference, n_workers, jobs):
+    folder = os.path.join(work_dir, 'spool{}'.format(n_workers))
+    shutil.copytree(reference, folder,
+                    ignore=shutil.ignore_patterns('img', 'out.md'))
+    workers = [start_worker(folder, jobs) for _ in range(n_workers)]
+    elapsed = build(folder, src_md, spool='spool')
+    for worker in workers:
+        worker.wait()
+    return elapsed, same_build(folder, reference)
+
+
+def bench_kill(work_dir, src_md, reference, jobs, latency):
+    """
+    Kill the worker holding the first claim, the coordinator must queue it
+    again after the claim timeout.
+    """
+    folder = os.path.join(work_dir, 'kill')
+    shutil.copytree(reference, folder,
+                    ignore=shutil.ignore_patterns('img', 'out.md'))
+    coordinator = threading.Thread(target=build, args=(folder, src_md),
+                                   kwargs=dict(spool='spool',
+                                               claim_timeout=1))
+    coordinator.start()
+    # slow enough to be killed in the middle of its first render
+    doomed = start_worker(folder, 1, latency=30)
+    claimed = os.path.join(folder, 'spool', 'claimed')
+    while not (os.path.isdir(claimed) and os.listdir(claimed)):
+        time.sleep(0.05)
+    doomed.send_signal(signal.SIGKILL)
+    doomed.wait()
+    workers = [start_worker(folder, jobs, latency) for _ in range(2)]
+    coordinator.join()
+    for worker in workers:
+        worker.wait()
+    return same_build(folder, reference)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_spool')
+    parser.add_argument('-k', '--kind', default='inline', choices=KINDS)
+    parser.add_argument('-n', type=int, default=200,
+                        help='number of formulas of the corpus')
+    parser.add_argument('-w', '--workers', default='1,2,4',
+                        help='comma separated numbers of worker processes')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='formulas rendered in parallel per worker')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    parser.add_argument('--kill', action='store_true',
+                        help='also check that the claim of a killed worker '
+                        'is rendered by another one')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp('gitex-bench')
+    # the DVI cache would let later runs skip latex
+    os.environ['GITEX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+    failed = False
+    try:
+        reference = os.path.join(work_dir, 'local')
+        src_md = gen_corpus(reference, args.kind, args.n)
+        local_time = build(reference, src_md, jobs=args.jobs,
+                           dvi_cache=False)
+        print('{:12s} {:8.2f}s'.format('local -j{}'.format(args.jobs),
+                                       local_time))
+        for n_workers in map(int, args.workers.split(',')):
+            elapsed, same = bench_workers(work_dir, src_md, reference,
+                                          n_workers, args.jobs)
+            print('{:12s} {:8.2f}s {:5.1f}x{}'.format(
+                '{} workers'.format(n_workers), elapsed, local_time / elapsed,
+                '' if same else '  DIFFERENT OUTPUT'))
+            failed |= not same
+        if args.kill:
+            same = bench_kill(work_dir, src_md, reference, args.jobs,
+                              args.latency)
+            print('killed worker: {}'.format('claim rendered again' if same
+                                             else 'DIFFERENT OUTPUT'))
+            failed |= not same
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failed:
+        sys.exit('Spool builds differ from the local build.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+GiTeX benchmark suite, writes machine-readable JSON results so that
+regressions in compile() and tex2png() can be tracked over time.
+Scenarios:
+  cold     compile() into an empty image folder
+  warm     compile() again, every image is cached, without build graph
+  noop     compile() again, nothing changed since the last build
+  edit     compile() after adding a paragraph at the end of the source
+  restyle  compile() at another DPI, latex is skipped by the DVI cache
+  parse    the markdown front end only, compile.scan()
+  imgsize  get_image_size() of every image of the build
+  tex2png  latency of single tex2png() calls
+Runs on the fake toolchain of benchmarks/fake_tex (injected through
+$GITEX_BIN_PATH) unless --real-tex is given.
+Usage: python benchmarks/bench_suite.py [-k inline,display] [-n 50,500]
+         [-s cold,warm,parse] [--latency 0.02] [-o results.json] [-b -j 4]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.tex2png import tex2png, get_cache_dir
+from gitex.imgsize import get_image_size
+from gitex.buildgraph import GRAPH_FILE
+from corpus import KINDS, SIZES, gen_corpus, gen_formula
+compile_module = sys.modules['gitex.compile']
+
+SCENARIOS = ['cold', 'warm', 'noop', 'edit', 'restyle', 'parse', 'imgsize',
+             'tex2png']
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+
+
+def timed(func, repeat):
+    """
+    Returns the wall times of `repeat` calls of func(i)
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def clear_dvi_cache():
+    shutil.rmtree(get_cache_dir('dvi'), ignore_errors=True)
+
+
+def bench_corpus(kind, n, scenarios, repeat, options):
+    """
+    Run the compile scenarios on one generated corpus.
+    Must be called from the corpus folder.
+    """
+    src_md = gen_corpus(os.curdir, kind, n)
+    n_formulas = len(compile_module.scan(src_md, image_folder='img',
+                                         redraw=False, dpi=200).jobs)
+
+    def build(i, dpi=200):
+        compile_module.compile(src_md, 'out.md', image_folder='img',
+                               redraw=False, dpi=dpi, **options)
+
+    def cold(i):
+        shutil.rmtree('img', ignore_errors=True)
+        os.mkdir('img')
+        clear_dvi_cache()
+        build(i)
+
+    def warm(i):
+        # every region is scanned again
+        os.remove(os.path.join('img', GRAPH_FILE))
+        build(i)
+
+    def edit(i):
+        with open(src_md, 'a') as f:
+            f.write('\nEdit {} of the source.\n'.format(i))
+        build(i)
+
+    def restyle(i):
+        # a new DPI every run, so that no image is cached
+        build(i, dpi=201 + i)
+
+    def parse(i):
+        compile_module.scan(src_md, image_folder='img', redraw=False,
+                            dpi=200)
+
+    def imgsize(i):
+        for name in os.listdir('img'):
+            if name.endswith('.png'):
+                get_image_size(os.path.join('img', name))
+
+    results = []
+    for scenario in scenarios:
+        if (scenario in ['warm', 'noop', 'edit', 'restyle', 'imgsize'] 
+                and not os.path.exists('out.md')):
+            # needs the images of a cold build
+            cold(0)
+        func = {'cold': cold, 'warm': warm, 'noop': build, 'edit': edit,
+                'restyle': restyle, 'parse': parse,
+                'imgsize': imgsize}[scenario]
+        results.append(result(scenario, kind, n, n_formulas,
+                              timed(func, repeat)))
+    return results
+
+
+def bench_tex2png(n, repeat, options):
+    formulas = [gen_formula(i) for i in range(n)]
+    tex2png_options = {key: value for key, value in options.items()
+                       if key in ['precompile', 'worker']}
+
+    def render(i):
+        clear_dvi_cache()
+        for j, formula in enumerate(formulas):
+            tex2png(formula, 'tex2png_{}.png'.format(j), dpi=200,
+                    **tex2png_options)
+
+    return result('tex2png', None, n, n, timed(render, repeat))
+
+
+def result(scenario, kind, size, n_formulas, times):
+    best = min(times)
+    return {'scenario': scenario,
+            'kind': kind,
+            'size': size,
+            'formulas': n_formulas,
+            'times': times,
+            'best': best,
+            'median': statistics.median(times),
+            'per_formula_ms': best / max(1, n_formulas) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_suite')
+    parser.add_argument('-k', '--kinds', default=','.join(KINDS),
+                        help='corpus kinds: ' + ', '.join(KINDS))
+    parser.add_argument('-n', '--sizes', default=','.join(map(str, SIZES)),
+                        help='corpus sizes in formulas')
+    parser.add_argument('-s', '--scenarios', default=','.join(SCENARIOS),
+                        help='scenarios: ' + ', '.join(SCENARIOS))
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per scenario, the best one counts')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    parser.add_argument('--tex2png-formulas', type=int, default=20,
+                        help='formulas rendered by the tex2png scenario')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON results file, `-` for stdout')
+    parser.add_argument('-b', '--batch', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-P', '--precompile', action='store_true')
+    parser.add_argument('-w', '--worker', action='store_true')
+    parser.add_argument('-O', '--optimize', nargs='?', const='python',
+                        default=False)
+    args = parser.parse_args()
+
+    kinds = args.kinds.split(',')
+    sizes = [int(size) for size in args.sizes.split(',')]
+    scenarios = args.scenarios.split(',')
+    for name in kinds + scenarios:
+        assert name in KINDS + SCENARIOS, 'unknown kind or scenario ' + name
+    options = dict(batch=args.batch, jobs=args.jobs, optimize=args.optimize,
+                   precompile=args.precompile, worker=args.worker)
+
+    work_dir = tempfile.mkdtemp('gitex-bench')
+    # keep precompiled formats away from the user cache
+    os.environ['GITEX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+    cwd = os.getcwd()
+    results = []
+    try:
+        for kind in kinds:
+            for size in sizes:
+                corpus_dir = os.path.join(work_dir, '{}_{}'.format(kind, size))
+                os.makedirs(corpus_dir)
+                os.chdir(corpus_dir)
+                corpus_scenarios = [s for s in scenarios if s != 'tex2png']
+                results += bench_corpus(kind, size, corpus_scenarios,
+                                        args.repeat, options)
+                for res in results[-len(corpus_scenarios):]:
+                    print('{scenario:8s} {kind:8s} {size:6d} {formulas:6d} '
+                          'formulas {best:8.3f}s {per_formula_ms:8.2f} '
+                          'ms/formula'.format(**res), file=sys.stderr)
+        if 'tex2png' in scenarios:
+            os.chdir(work_dir)
+            res = bench_tex2png(args.tex2png_formulas, args.repeat, options)
+            results.append(res)
+            print('tex2png  {formulas:6d} formulas {best:8.3f}s '
+                  '{per_formula_ms:8.2f} ms/formula'.format(**res),
+                  file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'meta': {'timestamp': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'toolchain': 'real' if args.real_tex else 'fake',
+                       'latency': None if args.real_tex else args.latency,
+                       'repeat': args.repeat,
+                       'options': options},
+              'results': results}
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
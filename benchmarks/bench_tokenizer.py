@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Throughput of the markdown front end on a large generated document.
+Only tokenize() and compile.scan() are timed, nothing is rendered.
+Usage: python benchmarks/bench_tokenizer.py [-m 8]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gitex.tokenizer import tokenize
+compile_module = sys.modules['gitex.compile']
+
+PARAGRAPHS = [
+    'Plain prose with a formula $x_{0} + y^2$ and an escaped \\$ sign.\n',
+    'Some text, $\\frac{a}{b}$[dpi=200] and $\\alpha$ inline.\n',
+    '$$\\sum_{i=1}^{n} i = \\frac{n(n+1)}{2}$$\n',
+    '$$\n\\int_0^1 f(x)\\,dx\n$$\n',
+    '![figure](https://example.com/figure.png =300x)\n',
+    '\\begin[math_mode=display]\n\\begin{align}\na &= b \\\\\nc &= d\n'
+    '\\end{align}\n\\end\n',
+    'A line without any math at all, just words and punctuation.\n',
+    '\n',
+]
+
+
+def gen_markdown(path, megabytes):
+    rand = random.Random(0)
+    size = 0
+    with open(path, 'w') as f:
+        while size < megabytes * 1024 * 1024:
+            paragraph = rand.choice(PARAGRAPHS)
+            f.write(paragraph)
+            size += len(paragraph)
+
+
+def bench(name, func, path, megabytes):
+    start = time.time()
+    count = func(path)
+    elapsed = time.time() - start
+    print('{:10s} {:8.2f} MB/s  {} segments'.format(
+        name, megabytes / elapsed, count))
+
+
+def run_tokenize(path):
+    with open(path) as f:
+        return sum(1 for _ in tokenize(f))
+
+
+def run_scan(path):
+    doc = compile_module.scan(path, image_folder=tempfile.gettempdir(),
+                              redraw=False)
+    return len(doc.pieces)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_tokenizer')
+    parser.add_argument('-m', '--megabytes', type=float, default=8,
+                        help='size of the generated markdown')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp('.md', 'gitex-bench')
+    os.close(fd)
+    try:
+        gen_markdown(path, args.megabytes)
+        bench('tokenize', run_tokenize, path, args.megabytes)
+        bench('scan', run_scan, path, args.megabytes)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
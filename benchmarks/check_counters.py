@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+A numbered environment must look the same whether it is rendered alone, on
+a page of a batch after other numbered formulas, or as a later job of a
+resident LaTeX worker: LaTeX counters are global, so every page and every
+job starts from fresh counters.
+Runs on the fake toolchain of benchmarks/fake_tex, which numbers equations,
+unless --real-tex is given.
+Usage: python benchmarks/check_counters.py [--latency 0] [--real-tex]
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.tex2png import tex2png_image, tex2png_batch, RenderSession
+
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+FORMULAS = [r'\begin{equation}a^2 + b^2 = c^2\end{equation}',
+            r'\begin{align}x &= 1 \\ y &= 2\end{align}',
+            r'\begin{equation}e^{i\pi} + 1 = 0\end{equation}']
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='check_counters')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds per fake latex/dvipng call')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp('gitex-check')
+    os.environ['GITEX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+        os.environ['FAKE_TEX_LATENCY'] = str(args.latency)
+    problems = []
+    try:
+        alone = [tex2png_image(formula, 'none', dvi_cache=False)
+                 for formula in FORMULAS]
+        jobs = [(formula, os.path.join(work_dir, '{}.png'.format(i)), 'none')
+                for i, formula in enumerate(FORMULAS)]
+        tex2png_batch(jobs, dvi_cache=False)
+        for (formula, png_file, _), image in zip(jobs, alone):
+            if read(png_file) != image.data:
+                problems.append('batch: `{}` differs'.format(formula))
+        with RenderSession() as session:
+            for formula, image in zip(FORMULAS, alone):
+                job = tex2png_image(formula, 'none', worker=True,
+                                    session=session, dvi_cache=False)
+                if job.data != image.data:
+                    problems.append('worker: `{}` differs'.format(formula))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit('Equation numbers depend on the other formulas rendered.')
+    print('{} numbered formulas: same images alone, in a batch and on a '
+          'worker'.format(len(FORMULAS)))
+
+
+if __name__ == '__main__':
+    main()
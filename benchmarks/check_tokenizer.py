@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+tokenize_line() must split a line the way the original scanner did: it
+replaced all display formulas of the line first, then the inline formulas
+left between them, then the escapes. `$$` thus wins over a `$` further
+left, e.g. `$x$$a$$` is the text `$x` then the display formula `a`.
+Random lines are checked against an emulation of those passes, except
+those where the original inline pass matched across a replaced display
+formula and rendered its image code as LaTeX.
+Usage: python benchmarks/check_tokenizer.py [-n 20000] [--seed 0]
+"""
+import os
+import re
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gitex.tokenizer import (tokenize_line, display_re, inline_re,
+                             escapes_re, ESCAPES)
+
+# (line, expected rendering) found to differ from the original scanner
+CASES = [
+    ('$x$$a$$', "$x('display', 'a', None)"),
+    ('\\\\end$[))$$a$$x', "\\end$[))('display', 'a', None)x"),
+    ('$$a$$[dpi=300] $b$',
+     "('display', 'a', 'dpi=300') ('inline', 'b', None)"),
+    ('$a$ \\$ $$b$$', "('inline', 'a', None) $ ('display', 'b', None)"),
+]
+ALPHABET = ['$', '$', '$$', 'a', 'x', ' ', '[', ']', '(', ')', '\\',
+            '\\\\end', '\\$', '[dpi=300]']
+PLACEHOLDER = '\x01{}\x02'
+placeholder_re = re.compile('\x01(\\d+)\x02')
+
+
+def passes(line):
+    """
+    The line rendered by the passes of the original scanner, or None if an
+    inline formula spans a display formula.
+    """
+    found = []
+
+    def replace(regex, kind, line):
+        def sub(match):
+            if placeholder_re.search(match.group()):
+                raise ValueError(match.group())
+            found.append((kind, match.group('formula'),
+                          match.group('options')))
+            return PLACEHOLDER.format(len(found) - 1)
+        return regex.sub(sub, line)
+
+    try:
+        line = replace(display_re, 'display', line)
+        line = replace(inline_re, 'inline', line)
+    except ValueError:
+        return None
+    line = escapes_re.sub(lambda match: ESCAPES[match.group()], line)
+    return placeholder_re.sub(
+        lambda match: repr(found[int(match.group(1))]), line)
+
+
+def render(line):
+    out = []
+    for segment in tokenize_line(line, images=False):
+        if segment.kind == 'text':
+            out.append(segment.text)
+        elif segment.kind == 'escape':
+            out.append(segment.value)
+        else:
+            out.append(repr((segment.kind, segment.value, segment.options)))
+    return ''.join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='check_tokenizer')
+    parser.add_argument('-n', type=int, default=20000,
+                        help='number of random lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    problems = []
+    for line, expected in CASES:
+        if render(line) != expected:
+            problems.append('{!r}: {} instead of {}'
+                            .format(line, render(line), expected))
+    rand = random.Random(args.seed)
+    skipped = 0
+    for _ in range(args.n):
+        line = ''.join(rand.choice(ALPHABET)
+                       for _ in range(rand.randint(1, 14)))
+        expected = passes(line)
+        if expected is None:
+            skipped += 1
+        elif render(line) != expected:
+            problems.append('{!r}: {} instead of {}'
+                            .format(line, render(line), expected))
+    for problem in problems[:20]:
+        print(problem)
+    if problems:
+        sys.exit('{} lines are split differently from the original scanner.'
+                 .format(len(problems)))
+    print('{} lines split as by the original scanner ({} spanning a display '
+          'formula skipped)'.format(len(CASES) + args.n - skipped, skipped))
+
+
+if __name__ == '__main__':
+    main()
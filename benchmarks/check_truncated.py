@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+A cached image cut short, e.g. by a full disk or a killed copy, must be
+rendered again by the next build, in png and in svg. Only its header is
+left intact, which is all that gives the size of the image.
+Runs on the fake toolchain of benchmarks/fake_tex unless --real-tex is
+given.
+Usage: python benchmarks/check_truncated.py [-n 20] [--real-tex]
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from gitex.compile import compile
+from corpus import gen_corpus
+
+FAKE_TEX = os.path.join(BENCH_DIR, 'fake_tex')
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def check(src_md, format):
+    """
+    Problems found after truncating an image of a `format` build.
+    """
+    problems = []
+    compile(src_md, 'out.md', image_folder='img', redraw=False, dpi=200,
+            format=format)
+    names = sorted(name for name in os.listdir('img')
+                   if name.endswith('.' + format))
+    expected = {name: read(os.path.join('img', name)) for name in names}
+    # past the 24 header bytes, and short of the end of the image
+    name = max(names, key=lambda name: len(expected[name]))
+    with open(os.path.join('img', name), 'wb') as f:
+        f.write(expected[name][:max(32, len(expected[name]) // 2)])
+    compile(src_md, 'out.md', image_folder='img', redraw=False, dpi=200,
+            format=format)
+    for name in names:
+        if read(os.path.join('img', name)) != expected[name]:
+            problems.append('{}: {} was not rendered again'
+                            .format(format, name))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='check_truncated')
+    parser.add_argument('-n', type=int, default=20,
+                        help='number of formulas of the corpus')
+    parser.add_argument('--real-tex', action='store_true',
+                        help='use the installed TeX instead of the fake one')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp('gitex-check')
+    os.environ['GITEX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    if not args.real_tex:
+        os.environ['GITEX_BIN_PATH'] = FAKE_TEX
+    cwd = os.getcwd()
+    problems = []
+    try:
+        for format in ['png', 'svg']:
+            folder = os.path.join(work_dir, format)
+            src_md = gen_corpus(folder, 'inline', args.n)
+            os.chdir(folder)
+            os.makedirs('img')
+            problems += check(src_md, format)
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit('Truncated images are reused.')
+    print('truncated png and svg images are rendered again')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Synthetic GiTeX markdown corpus for the benchmarks.
+Kinds: inline, display, begin and include heavy documents, and a mix.
+About a fifth of the formulas repeat earlier ones, like shared notation.
+Usage: python benchmarks/corpus.py folder [-k inline] [-n 500]
+"""
+import os
+import random
+import argparse
+
+KINDS = ['inline', 'display', 'begin', 'include', 'mixed']
+SIZES = [50, 500, 2000]
+
+WORDS = ('the of formula we define and let where it follows that for all '
+         'hence thus consider value bound term given').split()
+
+
+def gen_formula(i):
+    templates = [r'x_{{{0}}}^2 + y_{{{0}}}',
+                 r'\frac{{a_{{{0}}}}}{{b + {0}}}',
+                 r'\sum_{{k=1}}^{{{0}}} k^2',
+                 r'\alpha_{{{0}}} \leq \beta^{{{0}}}',
+                 r'\int_0^{{{0}}} f(t)\,dt']
+    return templates[i % len(templates)].format(i)
+
+
+def gen_text(rand, n_words):
+    return ' '.join(rand.choice(WORDS) for _ in range(n_words))
+
+
+def gen_block(rand, kind, i, include_dir):
+    """
+    One paragraph holding formula number `i` (and its neighbours for inline).
+    """
+    formula = gen_formula(i)
+    if kind == 'inline':
+        return '{} ${}$ {} ${}$[dpi=150] {} ${}$.\n\n'.format(
+            gen_text(rand, 8), formula, gen_text(rand, 5),
+            gen_formula(i + 1), gen_text(rand, 6), gen_formula(i + 2))
+    elif kind == 'display':
+        if i % 3:
+            return '{}\n\n$${}$$\n\n'.format(gen_text(rand, 12), formula)
+        return '{}\n\n$$\n{}\n$$\n\n'.format(gen_text(rand, 12), formula)
+    elif kind == 'begin':
+        return ('{}\n\\begin[math_mode=display]\n\\begin{{align}}\n'
+                '{} &= 0 \\\\\n{} &= 1\n\\end{{align}}\n\\end\n\n'
+                .format(gen_text(rand, 10), formula, gen_formula(i + 1)))
+    elif kind == 'include':
+        tex_file = os.path.join(include_dir, 'f{}.tex'.format(i))
+        with open(tex_file, 'w') as f:
+            f.write('\\[ {} \\]\n'.format(formula))
+        return '{}\n\\include[{}, dpi=200]\n\n'.format(
+            gen_text(rand, 10), tex_file)
+    else:
+        return gen_block(rand, KINDS[i % 4], i, include_dir)
+
+
+def gen_corpus(folder, kind, n, seed=0):
+    """
+    Write `<kind>_<n>.md` with about `n` formulas into `folder`.
+    \\include files go to `folder/include`, paths are relative to `folder`.
+    Returns the markdown file name, relative to `folder`.
+    """
+    assert kind in KINDS, 'corpus kind must be one of {}'.format(KINDS)
+    rand = random.Random(seed)
+    os.makedirs(os.path.join(folder, 'include'), exist_ok=True)
+    name = '{}_{}.md'.format(kind, n)
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with open(name, 'w') as f:
+            f.write('# {} corpus, {} formulas\n\n'.format(kind, n))
+            per_block = 3 if kind == 'inline' else 1
+            for block in range(max(1, n // per_block)):
+                i = block * per_block
+                if block and rand.random() < 0.2:
+                    # repeated notation
+                    i = rand.randrange(block) * per_block
+                f.write(gen_block(rand, kind, i, 'include'))
+    finally:
+        os.chdir(cwd)
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='corpus')
+    parser.add_argument('folder', help='output folder')
+    parser.add_argument('-k', '--kind', default='mixed', choices=KINDS)
+    parser.add_argument('-n', type=int, default=500,
+                        help='number of formulas')
+    args = parser.parse_args()
+    os.makedirs(args.folder, exist_ok=True)
+    print(os.path.join(args.folder,
+                       gen_corpus(args.folder, args.kind, args.n)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Tiny but valid DVI subset shared by the fake `latex`, `dvipng` and
+`dvisvgm`.
+Every page holds a single `xxx4` special with the TeX source of the page,
+dvipng sizes its image from that text.
+"""
+import os
+import time
+import struct
+
+PRE, POST, POST_POST, BOP, EOP, NOP = 247, 248, 249, 139, 140, 138
+FNT_DEF1, FNT_NUM_0, XXX4 = 243, 171, 242
+NUM, DEN, MAG = 25400000, 473628672, 1000
+
+
+def sleep(fraction=1.0):
+    # $FAKE_TEX_LATENCY: seconds spent by every fake program call
+    time.sleep(fraction * float(os.environ.get('FAKE_TEX_LATENCY', '0')))
+
+
+def pre():
+    return struct.pack('>BBiiiB', PRE, 2, NUM, DEN, MAG, 4) + b'fake'
+
+
+def fnt_def():
+    return struct.pack('>BBIiiBB', FNT_DEF1, 0, 0, 655360, 655360, 0, 5) \
+        + b'cmr10'
+
+
+def page(counts, text, define_font=False):
+    """
+    counts: \\count0-9 of the page
+    define_font: the first page defines the font used by all pages
+    """
+    data = text.encode('utf-8')
+    return (struct.pack('>B10ii', BOP, *(list(counts) + [-1]))
+            + (fnt_def() if define_font else b'') + bytes([FNT_NUM_0])
+            + struct.pack('>BI', XXX4, len(data)) + data + bytes([EOP]))
+
+
+def post():
+    return (struct.pack('>BiiiiiiHH', POST, -1, NUM, DEN, MAG, 0, 0, 1, 0)
+            + fnt_def() + struct.pack('>BiB', POST_POST, 0, 2) + b'\xdf' * 4)
+
+
+def read_pages(data):
+    """
+    Returns [(counts, text)], fails on a font used before its definition.
+    """
+    pos = 15 + data[14]
+    pages = []
+    fonts = set()
+    while pos < len(data) and data[pos] != POST:
+        op = data[pos]
+        if op == FNT_DEF1:
+            fonts.add(data[pos + 1])
+            pos += 2 + 14 + data[pos + 14] + data[pos + 15]
+            continue
+        if op == NOP:
+            pos += 1
+            continue
+        assert op == BOP, 'unexpected DVI opcode {}'.format(op)
+        counts = struct.unpack('>10i', data[pos + 1:pos + 41])
+        pos += 45
+        text = ''
+        while data[pos] != EOP:
+            op = data[pos]
+            if op == FNT_DEF1:
+                fonts.add(data[pos + 1])
+                pos += 2 + 14 + data[pos + 14] + data[pos + 15]
+            elif op == FNT_NUM_0:
+                assert 0 in fonts, 'font 0 used before its definition'
+                pos += 1
+            elif op == XXX4:
+                n = struct.unpack('>I', data[pos + 1:pos + 5])[0]
+                text = data[pos + 5:pos + 5 + n].decode('utf-8')
+                pos += 5 + n
+            else:
+                raise AssertionError('unexpected DVI opcode {}'.format(op))
+        pos += 1
+        pages.append((counts, text))
+    return pages
@@ -3,5 +3,5 @@ GiTeX: LaTeX for Github markdown
 """
 from .colors import CSS3_COLOR_RGB
 from .imgsize import get_image_size
-from .tex2png import tex2png
+from .tex2png import tex2png, RenderSession
 from .compile import compile
\ No newline at end of file
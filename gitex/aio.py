@@ -0,0 +1,331 @@
+"""
+asyncio versions of tex2png() and tex2png_batch(). The latex, dvipng and
+optipng stages run with asyncio.create_subprocess_exec, so a single event
+loop can drive many renders at once without threads:
+
+    image = await async_tex2png(r'\\sqrt{x}', 'sqrt.png', semaphore=sem)
+
+The number of renders running at once is bounded by an asyncio.Semaphore,
+see get_semaphore(). A cancelled render kills its subprocess and cleans up
+its scratch directory.
+Only png images rendered by TeX are supported, without the DVI cache, see
+UNSUPPORTED_OPTIONS.
+"""
+import os
+import asyncio
+import weakref
+import subprocess as pc
+from gitex.tex2png import (RenderSession, attrdict, get_binary, dump_format,
+                           rgb_arg, gen_latex_file, gen_batch_latex_file,
+                           latex_command, dvipng_command, report_latex_error,
+                           report_dvipng_error, parse_dvipng_report,
+                           report_image, OPTIPNG_ARGS)
+from gitex.imgsize import get_png_size
+from gitex.pngopt import optimize_file
+from gitex.stats import stage, count
+from gitex.atomic import write_file, publish_file, temp_path, remove
+
+# event loop -> its default semaphore
+_semaphores = weakref.WeakKeyDictionary()
+# tex2png() options without an asyncio version -> the only value accepted,
+# which renders the same as the asyncio functions
+UNSUPPORTED_OPTIONS = dict(worker=False, format='png', dvi_cache=False,
+                           variants=None, backend='tex')
+
+
+def check_options(options):
+    """
+    Raise on tex2png() `options` that the asyncio functions don't support,
+    see UNSUPPORTED_OPTIONS.
+    """
+    unknown = sorted(set(options) - set(UNSUPPORTED_OPTIONS))
+    if unknown:
+        raise TypeError('unexpected options: {}'.format(', '.join(unknown)))
+    unsupported = sorted(name for name, value in options.items()
+                         if value != UNSUPPORTED_OPTIONS[name])
+    if unsupported:
+        raise Exception('gitex.aio does not support {}, run tex2png() in an '
+                        'executor instead'.format(', '.join(
+                            '{}={!r}'.format(name, options[name])
+                            for name in unsupported)))
+
+
+def get_semaphore(semaphore=None):
+    """
+    `semaphore` if given, otherwise the default semaphore of the running
+    loop, which lets os.cpu_count() renders run at once.
+    """
+    if semaphore is not None:
+        return semaphore
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(os.cpu_count() or 4)
+    return _semaphores[loop]
+
+
+async def run_command(args, env=None):
+    """
+    Like subprocess.check_output(args, env=env).
+    The process is killed if the calling task is cancelled.
+    """
+    process = await asyncio.create_subprocess_exec(*args, stdout=pc.PIPE,
+                                                   env=env)
+    try:
+        output, _ = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        raise
+    if process.returncode:
+        raise pc.CalledProcessError(process.returncode, args, output)
+    return output
+
+
+async def run_latex(temp_dir, temp_tex, verbose=True, fmt=None, latex=None):
+    # see tex2png.run_latex(), the caller cleans up temp_dir
+    args, env = latex_command(temp_dir, temp_tex.name, fmt, latex)
+    count('subprocess.latex')
+    try:
+        with stage('latex'):
+            await run_command(args, env)
+    except pc.CalledProcessError as exc:
+        if verbose:
+            report_latex_error(temp_dir, temp_tex.name, exc.output)
+        raise
+
+
+async def run_dvipng(temp_dir, temp_tex, output_file, dpi, foreground,
+                     background, dvipng=None, report=False):
+    # see tex2png.convert_dvi(), the caller cleans up temp_dir
+    temp_dvi = os.path.splitext(temp_tex.name)[0] + '.dvi'
+    assert os.path.exists(temp_dvi), \
+        "LaTeX generated DVI file {} doesn't exist".format(temp_dvi)
+    count('subprocess.dvipng')
+    try:
+        with stage('dvipng'):
+            output = await run_command(dvipng_command(
+                temp_dvi, output_file, dpi, foreground, background,
+                dvipng=dvipng, report=report))
+    except pc.CalledProcessError as exc:
+        report_dvipng_error(temp_dir, exc.output)
+        raise
+    if report:
+        return parse_dvipng_report(output.decode('utf-8', 'replace'))
+
+
+async def run_optipng(output_file):
+    assert os.path.exists(output_file), \
+        "Output png file {} doesn't exist".format(output_file)
+    optipng = get_binary('optipng')
+    if not optipng:
+        print('optipng not found, skip optimization. ')
+        return
+    count('subprocess.optipng')
+    # optimized next to the image, then renamed over it, see
+    # tex2png.run_optipng()
+    temp_file = temp_path(output_file)
+    try:
+        with stage('optipng'):
+            await run_command([optipng] + OPTIPNG_ARGS
+                              + ['-out', temp_file, output_file])
+        if os.path.exists(temp_file):
+            os.replace(temp_file, output_file)
+    except pc.CalledProcessError as exc:
+        print('optipng ERROR!!!\n',
+              '-'*50, '\n',
+              exc.output.decode('utf-8'),
+              '-'*50) # exc.returncode
+        raise
+    finally:
+        # e.g. cancelled
+        remove(temp_file)
+
+
+async def optimize_image(png_file, optimize=True):
+    # see tex2png.optimize_image(), the in-process pass runs on a thread
+    if not optimize or optimize == 'False': # handle string version
+        return
+    loop = asyncio.get_running_loop()
+    with stage('pngopt'):
+        await loop.run_in_executor(None, optimize_file, png_file)
+    if optimize == 'optipng':
+        await run_optipng(png_file)
+
+
+async def get_format(packages):
+    # dump_format() blocks, but only the first time for `packages`
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, dump_format, packages)
+
+
+async def async_tex2png(formula,
+                        output_file,
+                        math_mode='inline',
+                        dpi=300,
+                        packages='',
+                        foreground='rgb 0.0 0.0 0.0',
+                        background='rgb 1.0 1.0 1.0',
+                        optimize=False,
+                        precompile=False,
+                        semaphore=None,
+                        session=None,
+                        **options):
+    """
+    Same options as tex2png() up to `precompile`, the others raise unless
+    they have the value of UNSUPPORTED_OPTIONS.
+    semaphore: asyncio.Semaphore bounding the renders running at once,
+               see get_semaphore()
+    Returns the image, see tex2png_image()
+    """
+    image = await async_tex2png_image(formula, math_mode, dpi, packages,
+                                      foreground, background, optimize,
+                                      precompile, semaphore, session,
+                                      **options)
+    if hasattr(output_file, 'write'):
+        output_file.write(image.data)
+    else:
+        write_file(output_file, image.data)
+    return image
+
+
+async def async_tex2png_image(formula,
+                              math_mode='inline',
+                              dpi=300,
+                              packages='',
+                              foreground='rgb 0.0 0.0 0.0',
+                              background='rgb 1.0 1.0 1.0',
+                              optimize=False,
+                              precompile=False,
+                              semaphore=None,
+                              session=None,
+                              **options):
+    """
+    See tex2png_image() and async_tex2png()
+    """
+    check_options(options)
+    if session is None:
+        with RenderSession(pool_size=0) as session:
+            return await async_tex2png_image(formula, math_mode, dpi,
+                                             packages, foreground, background,
+                                             optimize, precompile, semaphore,
+                                             session)
+    fmt = None
+    if precompile and math_mode != 'headless':
+        fmt = await get_format(packages)
+    async with get_semaphore(semaphore):
+        temp_dir = session.acquire_dir()
+        png_file = os.path.join(temp_dir, 'formula.png')
+        try:
+            temp_tex = gen_latex_file(temp_dir, formula, packages, math_mode,
+                                      fmt=fmt)
+            await run_latex(temp_dir, temp_tex, fmt=fmt, latex=session.latex)
+            report = await run_dvipng(temp_dir, temp_tex, png_file, dpi,
+                                      foreground=rgb_arg(foreground),
+                                      background=rgb_arg(background),
+                                      dvipng=session.dvipng, report=True)
+            await optimize_image(png_file, optimize)
+            with open(png_file, 'rb') as f:
+                data = f.read()
+        finally:
+            # also on errors and cancellation
+            session.release_dir(temp_dir)
+    width, height = get_png_size(data)
+    depth = report[0].get('depth') if report else None
+    return attrdict(data=data, width=width, height=height, depth=depth)
+
+
+async def async_tex2png_batch(jobs,
+                              dpi=300,
+                              packages='',
+                              foreground='rgb 0.0 0.0 0.0',
+                              background='rgb 1.0 1.0 1.0',
+                              optimize=False,
+                              precompile=False,
+                              semaphore=None,
+                              session=None,
+                              **options):
+    """
+    See tex2png_batch(), the batch takes a single slot of `semaphore`.
+    options: see async_tex2png()
+    jobs: list of (formula, output_file, math_mode)
+    If the batch fails, the formulas are rendered concurrently with
+    async_tex2png() so that the error is reported individually.
+    Returns the images in the order of `jobs`, see tex2png_batch()
+    """
+    check_options(options)
+    options = dict(dpi=dpi, packages=packages, optimize=optimize,
+                   foreground=foreground, background=background,
+                   precompile=precompile, semaphore=semaphore)
+    if session is None:
+        with RenderSession(pool_size=0) as session:
+            return await async_tex2png_batch(jobs, session=session, **options)
+    options['session'] = session
+
+    # output file -> image
+    images = {}
+    all_jobs = jobs
+
+    async def render_each(jobs):
+        # try every formula, then raise the first error
+        results = await asyncio.gather(
+            *[async_tex2png(formula, output_file, math_mode, **options)
+              for formula, output_file, math_mode in jobs],
+            return_exceptions=True)
+        errors = [result for result in results
+                  if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+        for (_, output_file, _), image in zip(jobs, results):
+            images[output_file] = image
+        return [images.get(output_file) for _, output_file, _ in all_jobs]
+
+    # headless formulas are complete documents of their own
+    headless = [job for job in jobs if job[2] == 'headless']
+    jobs = [job for job in jobs if job[2] != 'headless']
+    if len(jobs) <= 1:
+        return await render_each(headless + jobs)
+
+    fmt = await get_format(packages) if precompile else None
+    async with get_semaphore(semaphore):
+        temp_dir = session.acquire_dir()
+        try:
+            temp_tex = gen_batch_latex_file(
+                temp_dir,
+                [(formula, math_mode) for formula, _, math_mode in jobs],
+                packages, fmt=fmt)
+            try:
+                await run_latex(temp_dir, temp_tex, verbose=False, fmt=fmt,
+                                latex=session.latex)
+                batch_failed = False
+            except pc.CalledProcessError:
+                batch_failed = True
+            if not batch_failed:
+                # dvipng replaces %d with the page number, starting from 1
+                page_file = os.path.join(temp_dir, 'page%d.png')
+                report = await run_dvipng(temp_dir, temp_tex, page_file, dpi,
+                                          foreground=rgb_arg(foreground),
+                                          background=rgb_arg(background),
+                                          dvipng=session.dvipng, report=True)
+                page_files = [page_file % (i + 1) for i in range(len(jobs))]
+                # e.g. an empty formula doesn't produce a page
+                page_mismatch = (not all(map(os.path.exists, page_files))
+                                 or os.path.exists(page_file % (len(jobs) + 1)))
+                for metrics, (_, output_file, _) in zip(report, jobs):
+                    images[output_file] = report_image(metrics)
+                if not page_mismatch:
+                    for page_file, (_, output_file, _) in zip(page_files,
+                                                              jobs):
+                        publish_file(page_file, output_file)
+        finally:
+            session.release_dir(temp_dir)
+    if batch_failed:
+        print('LaTeX batch of {} formulas failed, '
+              'render one by one.'.format(len(jobs)))
+        return await render_each(headless + jobs)
+    if page_mismatch:
+        print('LaTeX batch page count mismatch, render one by one.')
+        return await render_each(headless + jobs)
+    await asyncio.gather(*[optimize_image(output_file, optimize)
+                           for _, output_file, _ in jobs])
+    return await render_each(headless)
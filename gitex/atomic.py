@@ -0,0 +1,180 @@
+"""
+Cross-process safe files, for image folders shared by concurrent builds,
+e.g. the jobs of a CI matrix.
+Files are written to a temporary file next to them, then renamed into
+place. A rename is atomic, so readers never see half an image.
+A render lock `<image>.lock`, created with O_EXCL, tells the other processes
+that an image is being rendered. They wait for it instead of rendering it
+again, see compile.render_jobs(). O_EXCL is atomic on local filesystems and
+on NFS v3 and later. A lock that is not refreshed for LOCK_TIMEOUT seconds,
+e.g. of a killed build, is broken.
+Shared state like the manifest is merged under a lock of the same kind, see
+file_lock() and Manifest.save().
+"""
+import os
+import time
+import shutil
+import socket
+import threading
+import contextlib
+from gitex.stats import count
+
+# seconds without refresh before the lock of a dead process is broken
+LOCK_TIMEOUT = 60
+# seconds between two looks at the locks waited for
+POLL_INTERVAL = 0.05
+
+
+def temp_path(path):
+    # unique per host, process and thread, and next to `path` so that the
+    # rename stays on one filesystem
+    return '{}.{}.{}.{}.part'.format(path, socket.gethostname(), os.getpid(),
+                                     threading.get_ident())
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_file(path, data):
+    # write bytes or text, then rename
+    temp_file = temp_path(path)
+    try:
+        with open(temp_file, 'w' if isinstance(data, str) else 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, path)
+    except BaseException:
+        remove(temp_file)
+        raise
+
+
+def publish_file(src, path):
+    # move `src`, e.g. from the scratch space on another filesystem, to `path`
+    temp_file = temp_path(path)
+    try:
+        shutil.move(src, temp_file)
+        os.replace(temp_file, path)
+    except BaseException:
+        remove(temp_file)
+        raise
+
+
+def lock_path(path):
+    return path + '.lock'
+
+
+def break_stale_lock(lock, timeout=LOCK_TIMEOUT):
+    """
+    Returns True if `lock` is gone, or was older than `timeout` seconds and
+    has been removed.
+    """
+    try:
+        age = time.time() - os.stat(lock).st_mtime
+    except OSError:
+        return True
+    if age <= timeout:
+        return False
+    # two processes breaking the same lock at once may render an image
+    # twice, which the atomic writes make harmless
+    remove(lock)
+    count('lock.broken')
+    return True
+
+
+def try_lock(path, timeout=LOCK_TIMEOUT):
+    """
+    Take the render lock of `path`, False if another process holds it.
+    """
+    lock = lock_path(path)
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not break_stale_lock(lock, timeout):
+                return False
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+        return True
+
+
+def wait_unlocked(paths, timeout=LOCK_TIMEOUT):
+    """
+    Wait until no process holds the render lock of any of `paths`.
+    """
+    pending = list(paths)
+    while pending:
+        pending = [path for path in pending
+                   if not break_stale_lock(lock_path(path), timeout)]
+        if pending:
+            time.sleep(POLL_INTERVAL)
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT):
+    """
+    Hold the lock of `path` for a short read-modify-write, e.g. the merge of
+    the manifest, waiting while another process holds it.
+    """
+    while not try_lock(path, timeout):
+        time.sleep(POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        remove(lock_path(path))
+
+
+class RenderLocks(object):
+    """
+    Render locks held by this process, released on exit. A thread refreshes
+    them, so that a long render isn't taken for a dead one.
+    """
+
+    def __init__(self, timeout=LOCK_TIMEOUT):
+        self.timeout = timeout
+        self.paths = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def acquire(self, path):
+        if not try_lock(path, self.timeout):
+            return False
+        with self.lock:
+            self.paths.add(path)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.refresh,
+                                               daemon=True)
+                self.thread.start()
+        return True
+
+    def release(self, path):
+        with self.lock:
+            self.paths.discard(path)
+        remove(lock_path(path))
+
+    def refresh(self):
+        while not self.stopped.wait(self.timeout / 4):
+            with self.lock:
+                paths = list(self.paths)
+            for path in paths:
+                try:
+                    os.utime(lock_path(path))
+                except OSError:
+                    pass
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for path in list(self.paths):
+            self.release(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
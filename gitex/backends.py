@@ -0,0 +1,187 @@
+"""
+Render backends of tex2png(), chosen with its `backend` option.
+`tex` is the reference: latex then dvipng or dvisvgm, see tex2png_image().
+Other backends render in-process and only accept the formulas that they
+draw like TeX does. With `auto`, every formula goes to the first backend
+that accepts it, and to TeX otherwise, see resolve_backend().
+`mathtext` renders tiny inline formulas like `$x$`, `$n^2$` or `$\\alpha$`
+with matplotlib, when it is installed, in a few milliseconds instead of a
+latex and a dvipng run. Its images are close to TeX's but not identical:
+the glyph placement, and so the size and the depth of an image, may differ
+by a few pixels, which is why it is opt-in. benchmarks/bench_backends.py
+--real-tex --check measures the difference.
+New backends subclass Backend and are added with register_backend().
+"""
+import re
+import threading
+from gitex.tex2png import attrdict, tex2png_image
+from gitex.recolor import paint_mask
+from gitex.canon import canonical_packages
+from gitex.stats import stage
+
+# commands that mathtext draws like TeX, beyond letters and digits
+MATHTEXT_COMMANDS = set('''
+    alpha beta gamma delta epsilon varepsilon zeta eta theta vartheta iota
+    kappa lambda mu nu xi pi varpi rho varrho sigma varsigma tau upsilon phi
+    varphi chi psi omega Gamma Delta Theta Lambda Xi Pi Sigma Upsilon Phi
+    Psi Omega
+    cdot times pm mp div leq geq le ge neq ne approx equiv sim propto infty
+    partial nabla ldots cdots prime in notin subset subseteq cup cap to
+    rightarrow leftarrow mapsto forall exists ell hbar emptyset
+    '''.split())
+# the longest formula sent to mathtext, layout differences add up
+MATHTEXT_MAX_LENGTH = 40
+# a command, or a character that means the same to mathtext and TeX
+mathtext_token_re = re.compile(r"\\([A-Za-z]+)|"
+                               r"[A-Za-z0-9 +\-=*/()\[\]<>|.,;:'!^_{}]")
+# points, see tex2png.gen_preamble()
+FONT_SIZE = 12
+
+
+class Backend(object):
+    """
+    name: value of the `backend` option of tex2png()
+    """
+    name = None
+
+    def available(self):
+        # whether the backend can run here, e.g. its dependencies are installed
+        return True
+
+    def accepts(self, formula, math_mode, packages, format):
+        # whether the backend renders this formula like TeX would
+        return True
+
+    def render(self, formula, math_mode, dpi, packages, foreground,
+               background, format, **options):
+        """
+        Returns attrdict(data, width, height, depth), see tex2png_image().
+        options: other tex2png() options, that the backend may ignore
+        """
+        raise NotImplementedError
+
+
+class TexBackend(Backend):
+    name = 'tex'
+
+    def render(self, formula, math_mode, dpi, packages, foreground,
+               background, format, **options):
+        return tex2png_image(formula, math_mode, dpi, packages, foreground,
+                             background, format=format, backend='tex',
+                             **options)
+
+
+class MathtextBackend(Backend):
+    """
+    matplotlib mathtext with the Computer Modern fonts, PNG only. The
+    coverage mask that mathtext draws is painted like dvipng paints, see
+    recolor.paint_mask().
+    """
+    name = 'mathtext'
+
+    def __init__(self):
+        self.parser = None
+        self.vector_parser = None
+        self.font = None
+        self.missing = False
+        # the mathtext parser isn't thread safe
+        self.lock = threading.Lock()
+
+    def available(self):
+        if self.parser is None and not self.missing:
+            try:
+                from matplotlib.mathtext import MathTextParser
+                from matplotlib.font_manager import FontProperties
+            except ImportError:
+                self.missing = True
+                return False
+            self.parser = MathTextParser('agg')
+            # exact metrics, the raster ones are padded
+            self.vector_parser = MathTextParser('path')
+            self.font = FontProperties(size=FONT_SIZE, math_fontfamily='cm')
+        return not self.missing
+
+    def accepts(self, formula, math_mode, packages, format):
+        if (math_mode not in ['inline', 'display'] or format != 'png'
+                or canonical_packages(packages)
+                or len(formula) > MATHTEXT_MAX_LENGTH
+                or not formula.strip()):
+            return False
+        pos = 0
+        for match in mathtext_token_re.finditer(formula):
+            if (match.start() != pos or match.group(1)
+                    and match.group(1) not in MATHTEXT_COMMANDS):
+                return False
+            pos = match.end()
+        if pos != len(formula) or not self.available():
+            return False
+        try:
+            self.parse(formula, 72)
+        except ValueError:
+            return False
+        return True
+
+    def parse(self, formula, dpi, parser=None):
+        with self.lock:
+            return (parser or self.parser).parse('$' + formula + '$', 
+                                                 dpi=dpi, prop=self.font)
+
+    def render(self, formula, math_mode, dpi, packages, foreground,
+               background, format, **options):
+        import numpy as np
+        with stage('mathtext'):
+            mask = np.asarray(self.parse(formula, int(dpi)).image, 
+                              dtype=np.uint8)
+            metrics = self.parse(formula, int(dpi), self.vector_parser)
+            # row of the baseline: the box height below a 1 pixel margin,
+            # see matplotlib's _mathtext.ship()
+            baseline = int(metrics.height - metrics.depth) + 1
+            depth = 0
+            rows = np.flatnonzero(mask.max(axis=1))
+            columns = np.flatnonzero(mask.max(axis=0))
+            if len(rows):
+                depth = max(0, rows[-1] + 1 - baseline)
+                # crop to the ink like `dvipng -T tight`
+                mask = mask[rows[0]:rows[-1] + 1,
+                            columns[0]:columns[-1] + 1]
+            height, width = mask.shape
+            data, = paint_mask(width, height,
+                               np.ascontiguousarray(mask).tobytes(),
+                               [(foreground, background)])
+        return attrdict(data=data, width=width, height=height, 
+                        depth=int(depth))
+
+
+# name -> Backend, in routing order
+BACKENDS = {}
+
+
+def register_backend(backend):
+    BACKENDS[backend.name] = backend
+
+
+register_backend(TexBackend())
+register_backend(MathtextBackend())
+
+
+def resolve_backend(backend, formula, math_mode, packages='', format='png'):
+    """
+    Name of the backend that renders the formula: `backend` if it accepts
+    the formula, `tex` otherwise. `auto` picks the first backend that
+    accepts it.
+    """
+    if backend == 'tex':
+        return backend
+    if backend == 'auto':
+        candidates = list(BACKENDS.values())
+    else:
+        assert backend in BACKENDS, 'backend must be one of {}'.format(
+            list(BACKENDS) + ['auto'])
+        candidates = [BACKENDS[backend]]
+    for candidate in candidates:
+        if candidate.name == 'tex':
+            continue
+        if (candidate.available()
+                and candidate.accepts(formula, math_mode, packages, format)):
+            return candidate.name
+    return 'tex'
@@ -0,0 +1,190 @@
+"""
+Build graph of the markdown outputs, `.gitex_build.json` in the image folder.
+For every output it records the source and `\\include`d files with their
+content hashes, the build options, and the regions of the source (runs of
+lines up to a blank line) with the markdown they produced and the images
+they link. A build whose files, options and images are unchanged is skipped
+after one stat() per file; otherwise only the changed regions are scanned
+again, see compile.scan().
+"""
+import os
+import json
+import hashlib
+from gitex.stats import stage
+from gitex.atomic import temp_path, file_lock
+
+GRAPH_FILE = '.gitex_build.json'
+GRAPH_VERSION = 2
+
+
+def split_regions(segments):
+    """
+    Group tokenizer segments into regions, each ending with a blank line.
+    Regions are independent: the output of a region only depends on its
+    own text, the `\\include`d files and the build options.
+    """
+    region = []
+    line_start = True
+    for segment in segments:
+        region.append(segment)
+        blank = (line_start and segment.kind == 'text'
+                 and not segment.text.strip())
+        line_start = segment.text.endswith('\n')
+        if blank and line_start:
+            yield region
+            region = []
+    if region:
+        yield region
+
+
+class BuildGraph(object):
+    """
+    files: {path: {size, mtime, hash}} of every file read or written
+    outputs: {output path: {src_md, options, deps, output, regions}}
+      deps: {path: content hash} of the source and the included files
+      output: content hash of the output file
+      regions: {region key: {output, images, formulas}}
+        images: every image linked, variants included
+        formulas: the distinct images of the formulas, without variants
+    Paths are absolute.
+    Concurrent builds of the image folder share the graph, see save().
+    """
+    def __init__(self, image_folder):
+        self.path = os.path.join(image_folder, GRAPH_FILE)
+        self.files = {}
+        self.outputs = {}
+        self.dirty = False
+        graph = self.read()
+        if graph is not None:
+            self.files = graph['files']
+            self.outputs = graph['outputs']
+        elif os.path.exists(self.path):
+            print('Corrupted build graph {}, rebuild.'.format(self.path))
+            self.dirty = True
+        # state as read, save() merges what changed since
+        self.loaded = json.loads(json.dumps([self.files, self.outputs]))
+
+    def read(self):
+        # the graph on disk, None if missing, corrupted or outdated
+        try:
+            with open(self.path) as f:
+                graph = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if graph.get('version') != GRAPH_VERSION:
+            return None
+        return graph
+
+    def file_hash(self, path):
+        """
+        md5 of the content of `path`, None if it doesn't exist.
+        The file is only read if its size or mtime changed.
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if self.files.pop(path, None):
+                self.dirty = True
+            return None
+        record = self.files.get(path)
+        if (record and record['size'] == stat.st_size
+                and record['mtime'] == stat.st_mtime):
+            return record['hash']
+        with open(path, 'rb') as f:
+            content_hash = hashlib.md5(f.read()).hexdigest()
+        self.files[path] = dict(size=stat.st_size, mtime=stat.st_mtime,
+                                hash=content_hash)
+        self.dirty = True
+        return content_hash
+
+    def region_key(self, segments):
+        # hash of the region text and of the files it includes
+        key = hashlib.md5(''.join(segment.text for segment in segments)
+                          .encode('utf-8'))
+        for segment in segments:
+            if segment.kind == 'include':
+                key.update(str(self.file_hash(segment.value)).encode())
+        return key.hexdigest()
+
+    def up_to_date(self, src_md, output_md, options, manifest):
+        """
+        Whether the last build of `output_md` is still valid: same source,
+        options and file contents, and all its images are in `manifest`.
+        """
+        entry = self.outputs.get(os.path.abspath(output_md))
+        if (not entry or entry['src_md'] != os.path.abspath(src_md)
+                or entry['options'] != options):
+            return False
+        with stage('up_to_date', output_md=output_md):
+            if self.file_hash(output_md) != entry['output']:
+                return False
+            for path, content_hash in entry['deps'].items():
+                if self.file_hash(path) != content_hash:
+                    return False
+            return all(manifest.lookup(png_file)
+                       for region in entry['regions'].values()
+                       for png_file in region['images'])
+
+    def regions(self, output_md, options, manifest):
+        """
+        Regions of the last build of `output_md` whose images are all in
+        `manifest`, empty if the options changed.
+        """
+        entry = self.outputs.get(os.path.abspath(output_md))
+        if not entry or entry['options'] != options:
+            return {}
+        return {key: region for key, region in entry['regions'].items()
+                if all(manifest.lookup(png_file)
+                       for png_file in region['images'])}
+
+    def deps(self, output_md):
+        # the source and the included files of the last build of output_md
+        entry = self.outputs.get(os.path.abspath(output_md))
+        return list(entry['deps']) if entry else []
+
+    def record(self, src_md, output_md, options, deps, regions):
+        """
+        Record the build of `output_md` once it is written.
+        deps: the source and the included files
+        regions: {region key: {output, images, formulas}}
+        """
+        self.outputs[os.path.abspath(output_md)] = dict(
+            src_md=os.path.abspath(src_md),
+            options=options,
+            deps={os.path.abspath(path): self.file_hash(path)
+                  for path in deps},
+            output=self.file_hash(output_md),
+            regions=regions)
+        self.dirty = True
+
+    def save(self):
+        """
+        Merge the files and outputs that this process recorded or forgot
+        into the graph on disk, under its lock, so that concurrent builds
+        of the image folder keep each other's outputs.
+        """
+        if not self.dirty:
+            return
+        with file_lock(self.path):
+            graph = self.read() or {'files': {}, 'outputs': {}}
+            merged = []
+            for mine, loaded, theirs in zip([self.files, self.outputs],
+                                            self.loaded,
+                                            [graph['files'],
+                                             graph['outputs']]):
+                for key in set(loaded) - set(mine):
+                    theirs.pop(key, None)
+                for key, value in mine.items():
+                    if value != loaded.get(key):
+                        theirs[key] = value
+                merged.append(theirs)
+            temp_file = temp_path(self.path)
+            with open(temp_file, 'w') as f:
+                json.dump({'version': GRAPH_VERSION, 'files': merged[0],
+                           'outputs': merged[1]}, f, indent=1, 
+                          sort_keys=True)
+            os.replace(temp_file, self.path)
+        self.files, self.outputs = merged
+        self.loaded = json.loads(json.dumps(merged))
+        self.dirty = False
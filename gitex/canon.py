@@ -0,0 +1,134 @@
+"""
+Canonical cache keys of the generated images.
+Formulas and options that render the same image get the same key, whatever
+their spelling: `dpi=200` from the command line (an int) or from an inline
+`[dpi=200]` (a string), options equal to the tex2png() defaults, `+` or `,`
+separated package lists, color names or values, and whitespace that TeX
+ignores.
+"""
+import re
+import json
+from gitex.tex2png import rgb_arg, md5
+
+# bump when image_key() changes, see Manifest.migrate()
+HASH_VERSION = 2
+# tex2png() defaults, options equal to them are left out of the key
+DEFAULTS = {'dpi': 300,
+            'packages': '',
+            'foreground': 'rgb 0.0 0.0 0.0',
+            'background': 'rgb 1.0 1.0 1.0',
+            'optimize': False,
+            'format': 'png',
+            'backend': 'tex'}
+# always loaded, see tex2png.gen_preamble()
+BASE_PACKAGES = ['amsmath', 'amssymb']
+
+# whitespace is significant in verbatim text
+verbatim_re = re.compile(r'\\(verb|url)\b|\\begin\{(verbatim|Verbatim|'
+                         r'lstlisting|minted|alltt)\}')
+# a control symbol like `\ ` or `\\`, or a run of blanks
+blank_re = re.compile(r'\\[\s\S]|[ \t\r\f\v]+')
+
+
+def canonical_formula(formula):
+    """
+    TeX reads a run of blanks as one space, drops the blanks at both ends of
+    a line, and reads several blank lines as one paragraph break.
+    Line ends are kept, they end `%` comments.
+    """
+    if verbatim_re.search(formula):
+        return formula
+    lines = [blank_re.sub(lambda match: match.group()
+                          if match.group().startswith('\\') else ' ',
+                          line).strip(' ')
+             for line in formula.split('\n')]
+    formula = re.sub(r'\n{3,}', '\n\n', '\n'.join(lines))
+    return formula.strip('\n')
+
+
+def canonical_packages(packages):
+    # `,` or `+` separated, in loading order, without the base packages
+    names = []
+    for name in str(packages).replace('+', ',').split(','):
+        name = name.strip()
+        if name and name not in BASE_PACKAGES and name not in names:
+            names.append(name)
+    return ','.join(names)
+
+
+def canonical_color(color):
+    # the dvipng color argument, see tex2png.rgb_arg()
+    try:
+        model, *values = rgb_arg(str(color).strip()).split()
+        values = [float(value) for value in values]
+    except (AssertionError, ValueError):
+        return ' '.join(str(color).split())
+    return ' '.join([model] + ['{:.4f}'.format(value) for value in values])
+
+
+def canonical_optimize(optimize):
+    if not optimize or str(optimize).strip().lower() in ['false', '0',
+                                                         'none']:
+        return False
+    return 'optipng' if optimize == 'optipng' else 'python'
+
+
+def canonical_option(key, value):
+    if key == 'dpi':
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    elif key == 'packages':
+        return canonical_packages(value)
+    elif key in ['foreground', 'background']:
+        return canonical_color(value)
+    elif key == 'optimize':
+        return canonical_optimize(value)
+    elif isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def canonical_options(options):
+    """
+    tex2png() options that change the image, in canonical form.
+    """
+    canonical = {}
+    for key, value in options.items():
+        value = canonical_option(key, value)
+        if key in DEFAULTS and value == canonical_option(key, DEFAULTS[key]):
+            continue
+        canonical[key] = value
+    if canonical.get('format') == 'svg':
+        # one svg image serves every DPI
+        canonical.pop('dpi', None)
+    return canonical
+
+
+def image_key(formula, math_mode, options):
+    """
+    md5 of the canonical formula, math mode and tex2png() options.
+    """
+    return md5(json.dumps([canonical_formula(formula), math_mode,
+                           canonical_options(options)], sort_keys=True))
+
+
+def image_name(formula, math_mode, options):
+    # file name of the image in the image folder
+    return 'tex_{}.{}'.format(image_key(formula, math_mode, options),
+                              canonical_options(options).get('format', 'png'))
+
+
+def legacy_image_name(formula, math_mode, options):
+    """
+    File name given by gitex before HASH_VERSION 2, for migrations.
+    Inline and `none` formulas shared their key, the options were hashed as
+    they were spelled.
+    """
+    image_format = options.get('format', 'png')
+    hash_options = dict(options)
+    hash_options.pop('dpi' if image_format == 'svg' else 'format', None)
+    key = md5(formula + ('$' if math_mode == 'display' else ' ')
+              + str(sorted(hash_options.items())))
+    return 'tex_{}.{}'.format(key, image_format)
@@ -3,52 +3,33 @@
 @author: jimfan
 """
 import os
-import re
-import hashlib
+import sys
+import json
+import time
 import argparse
 import subprocess as pc
-from gitex.tex2png import tex2png
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from gitex.tex2png import (tex2png, tex2png_image, tex2png_batch, attrdict, 
+                           RenderSession, FORMATS, OPTIMIZERS, optimize_image)
 from gitex.imgsize import get_image_size
-
-# http://stackoverflow.com/questions/36391979/find-markdown-image-syntax-in-string-in-java
-# match Markdown image syntax ![alt](image_link)
-# group 1: `alt`; group 2 `image_link`
-image_re = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
-
-# http://stackoverflow.com/questions/17767251/how-to-ignore-escaped-character-in-regex
-# negative lookahead: In general, (?<!Y)X matches an X that is not preceded by Y.
-# inline math: $ .... $ but \$ escapes dollar sign
-inline_re = re.compile(r'(?<!\\)\$([^\$]+)(?<!\\)\$')
-# extended: match $ ... $[optional_args]
-inline_re = re.compile(r'(?<!\\)\$([^\$]+)(?<!\\)\$(\[[^\]]*\])?')
-# non-standard regex support for named group
-inline_re = re.compile(r'(?<!\\)\$(?P<formula>[^\$]+)(?<!\\)\$(\[(?P<options>[^\]]*)\])?')
-
-# diplay mode math: $$ .... $$ but \$ escapes dollar sign
-display_re = re.compile(r'(?<!\\)\$\$([^\$]+)(?<!\\)\$\$')
-# extended; match $$ ... $$[optional_args]
-display_re = re.compile(r'(?<!\\)\$\$(?P<formula>[^\$]+)(?<!\\)\$\$(\[(?P<options>[^\]]*)\])?')
-
-# match \include[...] on its own line
-include_re = re.compile(r'[\s]*\\include\[(?P<options>[^\]]*)\][\s]*')
-
-# match \begin[...] on its own line
-begin_re = re.compile(r'^[\s]*\\begin\[([^\])]*)\][\s]*$')
-# make [...] optional
-begin_re = re.compile(r'^[\s]*\\begin(\[(?P<options>[^\]]*)\])?[\s]*$')
-
-# match \end on its own line
-end_re = re.compile(r'^[\s]*\\end[\s]*$')
-
-# `\\` escape to match literals
-escape_re = [
-    # ('$$', r'\\\$\$'),
-    ('$', r'\\\$'),
-    (r'\\end', r'\\\\end'),
-    (r'\\begin', r'\\\\begin'),
-    (r'\\include', r'\\\\include')
-]
-escape_re = [(literal, re.compile(regex)) for literal, regex in escape_re]
+from gitex.manifest import Manifest
+from gitex.canon import image_name, HASH_VERSION
+from gitex.recolor import recolor_file, parse_variant
+from gitex.backends import BACKENDS, resolve_backend
+from gitex.buildgraph import BuildGraph, split_regions
+from gitex.stats import stage, count, record_formula, instrument
+from gitex.spool import render_spool, CLAIM_TIMEOUT
+from gitex.atomic import write_file, RenderLocks, wait_unlocked
+from gitex.tokenizer import (image_re, inline_re, display_re, escapes_re, 
+                             ESCAPES, tokenize, tokenize_line)
+
+# tex2png options that only affect how an image is rendered, not the image
+RENDER_OPTIONS = ['precompile', 'worker', 'dvi_cache']
+# svg sizes are in points
+SVG_DPI = 72
+# variants linked from a <picture> element, by name
+VARIANT_MEDIA = {'light': '(prefers-color-scheme: light)',
+                 'dark': '(prefers-color-scheme: dark)'}
 
 
 def bash(cmd):
@@ -72,36 +53,52 @@ def replace_n(s, spans, replacements):
     assert len(spans) == len(replacements)
     if not spans:
         return s
-    new_s = s[:spans[0][0]]
+    new_s = [s[:spans[0][0]]]
     for i in range(len(spans) - 1):
         assert spans[i][1] <= spans[i+1][0]
-        new_s += replacements[i] + s[spans[i][1]: spans[i+1][0]]
-    return new_s + replacements[-1] + s[spans[-1][1]:]
+        new_s += [replacements[i], s[spans[i][1]: spans[i+1][0]]]
+    new_s += [replacements[-1], s[spans[-1][1]:]]
+    return ''.join(new_s)
     
     
-def gen_img_code(github_url, alt, width=None, height=None):
+def gen_img_code(github_url, alt, width=None, height=None, valign=None):
     """
     Generate image markdown code with absolute URL link <deprecated>
     <img src="https://raw.githubusercontent.com/LinxiFan/temp/master/d500.png" 
     height="20" />
     github_path: <username>/<repo>/<branch>/<folders>/<filename>
+    valign: vertical-align of the image in pixels, e.g. -5 to move the 
+      baseline of a formula down to the text baseline
     """
     # remove all new lines in `alt` text
     alt = alt.replace('\n', ' ')
     if height or width:
         width = 'width="{}"'.format(width) if width else ''
         height = 'height="{}"'.format(height) if height else ''
-        return ('<img src="{}" alt="{}" {} {} />'
-               .format(github_url, alt, width, height))
+        code = ('<img src="{}" alt="{}" {} {}'
+                .format(github_url, alt, width, height))
+        if valign is not None:
+            code += ' style="vertical-align: {}px"'.format(valign)
+        return code + ' />'
     else:
         return '![{}]({})'.format(alt, github_url)
 
 
-def md5(s):
-    # hash latex code into unique file name
-    h = hashlib.new('MD5')
-    h.update(s.encode('utf-8'))
-    return h.hexdigest()
+def gen_picture_code(img_code, sources):
+    """
+    Wrap the <img> code of a formula into a <picture> element that picks
+    the image of the reader's color scheme.
+    sources: list of (media query, image url)
+    """
+    if not sources:
+        return img_code
+    if img_code.startswith('!['):
+        # markdown images are not allowed inside html
+        alt, url = img_code[2:-1].split('](')
+        img_code = '<img src="{}" alt="{}" />'.format(url, alt)
+    return '<picture>{}{}</picture>'.format(
+        ''.join('<source media="{}" srcset="{}">'.format(media, url)
+                for media, url in sources), img_code)
 
 
 def process_image(line):
@@ -115,23 +112,40 @@ def process_image(line):
     replacements = []
     for match in image_re.finditer(line):
         alt, image_url = match.groups()
-        image_url = image_url.strip().rsplit('=')
-        width, height = None, None
-        if len(image_url) == 2:
-            size_spec = image_url[1]
-            width, height = size_spec.split('x')
-        image_url = image_url[0].strip()
-        if image_url.startswith('www.'):
-            image_url = 'http://' + image_url
         spans.append(match.span())
-        replacements.append(gen_img_code(image_url, alt, width, height))
+        replacements.append(gen_image_code(alt, image_url))
     return replace_n(line, spans, replacements)
 
 
+def gen_image_code(alt, image_url):
+    # image_url may end with the size spec, see process_image()
+    image_url = image_url.strip().rsplit('=')
+    width, height = None, None
+    if len(image_url) == 2:
+        size_spec = image_url[1]
+        width, height = size_spec.split('x')
+    image_url = image_url[0].strip()
+    if image_url.startswith('www.'):
+        image_url = 'http://' + image_url
+    return gen_img_code(image_url, alt, width, height)
+
+
 def get_height(png_file, dpi, math_mode):
+    with stage('get_image_size'):
+        _, height = get_image_size(png_file)
+    return scale_height(height, dpi, math_mode)
+
+
+def image_dpi(job):
+    # resolution of the image size, see tex2png_image()
+    if job.options.get('format') == 'svg':
+        return SVG_DPI
+    return job.options['dpi']
+
+
+def scale_height(height, dpi, math_mode):
     dpi = int(dpi)
     # inline image needs to be resized for better github rendering
-    _, height = get_image_size(png_file)
     if math_mode == 'display':
         scale = 1.2
     elif math_mode == 'inline':
@@ -142,32 +156,397 @@ def get_height(png_file, dpi, math_mode):
     return int(height / shrink * scale)
 
 
-def run_latex(formula, math_mode, **options):
+def gen_job(formula, math_mode, **options):
+    """
+    Resolve the image file of a formula without rendering it, `png_file` is
+    a `.svg` file for the svg format.
+    Returns (job, width, height). `width` and `height` are only used for the
+    generated <img> tag, so they don't belong to the job itself.
+    job.variants: jobs of the color variants of the image, named after the
+      colors they have, see render_variants()
+    """
     image_folder = options.pop('image_folder')
     redraw = options.pop('redraw')
+    variants = options.pop('variants', None) or []
     width, height = None, None
     if 'width' in options:
         width = options.pop('width')
     if 'height' in options:
         height = options.pop('height')
     
-    # differentiate display/inline math mode hash, and different config's hash
-    md5hash = md5(formula + ('$' if math_mode=='display' else ' ') 
-                  + str(sorted(options.items())))
-    png_file = os.path.join(image_folder, 'tex_' + md5hash + '.png')
+    # tex2png options that don't change the image are not hashed
+    render_options = {key: options.pop(key) for key in RENDER_OPTIONS 
+                      if key in options}
+    if options.get('backend', 'tex') != 'tex':
+        # formulas that fall back to TeX share the images of TeX builds
+        options['backend'] = resolve_backend(options['backend'], formula,
+                                             math_mode, 
+                                             options.get('packages', ''),
+                                             options.get('format', 'png'))
+    
+    # formulas and options that render the same image share it
+    png_file = os.path.join(image_folder, 
+                            image_name(formula, math_mode, options))
+    variant_jobs = []
+    for name, foreground, background in variants:
+        variant_options = merge_dict(options, {'foreground': foreground,
+                                               'background': background})
+        variant_file = os.path.join(image_folder, 
+                                    image_name(formula, math_mode, 
+                                               variant_options))
+        variant_jobs.append(attrdict(
+            name=name, formula=formula, math_mode=math_mode, 
+            png_file=variant_file, redraw=redraw,
+            options=merge_dict(variant_options, {'formula': formula,
+                                                 'output_file': variant_file,
+                                                 'math_mode': math_mode})))
     options = merge_dict({'formula': formula,
                           'output_file': png_file,
                           'math_mode': math_mode}, options)
-    if redraw or not os.path.exists(png_file):
-        tex2png(**options)
-    assert os.path.exists(png_file), \
-        'formula `{}` latex generation failure: {}'.format(formula, png_file)
-    
-    img_code = gen_img_code(png_file, formula, 
-                            width=width,
-                            height=height if height 
-                                else get_height(png_file, options['dpi'], math_mode))
-    return png_file, img_code
+    options.update(render_options)
+    job = attrdict(formula=formula,
+                   math_mode=math_mode,
+                   png_file=png_file,
+                   redraw=redraw,
+                   options=options,
+                   variants=variant_jobs,
+                   locations=[])
+    return job, width, height
+
+
+def load_manifest(image_folder):
+    """
+    Manifest of the image folder. Images cached under an older hash are
+    renamed first, see Manifest.migrate().
+    """
+    manifest = Manifest(image_folder)
+    if manifest.hash_version < HASH_VERSION:
+        renamed = manifest.migrate()
+        manifest.save()
+        if renamed:
+            print('Renamed {} cached images to their canonical hash.'
+                  .format(renamed))
+    return manifest
+
+
+def render_job(job):
+    # returns the image if rendered, see tex2png_image()
+    image = None
+    if job.redraw or not os.path.exists(job.png_file):
+        image = tex2png(**job.options)
+    render_variants([job], [job] if image else [])
+    return image
+
+
+def render_image(job, session=None):
+    """
+    Render a job in memory, then persist the image to job.png_file.
+    Returns the image, see tex2png_image()
+    """
+    options = job.options.copy()
+    options.pop('output_file')
+    image = tex2png_image(session=session, **options)
+    save_image(job.png_file, image.data)
+    return image
+
+
+def save_image(png_file, data):
+    # readers of a shared image folder never see half an image
+    write_file(png_file, data)
+
+
+def split_batch(batch_jobs, n):
+    # split a batch into at most n chunks of similar size
+    size = -(-len(batch_jobs) // n)
+    return [batch_jobs[i:i + size] for i in range(0, len(batch_jobs), size)]
+
+
+def is_cached(job, manifest=None):
+    if manifest is not None and manifest.tracks(job.png_file):
+        # also detects truncated images
+        return manifest.lookup(job.png_file) is not None
+    return os.path.exists(job.png_file)
+
+
+def render_jobs(jobs, batch=False, n_jobs=1, manifest=None, session=None,
+                spool=None, claim_timeout=CLAIM_TIMEOUT):
+    """
+    Render all jobs whose image is missing, on `n_jobs` threads 
+    (the heavy lifting happens in the latex/dvipng subprocesses).
+    batch: render all formulas that share the same tex2png options with a
+      single multi-page LaTeX run, see tex2png_batch(). Each batch is split
+      into `n_jobs` chunks so that all threads get work.
+    manifest: Manifest of the image folder, rendered images are recorded 
+      together with their render time.
+    session: RenderSession shared by all jobs, see tex2png()
+    spool: spool directory, the jobs are queued there and rendered by
+      `gitex worker` processes, see gitex.spool. `claim_timeout` seconds
+      later, the job of a silent worker is queued again.
+    Images are locked while they render, see gitex.atomic: the images that
+    another process, e.g. a concurrent build of the same image folder, is
+    rendering are waited for instead of rendered again.
+    Failed formulas are reported with their source locations, then the first
+    error is raised.
+    Returns the jobs that were rendered.
+    """
+    all_jobs = list(jobs)
+    if manifest is not None:
+        manifest.prefetch([job.png_file for job in all_jobs 
+                           if not job.redraw])
+    jobs = [job for job in all_jobs 
+            if job.redraw or not is_cached(job, manifest)]
+    count('cache.hit', len(all_jobs) - len(jobs))
+    count('cache.miss', len(jobs))
+    if not jobs:
+        return []
+    options = dict(batch=batch, n_jobs=n_jobs, manifest=manifest, 
+                   session=session, spool=spool, claim_timeout=claim_timeout)
+    with RenderLocks() as locks:
+        locked = [job for job in jobs if locks.acquire(job.png_file)]
+        locked_files = set(job.png_file for job in locked)
+        waiting = [job for job in jobs if job.png_file not in locked_files]
+        # rendered by another process since the cache lookup
+        done = [job for job in locked 
+                if not job.redraw and is_cached(job, manifest)]
+        done_files = set(job.png_file for job in done)
+        rendered = render_missing([job for job in locked 
+                                   if job.png_file not in done_files], 
+                                  **options)
+    if waiting:
+        count('lock.waited', len(waiting))
+        with stage('lock wait', images=len(waiting)):
+            wait_unlocked([job.png_file for job in waiting])
+        done += [job for job in waiting 
+                 if not job.redraw and is_cached(job, manifest)]
+        done_files = set(job.png_file for job in done)
+        # the other process failed or was killed, render them here
+        rendered += render_jobs([job for job in waiting 
+                                 if job.png_file not in done_files], 
+                                **options)
+    if manifest is not None:
+        for job in done:
+            manifest.record(job)
+    return rendered
+
+
+def render_missing(jobs, batch=False, n_jobs=1, manifest=None, session=None,
+                   spool=None, claim_timeout=CLAIM_TIMEOUT):
+    """
+    Render `jobs`, whose images are locked by this process, see 
+    render_jobs().
+    """
+    if not jobs:
+        return []
+    # task: (function, args, kwargs, jobs)
+    tasks = []
+    if spool is not None:
+        tasks = [(None, (), {}, [job]) for job in jobs]
+    elif batch:
+        batches = {}
+        for job in jobs:
+            options = job.options.copy()
+            for key in ['formula', 'output_file', 'math_mode']:
+                options.pop(key)
+            key = tuple(sorted(options.items()))
+            batches.setdefault(key, []).append(job)
+        for key, batch_jobs in batches.items():
+            for chunk in split_batch(batch_jobs, n_jobs):
+                batch_args = [(job.formula, job.png_file, job.math_mode) 
+                              for job in chunk]
+                tasks.append((tex2png_batch, (batch_args,), dict(key), chunk))
+    else:
+        for job in jobs:
+            tasks.append((render_image, (job,), {}, [job]))
+
+    def run_task(task):
+        # returns (exception, elapsed, result)
+        func, args, kwargs, task_jobs = task
+        start = time.time()
+        try:
+            with stage(func.__name__, 
+                       formulas=[job.formula for job in task_jobs]):
+                result = func(*args, session=session, **kwargs)
+        except Exception as exc:
+            return exc, time.time() - start, None
+        return None, time.time() - start, result
+
+    if spool is not None:
+        results = render_spool(jobs, spool, claim_timeout)
+    elif n_jobs > 1 and len(tasks) > 1:
+        with ThreadPoolExecutor(n_jobs) as pool:
+            results = list(pool.map(run_task, tasks))
+    else:
+        results = [run_task(task) for task in tasks]
+    errors = [exc for exc, _, _ in results if exc is not None]
+
+    for task, (exc, elapsed, result) in zip(tasks, results):
+        task_jobs = task[3]
+        # images come with their metrics, a batch returns one per job
+        images = result if isinstance(result, list) else [result]
+        for job, image in zip(task_jobs, images):
+            record_formula(job, elapsed / len(task_jobs))
+            if manifest is not None and exc is None:
+                manifest.record(job, render_time=elapsed / len(task_jobs),
+                                image=image)
+
+    failed = [job for job in jobs if not os.path.exists(job.png_file)]
+    for job in failed:
+        for src_md, lineno in job.locations:
+            print('{}:{}: failed to render {} formula `{}`'
+                  .format(src_md, lineno, job.math_mode, job.formula))
+    if errors:
+        raise errors[0]
+    if failed:
+        raise Exception('{} formulas failed to render'.format(len(failed)))
+    return jobs
+
+
+def variant_task(job, variants):
+    # recolor_file() arguments of the missing `variants` of `job`
+    return (job.png_file, job.options.get('foreground', 'rgb 0.0 0.0 0.0'),
+            job.options.get('background', 'rgb 1.0 1.0 1.0'),
+            [(variant.png_file, variant.options['foreground'],
+              variant.options['background']) for variant in variants])
+
+
+def run_variant_task(task):
+    recolor_file(*task)
+
+
+def render_variants(jobs, rendered=(), n_jobs=1, manifest=None):
+    """
+    Write the missing color variants of `jobs` by recoloring their image
+    in-process, see gitex.recolor. Variants of the `rendered` jobs are
+    written again. The recoloring is pure Python, so it runs on `n_jobs`
+    processes.
+    Returns the variant jobs written.
+    """
+    rendered = set(id(job) for job in rendered)
+    tasks, written = [], []
+    for job in jobs:
+        variants = [variant for variant in job.variants
+                    if variant.png_file != job.png_file
+                    and (id(job) in rendered or variant.redraw
+                         or not is_cached(variant, manifest))]
+        if variants:
+            tasks.append(variant_task(job, variants))
+            written += [(job, variant) for variant in variants]
+    if not tasks:
+        return []
+    with stage('variants', images=len(written)):
+        if n_jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(n_jobs) as pool:
+                list(pool.map(run_variant_task, tasks))
+        else:
+            for task in tasks:
+                run_variant_task(task)
+    if manifest is not None:
+        for job, variant in written:
+            # same size and depth as the image it was recolored from
+            image = manifest.lookup(job.png_file)
+            manifest.record(variant, render_time=0, image=image and attrdict(
+                data=None, width=image['width'], height=image['height'],
+                depth=image.get('depth')))
+    return [variant for _, variant in written]
+
+
+def optimize_jobs(jobs, optimize, n_jobs=1, manifest=None):
+    """
+    Optimization stage after rendering, see tex2png.optimize_image().
+    The PNG images of `jobs` are optimized on `n_jobs` processes, since the
+    in-process pass is pure Python. Prints the size savings and time spent.
+    """
+    png_files = [job.png_file for job in jobs 
+                 if job.png_file.endswith('.png') 
+                 # already optimized by tex2png()
+                 and job.options.get('optimize') in [None, False, 'False']]
+    if not optimize or not png_files:
+        return
+    start = time.time()
+    with stage('optimize', images=len(png_files)):
+        if n_jobs > 1 and len(png_files) > 1:
+            with ProcessPoolExecutor(n_jobs) as pool:
+                sizes = list(pool.map(optimize_image, png_files, 
+                                      [optimize] * len(png_files)))
+        else:
+            sizes = [optimize_image(png_file, optimize) 
+                     for png_file in png_files]
+    before = sum(size for size, _ in sizes)
+    after = sum(size for _, size in sizes)
+    count('optimize.saved_bytes', before - after)
+    if manifest is not None:
+        for png_file in png_files:
+            manifest.refresh(png_file)
+    print('Optimized {} images: {} -> {} bytes, {:.1f}% saved in {:.2f}s'
+          .format(len(png_files), before, after, 
+                  100. * (before - after) / max(1, before), 
+                  time.time() - start))
+
+
+def gen_job_code(job, width=None, height=None, manifest=None, 
+                 image_root=None, image=None, baseline=False):
+    """
+    manifest: if given, the image size is looked up in the manifest instead
+      of reading the image file
+    image_root: if given, the image is linked relative to this folder
+    image: metrics of the image just rendered, see tex2png_image(), no file
+      is read then
+    baseline: align inline formulas on the text baseline, needs the depth
+      reported by dvipng
+    """
+    png_file = job.png_file
+    entry = image
+    if entry is None and manifest is not None:
+        entry = manifest.lookup(png_file)
+    if not height:
+        if entry:
+            height = scale_height(entry['height'], image_dpi(job), 
+                                  job.math_mode)
+        else:
+            assert os.path.exists(png_file), \
+                'formula `{}` latex generation failure: {}'.format(job.formula, png_file)
+            height = get_height(png_file, image_dpi(job), job.math_mode)
+    valign = None
+    if baseline and job.math_mode == 'inline' and entry and entry.get('depth'):
+        valign = -scale_height(entry['depth'], image_dpi(job), job.math_mode)
+    if image_root is not None:
+        png_file = os.path.relpath(png_file, image_root)
+    img_code = gen_img_code(png_file, job.formula, width=width, height=height,
+                            valign=valign)
+    sources = []
+    for variant in job.variants:
+        if variant.name in VARIANT_MEDIA:
+            variant_file = variant.png_file
+            if image_root is not None:
+                variant_file = os.path.relpath(variant_file, image_root)
+            sources.append((VARIANT_MEDIA[variant.name], variant_file))
+    return gen_picture_code(img_code, sources)
+
+
+def run_latex(formula, math_mode, **options):
+    job, width, height = gen_job(formula, math_mode, **options)
+    image = render_job(job)
+    return job.png_file, gen_job_code(job, width, height, image=image)
+
+
+def defer_latex(doc, formula, math_mode, escape=False, **options):
+    """
+    Register the formula in `doc` and add a reference to it to the output,
+    its <img> code is generated by emit() after all formulas are rendered.
+    escape: whether process_escapes() applies to the generated code
+    """
+    job, width, height = gen_job(formula, math_mode, **options)
+    job = doc.jobs.setdefault(job.png_file, job)
+    job.locations.append((doc.src_md, doc.lineno))
+    doc.pieces.append((job, width, height, escape))
+
+
+def gen_ref_code(doc, ref):
+    # <img> code of a formula added by defer_latex()
+    job, width, height, escape = ref
+    code = gen_job_code(job, width, height, manifest=doc.manifest,
+                        image_root=doc.image_root, baseline=doc.baseline)
+    return process_escapes(code) if escape else code
 
 
 def parse_options(options_str):
@@ -202,80 +581,206 @@ def process_latex(line, math_mode, **tex2png_options):
 
 def process_escapes(line):
     # escaped `\$` will be translated to a dollar sign literal
-    for literal, regex in escape_re:
-        line = regex.sub(literal, line)
-    return line
+    return escapes_re.sub(lambda match: ESCAPES[match.group()], line)
 
 
-def compile(src_md, output_md, **tex2png_options):
-    output_md = open(output_md, 'w')
-    src = open(src_md)
-    line = 'none'
-    
-    while line:
-        line = src.readline()
-        # \begin \end syntax
-        begin_stmt = begin_re.match(line)
-        if begin_stmt:
-            # extra configs to tex2png()
-            options = begin_stmt.group('options')
-            options = parse_options(options)
-            formula = ''
-            while line:
-                line = src.readline()
-                if end_re.match(line):
-                    break
-                else:
-                    formula += line
-            if not line:
-                raise Exception(r'\begin[] statement has no \end')
-            if formula:
-                # user can override math mode, defaults to `none`
-                math_mode = options.pop('math_mode') if 'math_mode' in options else 'none'
-                options = merge_dict(tex2png_options, options)
-                png_file, img_code = run_latex(formula, math_mode, **options)
-                print(img_code, end='', file=output_md)
-            # skip the rest of processing
-            continue
-        
-        include_stmt = include_re.match(line)
-        if include_stmt:
-            options = include_stmt.group('options')
-            # \include[file_path, arg1=xx, arg2=...]
-            if ',' in options:
-                latex_src, options = options.split(',', 1)
-            else:
-                latex_src, options = options, ''
-            assert os.path.exists(latex_src), \
-                '\\include {} source file not found.'.format(latex_src)
-            formula = open(latex_src).read()
-            options = parse_options(options)
-            # print(formula, options)
+def scan(src_md, all_jobs=None, graph=None, regions=None, 
+         **tex2png_options):
+    """
+    Phase one of compile(): tokenize the whole source and collect all 
+    formulas to render, deduplicated by their image file. 
+    Nothing is rendered yet.
+    all_jobs: dict of jobs shared with other sources, see gitex.project
+    graph: BuildGraph recording the regions of the source, see emit()
+    regions: regions of the previous build, see BuildGraph.regions(). 
+      Unchanged regions reuse their output instead of being scanned again.
+    """
+    doc = attrdict(src_md=src_md, lineno=0, 
+                   jobs={} if all_jobs is None else all_jobs, 
+                   pieces=[], manifest=None, image_root=None, 
+                   baseline=False, graph=graph, options=None,
+                   deps=[src_md], regions=[])
+    regions = regions or {}
+    with stage('scan', src_md=src_md), open(src_md) as src:
+        for segments in split_regions(tokenize(src)):
+            doc.deps += [segment.value for segment in segments 
+                         if segment.kind == 'include']
+            key = graph.region_key(segments) if graph else None
+            start = len(doc.pieces)
+            if key in regions:
+                count('region.reused')
+                doc.pieces.append(regions[key]['output'])
+                doc.regions.append((key, start, regions[key]))
+                continue
+            for segment in segments:
+                scan_segment(doc, segment, **tex2png_options)
+            doc.regions.append((key, start, None))
+    return doc
+
+
+def scan_segment(doc, segment, **tex2png_options):
+    # add the output of one tokenizer Segment to doc.pieces
+    doc.lineno = segment.lineno
+    kind = segment.kind
+    if kind == 'text':
+        doc.pieces.append(segment.text)
+    elif kind == 'escape':
+        # e.g. \$ \\include to literals
+        doc.pieces.append(segment.value)
+    elif kind == 'image':
+        # new resize syntax
+        code = gen_image_code(segment.value, segment.options)
+        if '$' in code or '\\' in code:
+            # math and escapes in the alt text or url still apply
+            for sub_segment in tokenize_line(code, segment.lineno, 
+                                             images=False):
+                scan_segment(doc, sub_segment, **tex2png_options)
+        else:
+            doc.pieces.append(code)
+    elif kind in ['inline', 'display']:
+        options = parse_options(segment.options)
+        options = merge_dict(tex2png_options, options)
+        defer_latex(doc, segment.value, kind, escape=True, **options)
+    elif kind == 'begin':
+        # \begin \end syntax, extra configs to tex2png()
+        options = parse_options(segment.options)
+        if segment.value:
+            # user can override math mode, defaults to `none`
             math_mode = options.pop('math_mode') if 'math_mode' in options else 'none'
             options = merge_dict(tex2png_options, options)
-            png_file, img_code = run_latex(formula, math_mode, **options)
-            print(img_code, end='', file=output_md)
-            continue
-        
-        # check for images to implement the new resize syntax
-        line = process_image(line)
-        # display math mode $$...$$
-        line = process_latex(line, 'display', **tex2png_options)
-        # inline mode $...$
-        line = process_latex(line, 'inline', **tex2png_options)
-        # replace escapes (e.g. \$ \\include) to literals
-        line = process_escapes(line)
-        print(line, end='', file=output_md)
-
-    src.close()
-    output_md.close()
+            defer_latex(doc, segment.value, math_mode, **options)
+    elif kind == 'include':
+        latex_src = segment.value
+        assert os.path.exists(latex_src), \
+            '\\include {} source file not found.'.format(latex_src)
+        with open(latex_src) as f:
+            formula = f.read()
+        options = parse_options(segment.options)
+        math_mode = options.pop('math_mode') if 'math_mode' in options else 'none'
+        options = merge_dict(tex2png_options, options)
+        defer_latex(doc, formula, math_mode, **options)
 
 
-def main():
-    parser = argparse.ArgumentParser(prog='GiTeX')
-    parser.add_argument('src_md', help='Source markdown file')
-    parser.add_argument('output_md', help='Output markdown file')
+def write_output(output_md, content):
+    """
+    Replace `output_md` atomically, only if its content changes, so that
+    tools watching it see neither half-written nor rewritten files.
+    Returns whether the file was written.
+    """
+    try:
+        with open(output_md) as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    write_file(output_md, content)
+    return True
+
+
+def job_files(job):
+    # the image of a job and of its variants
+    return [job.png_file] + [variant.png_file for variant in job.variants]
 
+
+def emit(doc, output_md):
+    """
+    Phase three of compile(): write the output markdown after rendering,
+    and record the build in doc.graph.
+    """
+    with stage('emit', output_md=output_md):
+        output = [piece if isinstance(piece, str) 
+                  else gen_ref_code(doc, piece) for piece in doc.pieces]
+        if not write_output(output_md, ''.join(output)):
+            count('output.unchanged')
+        if doc.graph is None:
+            return
+        regions = {}
+        ends = [start for _, start, _ in doc.regions[1:]] + [len(output)]
+        for (key, start, region), end in zip(doc.regions, ends):
+            if region is None:
+                jobs = [piece[0] for piece in doc.pieces[start:end]
+                        if not isinstance(piece, str)]
+                region = dict(images=[png_file for job in jobs
+                                      for png_file in job_files(job)],
+                              formulas=sorted({job.png_file for job in jobs}))
+            regions[key] = dict(region, output=''.join(output[start:end]))
+        doc.graph.record(doc.src_md, output_md, doc.options, doc.deps, 
+                         regions)
+
+
+def build_options(tex2png_options, baseline=False, image_root=None):
+    # options that change the output markdown, see BuildGraph
+    options = {key: value for key, value in tex2png_options.items()
+               if key not in RENDER_OPTIONS + ['redraw']}
+    return json.dumps(dict(options, baseline=baseline, image_root=image_root),
+                      sort_keys=True)
+
+
+def build(src_md, output_md, manifest, graph, session, batch=False, jobs=1,
+          optimize=False, baseline=False, spool=None,
+          claim_timeout=CLAIM_TIMEOUT, **tex2png_options):
+    """
+    One incremental build of `output_md` on state kept by the caller, see
+    compile() and gitex.watch. The manifest and the graph are not saved.
+    manifest: Manifest of the image folder
+    graph: BuildGraph of the image folder
+    session: RenderSession of the build
+    Returns the doc, None if `output_md` was up to date.
+    """
+    options = build_options(tex2png_options, baseline)
+    regions = {}
+    if not tex2png_options['redraw']:
+        if graph.up_to_date(src_md, output_md, options, manifest):
+            print('{} is up to date.'.format(output_md))
+            return None
+        regions = graph.regions(output_md, options, manifest)
+    doc = scan(src_md, graph=graph, regions=regions, **tex2png_options)
+    doc.manifest = manifest
+    doc.baseline = baseline
+    doc.options = options
+    with stage('render'):
+        doc.rendered = render_jobs(doc.jobs.values(), batch=batch, 
+                                   n_jobs=jobs, manifest=manifest, 
+                                   session=session, spool=spool,
+                                   claim_timeout=claim_timeout)
+    optimize_jobs(doc.rendered, optimize, n_jobs=jobs, manifest=manifest)
+    doc.recolored = render_variants(doc.jobs.values(), doc.rendered, 
+                                    n_jobs=jobs, manifest=manifest)
+    emit(doc, output_md)
+    return doc
+
+
+def compile(src_md, output_md, batch=False, jobs=1, stats=0, trace=None,
+            optimize=False, baseline=False, spool=None,
+            claim_timeout=CLAIM_TIMEOUT, **tex2png_options):
+    """
+    Scan the whole source first, then render all missing formulas, 
+    then write `output_md`. Builds are incremental, see BuildGraph: an 
+    unchanged build does nothing, `redraw` scans everything again.
+    batch: render formulas with one multi-page LaTeX run per option set
+    jobs: number of formulas (or batches) rendered in parallel
+    optimize: optimize the newly rendered images, see optimize_jobs()
+    baseline: align inline formulas on the text baseline, see gen_job_code()
+    stats: print time per stage and the `stats` slowest formulas
+    trace: write a Chrome trace of the build to this file
+    spool: queue the formulas in this spool directory for `gitex worker`
+      processes instead of rendering them, see render_jobs()
+    """
+    with instrument(stats, trace):
+        image_folder = tex2png_options['image_folder']
+        manifest = load_manifest(image_folder)
+        graph = BuildGraph(image_folder)
+        with RenderSession(pool_size=jobs) as session:
+            build(src_md, output_md, manifest, graph, session, batch=batch,
+                  jobs=jobs, optimize=optimize, baseline=baseline, 
+                  spool=spool, claim_timeout=claim_timeout,
+                  **tex2png_options)
+        manifest.save()
+        graph.save()
+
+
+def add_arguments(parser):
+    # options shared by `gitex` and `gitex project`
     parser.add_argument('-i', '--image-folder', default='',
                         help='Folder for the generated latex images, '
                         'must be RELATIVE PATH with respect to your github dir.')
@@ -283,14 +788,116 @@ def main():
                         help='force all LaTeX formulas to redraw')
     parser.add_argument('-d', '--dpi', type=int, default=200,
                         help='default global DPI for generated images')
-
-    args = parser.parse_args()
-    folder = args.image_folder
+    parser.add_argument('-f', '--format', default='png', choices=FORMATS,
+                        help='image format, svg images are rendered with '
+                        'dvisvgm and serve every DPI')
+    parser.add_argument('--backend', default='tex', 
+                        choices=list(BACKENDS) + ['auto'],
+                        help='render with `tex`, with matplotlib `mathtext` '
+                        'when it draws the formula like TeX, or `auto` to '
+                        'pick the fastest backend per formula, see '
+                        'gitex/backends.py')
+    parser.add_argument('-V', '--variant', dest='variants', action='append',
+                        type=parse_variant, metavar='NAME=FG:BG',
+                        default=argparse.SUPPRESS,
+                        help='also write every image recolored with FG on BG, '
+                        'without running latex again, e.g. `dark=white:rgb '
+                        '13 17 23`. `light` and `dark` variants are linked '
+                        'from a <picture> element. Repeatable.')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='render all formulas that share the same options '
+                        'with a single multi-page LaTeX run')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of formulas rendered in parallel')
+    parser.add_argument('--spool', metavar='DIR',
+                        help='queue the formulas in the spool directory DIR '
+                        'and wait for `gitex worker DIR` processes, e.g. on '
+                        'other hosts sharing DIR and the image folder, to '
+                        'render them')
+    parser.add_argument('--claim-timeout', type=float,
+                        default=CLAIM_TIMEOUT, metavar='SECS',
+                        help='with --spool, queue a formula again when its '
+                        'worker has not finished it after SECS seconds '
+                        '(default {})'.format(CLAIM_TIMEOUT))
+    parser.add_argument('-O', '--optimize', nargs='?', const='python',
+                        choices=OPTIMIZERS, default=False,
+                        help='optimize the rendered PNG images in parallel '
+                        'after rendering, `optipng` also runs optipng when '
+                        'available')
+    parser.add_argument('-P', '--precompile', action='store_true',
+                        help='load the LaTeX preamble from a cached '
+                        'precompiled format, much faster for short formulas')
+    parser.add_argument('-w', '--worker', action='store_true',
+                        help='render on resident LaTeX processes instead of '
+                        'starting one per formula')
+    parser.add_argument('--no-dvi-cache', dest='dvi_cache',
+                        action='store_false',
+                        help='always run latex, even when only the DPI or the '
+                        'colors changed since the DVI of a formula was cached')
+    parser.add_argument('--baseline', action='store_true',
+                        help='align inline formulas on the text baseline with '
+                        'a vertical-align style, which GitHub strips but other '
+                        'markdown renderers keep')
+    parser.add_argument('--stats', type=int, nargs='?', const=10, default=0,
+                        metavar='N',
+                        help='print the time spent per stage and the N '
+                        '(default 10) slowest formulas')
+    parser.add_argument('--trace', metavar='TRACE_JSON',
+                        help='write a Chrome trace (chrome://tracing) of the '
+                        'build')
+
+
+def make_image_folder(folder):
     if folder and not os.path.exists(folder):
         os.mkdir(folder)
         print('Created new folder for generated latex images: {}'.format(folder))
+
+
+def main():
+    if sys.argv[1:2] == ['project']:
+        from gitex.project import main as project_main
+        return project_main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        from gitex.server import main as serve_main
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ['prune']:
+        from gitex.prune import main as prune_main
+        return prune_main(sys.argv[2:])
+    if sys.argv[1:2] == ['worker']:
+        from gitex.spool import main as worker_main
+        return worker_main(sys.argv[2:])
+    if sys.argv[1:2] == ['migrate']:
+        from gitex.migrate import main as migrate_main
+        return migrate_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(prog='GiTeX',
+                                     epilog='`gitex project -h` to build '
+                                     'many markdown files at once, '
+                                     '`gitex serve -h` to render formulas '
+                                     'over HTTP, `gitex prune -h` to delete '
+                                     'unused images, `gitex migrate -h` to '
+                                     'rename images cached by older versions, '
+                                     '`gitex worker -h` to render the '
+                                     'formulas queued with --spool')
+    parser.add_argument('src_md', help='Source markdown file')
+    parser.add_argument('output_md', help='Output markdown file')
+    add_arguments(parser)
+    parser.add_argument('--watch', action='store_true',
+                        help='rebuild whenever the source or an included '
+                        'file changes, keeping the build state in memory')
+    parser.add_argument('--debounce', type=int, default=100, metavar='MS',
+                        help='with --watch, wait until the files have not '
+                        'changed for MS milliseconds (default 100)')
+
+    args = parser.parse_args()
+    make_image_folder(args.image_folder)
     
-    compile(**vars(args))
+    options = vars(args)
+    debounce = options.pop('debounce') / 1000
+    if options.pop('watch'):
+        from gitex.watch import watch
+        return watch(debounce=debounce, **options)
+    compile(**options)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,181 @@
+"""
+Minimal DVI reader.
+Reads the complete pages of a DVI file that is still being written by TeX,
+and writes any page back as a standalone single-page DVI file for dvipng.
+"""
+import struct
+
+SET_RULE, PUT_RULE, NOP, BOP, EOP, PUSH, POP = 132, 137, 138, 139, 140, 141, 142
+XXX1, FNT_DEF1, PRE, POST, POST_POST = 239, 243, 247, 248, 249
+
+
+def param_length(data, pos):
+    """
+    Length of the DVI command at `pos`, including the opcode byte.
+    Returns None if the command is not complete yet.
+    """
+    op = data[pos]
+    if op == BOP:
+        length = 45
+    elif op < 128 or NOP <= op <= POP or op in (147, 152, 161, 166) \
+            or 171 <= op <= 234:
+        length = 1
+    elif op <= 131:                         # set1-4
+        length = 1 + op - 127
+    elif op in (SET_RULE, PUT_RULE):
+        length = 9
+    elif op <= 136:                         # put1-4
+        length = 1 + op - 132
+    elif op <= 146:                         # right1-4
+        length = 1 + op - 142
+    elif op <= 151:                         # w1-4
+        length = 1 + op - 147
+    elif op <= 156:                         # x1-4
+        length = 1 + op - 152
+    elif op <= 160:                         # down1-4
+        length = 1 + op - 156
+    elif op <= 165:                         # y1-4
+        length = 1 + op - 161
+    elif op <= 170:                         # z1-4
+        length = 1 + op - 166
+    elif op <= 238:                         # fnt1-4
+        length = 1 + op - 234
+    elif op <= 242:                         # xxx1-4: special
+        k = op - XXX1 + 1
+        if pos + 1 + k > len(data):
+            return None
+        length = 1 + k + read_uint(data, pos + 1, k)
+    elif op <= 246:                         # fnt_def1-4
+        k = op - FNT_DEF1 + 1
+        if pos + 1 + k + 14 > len(data):
+            return None
+        a, l = data[pos + 1 + k + 12], data[pos + 1 + k + 13]
+        length = 1 + k + 14 + a + l
+    elif op == PRE:
+        if pos + 15 > len(data):
+            return None
+        length = 15 + data[pos + 14]
+    else:
+        raise ValueError('Unexpected DVI opcode {} at {}'.format(op, pos))
+    if pos + length > len(data):
+        return None
+    return length
+
+
+def read_uint(data, pos, k):
+    return int.from_bytes(data[pos:pos + k], 'big')
+
+
+class DviReader(object):
+    """
+    Incrementally reads complete pages of a growing DVI file.
+    pages: list of (counts, body), `counts` are \\count0-9 of the page and
+      `body` the commands between `bop` and `eop`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = b''
+        self.pos = 0
+        self.preamble = None
+        # font number -> fnt_def command, in definition order
+        self.fonts = {}
+        self.pages = []
+        # fonts defined before each page
+        self.page_fonts = []
+
+    def read(self):
+        """
+        Parse all pages completed since the last call.
+        Returns the list of new pages.
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(len(self.data))
+            self.data += f.read()
+        data = self.data
+        new_pages = []
+        while self.pos < len(data):
+            op = data[self.pos]
+            if op == BOP:
+                page = self.read_page(self.pos)
+                if page is None:
+                    break
+                new_pages.append(page)
+                continue
+            if op == POST:
+                break
+            length = param_length(data, self.pos)
+            if length is None:
+                break
+            if op == PRE:
+                self.preamble = data[self.pos:self.pos + length]
+            elif FNT_DEF1 <= op <= FNT_DEF1 + 3:
+                self.add_font(self.pos, length)
+            self.pos += length
+        return new_pages
+
+    def add_font(self, pos, length):
+        k = self.data[pos] - FNT_DEF1 + 1
+        number = read_uint(self.data, pos + 1, k)
+        self.fonts.setdefault(number, self.data[pos:pos + length])
+
+    def read_page(self, bop_pos):
+        # returns the page if it is complete, and moves past its eop
+        data = self.data
+        if bop_pos + 45 > len(data):
+            return None
+        counts = struct.unpack('>10i', data[bop_pos + 1:bop_pos + 41])
+        pos = bop_pos + 45
+        known_fonts = list(self.fonts.values())
+        page_fonts = []
+        while pos < len(data):
+            op = data[pos]
+            if op == EOP:
+                for font_pos, length in page_fonts:
+                    self.add_font(font_pos, length)
+                page = (counts, data[bop_pos + 45:pos])
+                self.pages.append(page)
+                self.page_fonts.append(known_fonts)
+                self.pos = pos + 1
+                return page
+            length = param_length(data, pos)
+            if length is None:
+                return None
+            if FNT_DEF1 <= op <= FNT_DEF1 + 3:
+                page_fonts.append((pos, length))
+            pos += length
+        return None
+
+    def write_page(self, index, path):
+        """
+        Write page number `index` (0-based) as a standalone DVI file.
+        Fonts defined on earlier pages are defined again right after `bop`.
+        """
+        counts, body = self.pages[index]
+        known_fonts = self.page_fonts[index]
+        out = bytearray(self.preamble)
+        bop_pos = len(out)
+        out += struct.pack('>B10ii', BOP, *(counts + (-1,)))
+        out += b''.join(known_fonts)
+        out += body
+        out.append(EOP)
+        # max stack depth, needed by the postamble
+        depth = max_depth = 0
+        pos = 0
+        while pos < len(body):
+            op = body[pos]
+            if op == PUSH:
+                depth += 1
+                max_depth = max(max_depth, depth)
+            elif op == POP:
+                depth -= 1
+            pos += param_length(body, pos)
+        post_pos = len(out)
+        # post p[4] num[4] den[4] mag[4] l[4] u[4] s[2] t[2]
+        num, den, mag = struct.unpack('>iii', self.preamble[2:14])
+        out += struct.pack('>BiiiiiiHH', POST, bop_pos, num, den, mag,
+                           0, 0, max_depth, 1)
+        out += b''.join(self.fonts.values())
+        out += struct.pack('>BiB', POST_POST, post_pos, 2)
+        out += b'\xdf' * (4 + (-len(out)) % 4)
+        with open(path, 'wb') as f:
+            f.write(out)
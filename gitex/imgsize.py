@@ -1,27 +1,84 @@
+import re
 import sys
 import struct
-import imghdr
+from concurrent.futures import ThreadPoolExecutor
 
-def get_image_size(fname):
-    "Determine the image type of fhandle and return its size."
+# points per unit of the SVG lengths, see get_svg_size()
+SVG_UNITS = {'pt': 1., 'bp': 1., 'px': .75, 'in': 72., 'cm': 72 / 2.54,
+             'mm': 72 / 25.4, 'pc': 12., '': .75}
+svg_tag_re = re.compile(rb'<svg\b[^>]*>')
+# the IEND chunk that closes every PNG: length 0, type, CRC
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+svg_end_re = re.compile(rb'</svg>\s*$')
+svg_length_re = r"""(?<![\w-]){}\s*=\s*['"]\s*([0-9.]+)\s*([a-z]*)\s*['"]"""
+
+def get_png_size(data):
+    """
+    Width and height from the first 24 bytes of a PNG, None if not a PNG.
+    """
+    if len(data) < 24 or data[:8] != b'\x89PNG\r\n\x1a\n':
+        return
+    return struct.unpack('>ii', data[16:24])
+
+
+def get_svg_size(data):
+    """
+    Declared width and height of an SVG in points (1/72 inch), as floats.
+    None if not an SVG or its size isn't given in absolute units.
+    """
+    match = svg_tag_re.search(data[:4096])
+    if not match:
+        return
+    tag = match.group().decode('utf-8', 'replace')
+    size = []
+    for name in ['width', 'height']:
+        length = re.search(svg_length_re.format(name), tag)
+        if not length or length.group(2) not in SVG_UNITS:
+            return
+        size.append(round(float(length.group(1)) 
+                          * SVG_UNITS[length.group(2)], 3))
+    return tuple(size)
+
+
+def is_complete(fhandle, svg=False):
+    """
+    Whether the PNG (or SVG) open in `fhandle` ends like a whole image, with
+    the IEND chunk (or the closing `</svg>`), e.g. not cut by a full disk.
+    """
+    fhandle.seek(0, 2)
+    end = fhandle.tell()
+    fhandle.seek(max(0, end - (64 if svg else len(PNG_END))))
+    tail = fhandle.read()
+    if svg:
+        return svg_end_re.search(tail) is not None
+    return tail == PNG_END
+
+
+def get_image_size(fname, complete=False):
+    """
+    Width and height of a PNG, GIF or JPEG image, in points for an SVG,
+    None if unknown. The type is told from the first bytes, the file is
+    opened once.
+    complete: also None for a PNG or an SVG that isn't whole, see
+      is_complete(), the header alone gives the size of a truncated file
+    """
     # Adapted from http://stackoverflow.com/questions/8032642/how-to-obtain-image-size-using-standard-python-class-without-using-external-lib
     with open(fname, 'rb') as fhandle:
         head = fhandle.read(24)
         if len(head) != 24:
             return
-        if imghdr.what(fname) == 'png':
-            check = struct.unpack('>i', head[4:8])[0]
-            if check != 0x0d0a1a0a:
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            if complete and not is_complete(fhandle):
                 return
-            width, height = struct.unpack('>ii', head[16:24])
-        elif imghdr.what(fname) == 'gif':
+            return get_png_size(head)
+        elif head[:6] in (b'GIF87a', b'GIF89a'):
             width, height = struct.unpack('<HH', head[6:10])
-        elif imghdr.what(fname) == 'jpeg':
+        elif head[:2] == b'\xff\xd8':
             try:
-                fhandle.seek(0) # Read 0xff next
-                size = 2
+                fhandle.seek(2) # Read 0xff next
+                size = 0
                 ftype = 0
-                while not 0xc0 <= ftype <= 0xcf:
+                while not 0xc0 <= ftype <= 0xcf or ftype in (0xc4, 0xc8, 0xcc):
                     fhandle.seek(size, 1)
                     byte = fhandle.read(1)
                     while ord(byte) == 0xff:
@@ -33,9 +90,30 @@ def get_image_size(fname):
                 height, width = struct.unpack('>HH', fhandle.read(4))
             except Exception: #IGNORE:W0703
                 return
+        elif head.lstrip().startswith((b'<?xml', b'<svg')):
+            # size in points, see get_svg_size()
+            size = get_svg_size(head + fhandle.read(4096 - len(head)))
+            if complete and not is_complete(fhandle, svg=True):
+                return
+            return size
         else:
             return
         return width, height
 
+
+def get_image_sizes(fnames, n_jobs=8, complete=False):
+    """
+    Batch mode of get_image_size(), files are read on `n_jobs` threads.
+    Returns the sizes in the order of `fnames`.
+    """
+    fnames = list(fnames)
+    if n_jobs <= 1 or len(fnames) <= 1:
+        return [get_image_size(fname, complete) for fname in fnames]
+    with ThreadPoolExecutor(min(n_jobs, len(fnames))) as pool:
+        return list(pool.map(lambda fname: get_image_size(fname, complete),
+                             fnames))
+
+
 if __name__ == '__main__':
-    print(get_image_size(sys.argv[1]))
\ No newline at end of file
+    for fname, size in zip(sys.argv[1:], get_image_sizes(sys.argv[1:])):
+        print(fname, size)
@@ -0,0 +1,249 @@
+"""
+Render manifest of an image folder.
+Maps every `tex_<md5>.png` to the formula it was rendered from and its size,
+so that a cached build never needs to open the image files.
+"""
+import os
+import json
+import time
+from gitex.imgsize import get_image_size, get_image_sizes
+from gitex.tex2png import get_version
+from gitex.canon import image_name, HASH_VERSION
+from gitex.stats import stage
+from gitex.atomic import temp_path, file_lock
+
+MANIFEST_FILE = '.gitex_manifest.json'
+MANIFEST_VERSION = 1
+# seconds, `used_at` is only updated once per period so that builds don't
+# rewrite the manifest for every use
+USE_RESOLUTION = 3600
+
+
+def get_toolchain_version():
+    return '; '.join(map(get_version, ['latex', 'dvipng']))
+
+
+class Manifest(object):
+    """
+    Entries are keyed by image file name, e.g. `tex_<md5>.png`:
+    {formula, math_mode, options, width, height, depth, size, mtime,
+     render_time, toolchain, used_at}
+    `depth` (pixels below the baseline) is reported by dvipng, it is None
+    for images adopted from earlier builds and for svg images.
+    `size` and `mtime` of the image file detect missing, truncated or
+    externally modified images with a single stat().
+    `used_at` is the last time a build used the image, see gitex.prune.
+    `hash_version` is the canon.HASH_VERSION the images are named with.
+    Concurrent builds of the image folder share the manifest, see save().
+    """
+    def __init__(self, image_folder):
+        self.image_folder = image_folder
+        self.path = os.path.join(image_folder, MANIFEST_FILE)
+        self.entries = {}
+        self.hash_version = HASH_VERSION
+        self.dirty = False
+        manifest = self.read()
+        if manifest is not None:
+            self.entries = manifest['entries']
+            self.hash_version = manifest.get('hash_version', 1)
+        elif os.path.exists(self.path):
+            print('Corrupted manifest {}, rebuild.'.format(self.path))
+            self.dirty = True
+        # entries as read, save() merges what changed since
+        self.loaded = json.loads(json.dumps(self.entries))
+
+    def read(self):
+        # the manifest on disk, None if missing, corrupted or outdated
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def tracks(self, png_file):
+        return os.path.dirname(png_file) == self.image_folder
+
+    def lookup(self, png_file):
+        """
+        Returns the entry if `png_file` is a valid image, otherwise None.
+        Images rendered without manifest are adopted after reading their size.
+        """
+        if not self.tracks(png_file):
+            return None
+        name = os.path.basename(png_file)
+        entry = self.entries.get(name)
+        try:
+            stat = os.stat(png_file)
+        except OSError:
+            if entry:
+                self.drop(png_file)
+            return None
+        if (entry and entry['size'] == stat.st_size
+                and entry['mtime'] == stat.st_mtime):
+            self.touch(entry)
+            return entry
+        # unknown or modified image, truncated files have no valid size
+        with stage('get_image_size'):
+            size = get_image_size(png_file, complete=True)
+        if not size:
+            if entry:
+                self.drop(png_file)
+            return None
+        entry = entry or {}
+        entry.update(width=size[0], height=size[1],
+                     size=stat.st_size, mtime=stat.st_mtime)
+        self.entries[name] = entry
+        self.touch(entry)
+        self.dirty = True
+        return entry
+
+    def touch(self, entry):
+        # the image is used by the current build
+        now = time.time()
+        if now - entry.get('used_at', 0) > USE_RESOLUTION:
+            entry['used_at'] = now
+            self.dirty = True
+
+    def prefetch(self, png_files, n_jobs=8):
+        """
+        Read the size of all unknown or modified images at once, see 
+        imgsize.get_image_sizes(), so that lookup() finds them.
+        """
+        stale = []
+        for png_file in png_files:
+            if not self.tracks(png_file):
+                continue
+            entry = self.entries.get(os.path.basename(png_file))
+            try:
+                stat = os.stat(png_file)
+            except OSError:
+                continue
+            if not (entry and entry['size'] == stat.st_size
+                    and entry['mtime'] == stat.st_mtime):
+                stale.append((png_file, stat))
+        if not stale:
+            return
+        with stage('get_image_size', images=len(stale)):
+            sizes = get_image_sizes([png_file for png_file, _ in stale], 
+                                    n_jobs, complete=True)
+        for (png_file, stat), size in zip(stale, sizes):
+            if not size:
+                continue
+            entry = self.entries.setdefault(os.path.basename(png_file), {})
+            entry.update(width=size[0], height=size[1],
+                         size=stat.st_size, mtime=stat.st_mtime)
+            self.dirty = True
+
+    def record(self, job, render_time=None, image=None):
+        """
+        Record a freshly rendered job, see compile.gen_job()
+        image: width, height and depth of the image, see 
+          tex2png.tex2png_image(). Read from the image file if not given.
+        """
+        if not self.tracks(job.png_file):
+            return
+        options = {key: value for key, value in job.options.items()
+                   if key not in ['formula', 'output_file', 'math_mode',
+                                  'precompile', 'worker', 'dvi_cache']}
+        name = os.path.basename(job.png_file)
+        self.entries.pop(name, None)
+        if image is None:
+            entry = self.lookup(job.png_file)
+            if entry is None:
+                return
+        else:
+            try:
+                stat = os.stat(job.png_file)
+            except OSError:
+                return
+            entry = dict(width=image.width, height=image.height, 
+                         depth=image.depth,
+                         size=stat.st_size, mtime=stat.st_mtime)
+            self.entries[name] = entry
+            self.dirty = True
+        entry.update(formula=job.formula,
+                     math_mode=job.math_mode,
+                     options=options,
+                     render_time=render_time,
+                     rendered_at=time.time(),
+                     used_at=time.time(),
+                     toolchain=get_toolchain_version())
+
+    def refresh(self, png_file):
+        # the image file was rewritten without changing its pixels
+        entry = self.entries.get(os.path.basename(png_file))
+        if not entry or not self.tracks(png_file):
+            return
+        try:
+            stat = os.stat(png_file)
+        except OSError:
+            return
+        entry.update(size=stat.st_size, mtime=stat.st_mtime)
+        self.dirty = True
+
+    def migrate(self):
+        """
+        Rename the images named with an older hash version after the formula
+        and options recorded for them, see canon.image_name(), without
+        rendering them again. Images cached twice under the old names are
+        kept once. Returns the number of images renamed.
+        """
+        renamed = 0
+        for name, entry in list(self.entries.items()):
+            if 'formula' not in entry:
+                # adopted from an earlier build, the formula is unknown
+                continue
+            new_name = image_name(entry['formula'], entry['math_mode'],
+                                  entry['options'])
+            if new_name == name:
+                continue
+            old_file = os.path.join(self.image_folder, name)
+            new_file = os.path.join(self.image_folder, new_name)
+            del self.entries[name]
+            if not os.path.exists(old_file):
+                continue
+            if new_name in self.entries or os.path.exists(new_file):
+                os.remove(old_file)
+                continue
+            os.replace(old_file, new_file)
+            self.entries[new_name] = entry
+            renamed += 1
+        self.hash_version = HASH_VERSION
+        self.dirty = True
+        return renamed
+
+    def drop(self, png_file):
+        self.entries.pop(os.path.basename(png_file), None)
+        self.dirty = True
+
+    def save(self):
+        """
+        Merge the entries that this process added, changed or dropped into
+        the manifest on disk, under its lock, so that concurrent builds of
+        the image folder keep each other's entries.
+        """
+        if not self.dirty:
+            return
+        with file_lock(self.path):
+            manifest = self.read()
+            entries = manifest['entries'] if manifest else {}
+            for name in set(self.loaded) - set(self.entries):
+                entries.pop(name, None)
+            for name, entry in self.entries.items():
+                if entry != self.loaded.get(name):
+                    entries[name] = entry
+            # write to a temp file first so that readers never see half a 
+            # manifest
+            temp_file = temp_path(self.path)
+            with open(temp_file, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 
+                           'hash_version': self.hash_version,
+                           'entries': entries},
+                          f, indent=1, sort_keys=True)
+            os.replace(temp_file, self.path)
+        self.entries = entries
+        self.loaded = json.loads(json.dumps(entries))
+        self.dirty = False
@@ -0,0 +1,78 @@
+"""
+`gitex migrate`: rename the images cached by an older GiTeX to the canonical
+hash of gitex.canon, without rendering them again.
+Images recorded in the manifest are renamed after the formula and options it
+recorded, which every build also does on its own, see compile.load_manifest().
+Images cached before the manifest existed are found by scanning the markdown
+sources again, with the options of the build that rendered them.
+"""
+import os
+import argparse
+from gitex.compile import (scan, load_manifest, add_arguments,
+                           RENDER_OPTIONS)
+from gitex.canon import legacy_image_name
+
+# compile() options that don't reach the jobs
+BUILD_OPTIONS = ['batch', 'jobs', 'optimize', 'baseline', 'stats', 'trace',
+                 'spool', 'claim_timeout']
+
+
+def migrate_sources(sources, dry_run=False, **tex2png_options):
+    """
+    Rename the images of the formulas of `sources` from their legacy name,
+    see canon.legacy_image_name(), and record them in the manifest.
+    tex2png_options: as given to compile()
+    Returns (renamed, missing): numbers of images renamed and of formulas
+    without a cached image under either name.
+    """
+    manifest = load_manifest(tex2png_options['image_folder'])
+    all_jobs = {}
+    for src_md in sources:
+        scan(src_md, all_jobs=all_jobs, **tex2png_options)
+    renamed, missing = 0, 0
+    for job in all_jobs.values():
+        if os.path.exists(job.png_file):
+            continue
+        options = {key: value for key, value in job.options.items()
+                   if key not in ['formula', 'output_file', 'math_mode']
+                   + RENDER_OPTIONS}
+        if options.get('backend') == 'tex':
+            # older versions only had TeX
+            options.pop('backend')
+        old_file = os.path.join(os.path.dirname(job.png_file),
+                                legacy_image_name(job.formula, job.math_mode,
+                                                  options))
+        if not os.path.exists(old_file):
+            missing += 1
+            continue
+        print('{} -> {}'.format(old_file, job.png_file))
+        renamed += 1
+        if not dry_run:
+            os.replace(old_file, job.png_file)
+            manifest.record(job)
+    if not dry_run:
+        manifest.save()
+    return renamed, missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gitex migrate',
+                                     description='Rename the images cached by '
+                                     'an older GiTeX to their canonical hash, '
+                                     'without rendering them again. Give the '
+                                     'options of the build that rendered '
+                                     'them.')
+    parser.add_argument('sources', nargs='*',
+                        help='markdown sources of the cached images, only '
+                        'needed for images missing from the manifest')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only print the renames')
+    add_arguments(parser)
+
+    args = parser.parse_args(argv)
+    options = vars(args)
+    for key in BUILD_OPTIONS:
+        options.pop(key)
+    renamed, missing = migrate_sources(options.pop('sources'), **options)
+    print('Renamed {} images, {} formulas have no cached image.'
+          .format(renamed, missing))
@@ -0,0 +1,315 @@
+"""
+Lossless in-process PNG optimizer, pure Python.
+Drops the ancillary chunks, reduces the color type to grayscale, gray+alpha
+or a palette when the pixels allow it, then deflates again. The smallest
+encoding wins, and the original is kept if nothing is smaller.
+16-bit and interlaced images are left as they are.
+"""
+import sys
+import zlib
+import struct
+from gitex.atomic import write_file
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# color type -> samples per pixel
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def read_chunks(data):
+    # yields (type, body) of every chunk
+    assert data[:8] == PNG_SIGNATURE, 'not a PNG'
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        yield kind, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def make_chunk(kind, body):
+    return (struct.pack('>I', len(body)) + kind + body
+            + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff))
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def unfilter(raw, height, stride, bpp):
+    """
+    Undo the per-scanline filters, returns the rows without filter bytes.
+    """
+    rows = []
+    prev = bytearray(stride)
+    pos = 0
+    for _ in range(height):
+        kind = raw[pos]
+        row = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        if kind == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+        elif kind == 2:
+            for i in range(stride):
+                row[i] = (row[i] + prev[i]) & 0xff
+        elif kind == 3:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                upleft = prev[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + paeth(left, prev[i], upleft)) & 0xff
+        rows.append(row)
+        prev = row
+    return rows
+
+
+def unpack_samples(row, width, bit_depth):
+    # samples of a row with 1, 2 or 4 bits per sample
+    mask = (1 << bit_depth) - 1
+    per_byte = 8 // bit_depth
+    samples = bytearray(width)
+    for x in range(width):
+        shift = 8 - bit_depth * (x % per_byte + 1)
+        samples[x] = (row[x // per_byte] >> shift) & mask
+    return samples
+
+
+def pack_samples(samples, bit_depth):
+    # inverse of unpack_samples()
+    per_byte = 8 // bit_depth
+    packed = bytearray(-(-len(samples) // per_byte))
+    for x, sample in enumerate(samples):
+        packed[x // per_byte] |= sample << (8 - bit_depth * (x % per_byte + 1))
+    return packed
+
+
+def decode(data):
+    """
+    Returns (width, height, RGBA bytes), None if the image isn't supported.
+    """
+    header, palette, transparency, idat = None, b'', None, []
+    for kind, body in read_chunks(data):
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif kind == b'PLTE':
+            palette = body
+        elif kind == b'tRNS':
+            transparency = body
+        elif kind == b'IDAT':
+            idat.append(body)
+    if header is None:
+        return
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if interlace or bit_depth == 16 or color_type not in CHANNELS:
+        return
+    channels = CHANNELS[color_type]
+    stride = -(-width * channels * bit_depth // 8)
+    bpp = max(1, channels * bit_depth // 8)
+    rows = unfilter(zlib.decompress(b''.join(idat)), height, stride, bpp)
+
+    rgba = bytearray()
+    if color_type in (0, 3):
+        if color_type == 3:
+            alphas = bytearray(transparency or b'')
+            alphas += b'\xff' * (256 - len(alphas))
+            lookup = [palette[3 * i:3 * i + 3] + bytes([alphas[i]])
+                      for i in range(len(palette) // 3)]
+        else:
+            scale = 255 // ((1 << bit_depth) - 1)
+            key = (struct.unpack('>H', transparency)[0]
+                   if transparency else None)
+            lookup = [bytes([v * scale] * 3 + [0 if v == key else 255])
+                      for v in range(1 << bit_depth)]
+        table = {i: value for i, value in enumerate(lookup)}
+        for row in rows:
+            if bit_depth < 8:
+                row = unpack_samples(row, width, bit_depth)
+            rgba += b''.join(table[i] for i in row[:width])
+    elif color_type == 2:
+        key = (bytes(struct.unpack('>HHH', transparency))
+               if transparency else None)
+        for row in rows:
+            pixels = bytearray(4 * width)
+            for channel in range(3):
+                pixels[channel::4] = row[channel::3]
+            pixels[3::4] = b'\xff' * width
+            if key is not None:
+                for x in range(width):
+                    if row[3 * x:3 * x + 3] == key:
+                        pixels[4 * x + 3] = 0
+            rgba += pixels
+    elif color_type == 4:
+        for row in rows:
+            pixels = bytearray(4 * width)
+            for channel in range(3):
+                pixels[channel::4] = row[0::2]
+            pixels[3::4] = row[1::2]
+            rgba += pixels
+    else:
+        for row in rows:
+            rgba += row
+    return width, height, bytes(rgba)
+
+
+def filter_rows(rows, bpp, adaptive):
+    """
+    Filtered scanlines. Without `adaptive` every row uses filter 0, the best
+    choice for palette and low bit depth images. Otherwise each row gets the
+    filter with the smallest sum of absolute values.
+    """
+    if not adaptive:
+        return b''.join(b'\x00' + bytes(row) for row in rows)
+    out = bytearray()
+    prev = bytes(len(rows[0])) if rows else b''
+    for row in rows:
+        n = len(row)
+        left = bytes(bpp) + row[:n - bpp]
+        upleft = bytes(bpp) + prev[:n - bpp]
+        candidates = [
+            row,
+            bytes((row[i] - left[i]) & 0xff for i in range(n)),
+            bytes((row[i] - prev[i]) & 0xff for i in range(n)),
+            bytes((row[i] - ((left[i] + prev[i]) >> 1)) & 0xff
+                  for i in range(n)),
+            bytes((row[i] - paeth(left[i], prev[i], upleft[i])) & 0xff
+                  for i in range(n))]
+        # bytes above 127 stand for small negative differences
+        kind = min(range(5), key=lambda k: sum(
+            v if v < 128 else 256 - v for v in candidates[k]))
+        out += bytes([kind]) + candidates[kind]
+        prev = row
+    return bytes(out)
+
+
+def deflate(raw):
+    # smallest of a few zlib strategies
+    best = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        compressed = compressor.compress(raw) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return best
+
+
+def encode(width, height, bit_depth, color_type, rows, extra_chunks=(),
+           adaptive=False):
+    bpp = max(1, CHANNELS[color_type] * bit_depth // 8)
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, color_type,
+                         0, 0, 0)
+    return (PNG_SIGNATURE + make_chunk(b'IHDR', header)
+            + b''.join(make_chunk(kind, body) for kind, body in extra_chunks)
+            + make_chunk(b'IDAT', deflate(filter_rows(rows, bpp, adaptive)))
+            + make_chunk(b'IEND', b''))
+
+
+def gen_candidates(width, height, rgba):
+    # yields the encodings allowed by the colors of the image
+    n = width * height
+    row_size = 4 * width
+    opaque = rgba[3::4].count(255) == n
+    gray = rgba[0::4] == rgba[1::4] == rgba[2::4]
+
+    colors = {}
+    for i in range(0, len(rgba), 4):
+        color = rgba[i:i + 4]
+        if color not in colors:
+            if len(colors) == 256:
+                colors = None
+                break
+            colors[color] = len(colors)
+    if colors is not None:
+        # translucent entries first, so that tRNS stays short
+        ordered = sorted(colors, key=lambda color: color[3] == 255)
+        index = {color: i for i, color in enumerate(ordered)}
+        bit_depth = next(depth for depth in (1, 2, 4, 8)
+                         if len(ordered) <= 1 << depth)
+        extra = [(b'PLTE', b''.join(color[:3] for color in ordered))]
+        alphas = bytes(color[3] for color in ordered if color[3] != 255)
+        if alphas:
+            extra.append((b'tRNS', alphas))
+        rows = []
+        for y in range(height):
+            row = rgba[y * row_size:(y + 1) * row_size]
+            samples = bytearray(index[row[x:x + 4]]
+                                for x in range(0, row_size, 4))
+            rows.append(pack_samples(samples, bit_depth)
+                        if bit_depth < 8 else samples)
+        yield encode(width, height, bit_depth, 3, rows, extra)
+
+    if gray:
+        levels = rgba[0::4]
+        if opaque:
+            for bit_depth in (1, 2, 4):
+                scale = 255 // ((1 << bit_depth) - 1)
+                if all(level % scale == 0 for level in set(levels)):
+                    rows = [pack_samples(bytes(v // scale for v in
+                                               levels[y * width:
+                                                      (y + 1) * width]),
+                                         bit_depth)
+                            for y in range(height)]
+                    yield encode(width, height, bit_depth, 0, rows)
+                    break
+            rows = [levels[y * width:(y + 1) * width] for y in range(height)]
+            yield encode(width, height, 8, 0, rows)
+            yield encode(width, height, 8, 0, rows, adaptive=True)
+        else:
+            pixels = bytearray(2 * n)
+            pixels[0::2] = levels
+            pixels[1::2] = rgba[3::4]
+            rows = [pixels[y * 2 * width:(y + 1) * 2 * width]
+                    for y in range(height)]
+            yield encode(width, height, 8, 4, rows, adaptive=True)
+    elif colors is None:
+        if opaque:
+            pixels = bytearray(3 * n)
+            for channel in range(3):
+                pixels[channel::3] = rgba[channel::4]
+            rows = [pixels[y * 3 * width:(y + 1) * 3 * width]
+                    for y in range(height)]
+            yield encode(width, height, 8, 2, rows, adaptive=True)
+        else:
+            rows = [rgba[y * row_size:(y + 1) * row_size]
+                    for y in range(height)]
+            yield encode(width, height, 8, 6, rows, adaptive=True)
+
+
+def optimize_png(data):
+    """
+    Returns the smallest lossless encoding of the PNG `data`, `data` itself
+    if it can't be made smaller.
+    """
+    try:
+        image = decode(data)
+    except (zlib.error, struct.error, IndexError, KeyError, AssertionError):
+        return data
+    if image is None:
+        return data
+    best = data
+    for candidate in gen_candidates(*image):
+        if len(candidate) < len(best):
+            best = candidate
+    return best
+
+
+def optimize_file(png_file):
+    """
+    Optimize `png_file` in place, returns (size before, size after).
+    """
+    with open(png_file, 'rb') as f:
+        data = f.read()
+    optimized = optimize_png(data)
+    if len(optimized) < len(data):
+        write_file(png_file, optimized)
+    return len(data), len(optimized)
+
+
+if __name__ == '__main__':
+    for png_file in sys.argv[1:]:
+        print('{}: {} -> {} bytes'.format(png_file, *optimize_file(png_file)))
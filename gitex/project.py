@@ -0,0 +1,215 @@
+"""
+Project mode: build many GiTeX markdown files at once.
+All sources are scanned first, so that a formula shared by several files is
+rendered only once, then all outputs are written.
+"""
+import os
+import glob
+import json
+import time
+import argparse
+from gitex.tex2png import attrdict, RenderSession
+from gitex.stats import stage, instrument
+from gitex.compile import (scan, render_jobs, optimize_jobs, emit, 
+                           render_variants, load_manifest, build_options, 
+                           add_arguments, make_image_folder)
+from gitex.buildgraph import BuildGraph
+from gitex.spool import CLAIM_TIMEOUT
+
+# `notes.gitex.md` compiles to `notes.md`
+SOURCE_SUFFIX = '.gitex.md'
+
+
+def output_path(src_md, suffix=SOURCE_SUFFIX):
+    assert src_md.endswith(suffix), \
+        '{} is not a `*{}` source file'.format(src_md, suffix)
+    return src_md[:-len(suffix)] + '.md'
+
+
+def find_sources(paths, suffix=SOURCE_SUFFIX):
+    """
+    paths: source files, glob patterns (`**` recurses) or directories, which
+      are searched recursively for `*<suffix>` files
+    Returns a list of (src_md, output_md)
+    """
+    pairs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                # skip .git and friends, walk in a stable order
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(files):
+                    if name.endswith(suffix):
+                        src_md = os.path.join(root, name)
+                        pairs.append((src_md, output_path(src_md, suffix)))
+        else:
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                raise Exception('No source file matches {}'.format(path))
+            pairs += [(src_md, output_path(src_md, suffix))
+                      for src_md in matches if os.path.isfile(src_md)]
+    return pairs
+
+
+def load_config(config_file, suffix=SOURCE_SUFFIX):
+    """
+    JSON project file:
+    {
+        "files": [["intro.gitex.md", "README.md"], "docs/", "notes/*.gitex.md"],
+        "image_folder": "img",
+        "dpi": 200
+    }
+    `files` holds explicit [src_md, output_md] pairs and paths for
+    find_sources(). All other keys are `gitex project` options.
+    Returns (pairs, options)
+    """
+    with open(config_file) as f:
+        options = json.load(f)
+    pairs = []
+    for entry in options.pop('files', []):
+        if isinstance(entry, str):
+            pairs += find_sources([entry], options.get('suffix', suffix))
+        else:
+            src_md, output_md = entry
+            pairs.append((src_md, output_md))
+    return pairs, options
+
+
+def compile_project(pairs, batch=False, jobs=1, stats=0, trace=None,
+                    optimize=False, baseline=False, spool=None,
+                    claim_timeout=CLAIM_TIMEOUT, **tex2png_options):
+    """
+    Compile all (src_md, output_md) pairs with one global set of formulas.
+    batch, jobs, stats, trace, optimize, baseline, spool, claim_timeout:
+      see compile.compile()
+    Images are linked relative to the folder of each output file.
+    Unchanged outputs are skipped, see BuildGraph.
+    Returns an attrdict of build statistics.
+    """
+    with instrument(stats, trace):
+        return build_project(pairs, batch, jobs, optimize, baseline, 
+                             spool, claim_timeout, **tex2png_options)
+
+
+def build_project(pairs, batch, jobs, optimize=False, baseline=False,
+                  spool=None, claim_timeout=CLAIM_TIMEOUT, **tex2png_options):
+    outputs = [output_md for _, output_md in pairs]
+    assert len(set(outputs)) == len(outputs), \
+        'several sources compile to the same output file'
+    start = time.time()
+    all_jobs = {}
+    image_folder = tex2png_options['image_folder']
+    manifest = load_manifest(image_folder)
+    graph = BuildGraph(image_folder)
+    docs = []
+    skipped = 0
+    for src_md, output_md in pairs:
+        scan_start = time.time()
+        image_root = os.path.dirname(output_md) or os.curdir
+        options = build_options(tex2png_options, baseline, image_root)
+        regions = {}
+        if not tex2png_options['redraw']:
+            if graph.up_to_date(src_md, output_md, options, manifest):
+                skipped += 1
+                continue
+            regions = graph.regions(output_md, options, manifest)
+        doc = scan(src_md, all_jobs=all_jobs, graph=graph, regions=regions,
+                   **tex2png_options)
+        doc.output_md = output_md
+        doc.manifest = manifest
+        doc.baseline = baseline
+        doc.image_root = image_root
+        doc.options = options
+        doc.time = time.time() - scan_start
+        docs.append(doc)
+    scan_time = time.time() - start
+
+    render_start = time.time()
+    with stage('render'), RenderSession(pool_size=jobs) as session:
+        rendered = render_jobs(all_jobs.values(), batch=batch, n_jobs=jobs,
+                               manifest=manifest, session=session,
+                               spool=spool, claim_timeout=claim_timeout)
+    optimize_jobs(rendered, optimize, n_jobs=jobs, manifest=manifest)
+    render_variants(all_jobs.values(), rendered, n_jobs=jobs, 
+                    manifest=manifest)
+    render_time = time.time() - render_start
+    # a formula is accounted to the first file that uses it
+    rendered_by = {}
+    for job in rendered:
+        src_md = job.locations[0][0]
+        rendered_by[src_md] = rendered_by.get(src_md, 0) + 1
+
+    write_start = time.time()
+    # the images of the formulas, a formula used twice or with variants is
+    # counted once
+    all_formulas = set()
+    for doc in docs:
+        emit_start = time.time()
+        if os.path.dirname(doc.output_md):
+            os.makedirs(os.path.dirname(doc.output_md), exist_ok=True)
+        emit(doc, doc.output_md)
+        doc.time += time.time() - emit_start
+        formulas = {piece[0].png_file for piece in doc.pieces
+                    if not isinstance(piece, str)}
+        # formulas of the regions reused from the previous build
+        for _, _, region in doc.regions:
+            if region is not None:
+                formulas.update(region['formulas'])
+        all_formulas |= formulas
+        print('{} -> {}: {} formulas, {} rendered, {:.0f} ms'
+              .format(doc.src_md, doc.output_md, len(formulas),
+                      rendered_by.get(doc.src_md, 0), doc.time * 1000))
+    manifest.save()
+    graph.save()
+    write_time = time.time() - write_start
+
+    stats = attrdict(files=len(docs),
+                     up_to_date=skipped,
+                     formulas=len(all_formulas),
+                     unique=len(all_jobs),
+                     rendered=len(rendered),
+                     scan_time=scan_time,
+                     render_time=render_time,
+                     write_time=write_time,
+                     total_time=time.time() - start)
+    print('{files} files built, {up_to_date} up to date, {formulas} formulas, '
+          '{unique} unique, {rendered} rendered in {total_time:.2f}s '
+          '(scan {scan_time:.2f}s, render {render_time:.2f}s, write {write_time:.2f}s)'
+          .format(**stats))
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gitex project',
+                                     description='Build many GiTeX markdown '
+                                     'files, rendering each distinct formula '
+                                     'only once.')
+    parser.add_argument('paths', nargs='*',
+                        help='source files, directories or glob patterns')
+    parser.add_argument('-c', '--config',
+                        help='JSON project file listing sources and options')
+    parser.add_argument('-s', '--suffix', default=SOURCE_SUFFIX,
+                        help='suffix of source files, replaced by `.md` in '
+                        'the output file name')
+    add_arguments(parser)
+
+    args = parser.parse_args(argv)
+    pairs = []
+    if args.config:
+        pairs, options = load_config(args.config, args.suffix)
+        unknown = set(options) - (set(vars(args)) - {'paths', 'config'})
+        if unknown:
+            parser.error('unknown options in {}: {}'
+                         .format(args.config, ', '.join(sorted(unknown))))
+        # the command line overrides the project file
+        parser.set_defaults(**options)
+        args = parser.parse_args(argv)
+    pairs += find_sources(args.paths, args.suffix)
+    if not pairs:
+        parser.error('no source files, give paths or a --config file')
+
+    options = vars(args)
+    for key in ['paths', 'config', 'suffix']:
+        options.pop(key)
+    make_image_folder(options['image_folder'])
+    compile_project(pairs, **options)
@@ -0,0 +1,195 @@
+"""
+`gitex prune`: garbage collection of the image folder.
+Images are referenced by the compiled outputs: those given on the command
+line, whose `tex_<md5>` links are read, or else every output recorded in the
+build graph, which costs no file read. Without limits, every image that no
+output references is pruned. With `--max-size` or `--max-age`, e.g. for a
+cache shared by CI builds, unreferenced images are only evicted when unused
+for too long or, least recently used first, while the folder is too large.
+The last use comes from the manifest, see Manifest.touch().
+Images that a running build may not have recorded yet, locked or written in
+the last RECENT seconds, are never pruned. The build graph only knows the
+outputs of finished builds, so `--delete` without outputs is refused while
+a build holds locks in the folder, see gitex.atomic.
+Nothing is deleted without `--delete`.
+"""
+import os
+import re
+import time
+import argparse
+from gitex.manifest import Manifest
+from gitex.buildgraph import BuildGraph
+
+# name of a generated image
+image_name_re = re.compile(r'tex_[0-9a-f]{32}\.(?:png|svg)')
+# size suffixes of --max-size
+UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+# seconds, images written since are kept for the build that wrote them
+RECENT = 3600
+
+
+def parse_size(size):
+    """
+    '500M' -> bytes, also takes k and G and plain bytes.
+    """
+    match = re.match(r'^\s*([\d.]+)\s*([kmg]?)i?b?\s*$', str(size).lower())
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(size))
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def referenced_images(image_folder, outputs=None):
+    """
+    Names of the images referenced by `outputs`, or by the existing outputs
+    of the build graph if None.
+    """
+    names = set()
+    if outputs is not None:
+        for output_md in outputs:
+            with open(output_md) as f:
+                names.update(image_name_re.findall(f.read()))
+        return names
+    graph = BuildGraph(image_folder)
+    for output_md, entry in graph.outputs.items():
+        if not os.path.exists(output_md):
+            continue
+        for region in entry['regions'].values():
+            names.update(os.path.basename(png_file)
+                         for png_file in region['images'])
+    return names
+
+
+def busy_images(image_folder, now=None):
+    """
+    Returns (names of the images locked or written in the last RECENT 
+    seconds, whether any lock is held in the folder).
+    """
+    now = time.time() if now is None else now
+    busy = set()
+    locked = False
+    for entry in os.scandir(image_folder or os.curdir):
+        if entry.name.endswith('.lock'):
+            locked = True
+            busy.add(entry.name[:-len('.lock')])
+        elif image_name_re.fullmatch(entry.name):
+            try:
+                if now - entry.stat().st_mtime < RECENT:
+                    busy.add(entry.name)
+            except OSError:
+                pass
+    return busy, locked
+
+
+def list_images(image_folder, manifest):
+    """
+    Returns [(name, size in bytes, last use)] of the generated images.
+    The last use falls back to the file mtime for untracked images.
+    """
+    images = []
+    for entry in os.scandir(image_folder or os.curdir):
+        if not image_name_re.fullmatch(entry.name):
+            continue
+        stat = entry.stat()
+        record = manifest.entries.get(entry.name) or {}
+        used_at = record.get('used_at') or record.get('rendered_at')
+        images.append((entry.name, stat.st_size, used_at or stat.st_mtime))
+    return images
+
+
+def select_images(images, keep, max_size=None, max_age=None, now=None):
+    """
+    Images to prune, see the module doc.
+    images: see list_images()
+    keep: names of the referenced images, never pruned
+    max_size: bytes, max_age: seconds
+    """
+    now = time.time() if now is None else now
+    candidates = [image for image in images if image[0] not in keep]
+    if max_size is None and max_age is None:
+        return candidates
+    pruned = []
+    if max_age is not None:
+        pruned = [image for image in candidates if now - image[2] > max_age]
+    if max_size is not None:
+        total = sum(size for _, size, _ in images)
+        total -= sum(size for _, size, _ in pruned)
+        # least recently used first
+        for image in sorted(candidates, key=lambda image: image[2]):
+            if total <= max_size:
+                break
+            if image not in pruned:
+                pruned.append(image)
+                total -= image[1]
+    return pruned
+
+
+def prune(image_folder, outputs=None, max_size=None, max_age=None,
+          delete=False, verbose=False):
+    """
+    Report, or delete with `delete`, the images selected by select_images().
+    outputs: compiled markdown files, None for the outputs of the build graph
+    max_age: days
+    Returns (number of images, bytes) pruned.
+    """
+    manifest = Manifest(image_folder)
+    busy, locked = busy_images(image_folder)
+    if delete and outputs is None and locked:
+        raise Exception('A build is running in {}, its outputs are not in '
+                        'the build graph yet. Give the outputs, or try '
+                        'again later.'.format(image_folder or os.curdir))
+    keep = referenced_images(image_folder, outputs)
+    if not keep and max_size is None and max_age is None:
+        raise Exception('No compiled output references {}, give the '
+                        'outputs or --max-size/--max-age.'
+                        .format(image_folder or os.curdir))
+    images = list_images(image_folder, manifest)
+    pruned = select_images(images, keep | busy, max_size,
+                           None if max_age is None else max_age * 86400)
+    for name, size, used_at in pruned:
+        if verbose:
+            print('{} {} bytes, last used {}'.format(
+                name, size, time.strftime('%Y-%m-%d',
+                                          time.localtime(used_at))))
+        if delete:
+            png_file = os.path.join(image_folder, name)
+            os.remove(png_file)
+            manifest.drop(png_file)
+    if delete:
+        # also forget the images deleted by hand
+        for name in list(manifest.entries):
+            if not os.path.exists(os.path.join(image_folder, name)):
+                manifest.drop(name)
+        manifest.save()
+    n_bytes = sum(size for _, size, _ in pruned)
+    print('{} {} of {} images, {:.1f} MB, {} referenced.'.format(
+        'Deleted' if delete else 'Would delete', len(pruned), len(images),
+        n_bytes / (1 << 20), len(keep)))
+    return len(pruned), n_bytes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gitex prune',
+                                     description='Find the images of the '
+                                     'image folder that no compiled output '
+                                     'references, and delete them with '
+                                     '--delete.')
+    parser.add_argument('outputs', nargs='*',
+                        help='compiled markdown files, by default the '
+                        'outputs recorded in the build graph of the folder')
+    parser.add_argument('-i', '--image-folder', default='',
+                        help='folder of the generated images')
+    parser.add_argument('--max-size', type=parse_size, metavar='SIZE',
+                        help='only evict unreferenced images, least recently '
+                        'used first, while the folder is larger than SIZE, '
+                        'e.g. 500M or 2G')
+    parser.add_argument('--max-age', type=float, metavar='DAYS',
+                        help='only evict unreferenced images unused for more '
+                        'than DAYS days')
+    parser.add_argument('--delete', action='store_true',
+                        help='delete the images, by default they are only '
+                        'reported')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='list the images')
+    args = parser.parse_args(argv)
+    prune(args.image_folder, args.outputs or None, args.max_size,
+          args.max_age, args.delete, args.verbose)
@@ -0,0 +1,140 @@
+"""
+Color variants of a rendered formula, in-process and pure Python.
+dvipng antialiases by blending the foreground into the background, so every
+pixel of an image is a mix of its two colors. The mix ratio (the ink
+coverage) is read back from the master image and blended again with the
+colors of each variant, e.g. light-on-dark for dark themes. No latex or
+dvipng runs for a variant.
+PNG variants are written with a palette of one color per gray level of the
+master. SVG variants are painted again, see tex2png.paint_svg_data().
+"""
+import re
+import argparse
+from gitex.pngopt import decode, encode, pack_samples
+from gitex.imgsize import svg_tag_re
+from gitex.tex2png import rgb_arg, css_color, paint_svg_data
+from gitex.stats import stage, count
+from gitex.atomic import write_file
+
+# painting of tex2png.paint_svg_data(), removed before painting again
+painted_fill_re = re.compile(rb"^<svg fill='#[0-9a-f]{6}'")
+painted_rect_re = re.compile(rb"^<rect x='[^']*' y='[^']*' width='[^']*' "
+                             rb"height='[^']*' fill='#[0-9a-f]{6}'/>")
+
+
+def parse_variant(spec):
+    """
+    `NAME=FOREGROUND:BACKGROUND` -> (name, foreground, background), colors
+    as in tex2png(), e.g. `dark=white:rgb 13 17 23`
+    """
+    try:
+        name, colors = spec.split('=', 1)
+        foreground, background = colors.split(':')
+        for color in [foreground, background]:
+            rgb_arg(color.strip())
+    except (ValueError, AssertionError):
+        raise argparse.ArgumentTypeError(
+            'invalid variant `{}`, expected NAME=FOREGROUND:BACKGROUND'
+            .format(spec))
+    return name.strip(), foreground.strip(), background.strip()
+
+
+def variant_file(output_file, name):
+    # `formula.png` -> `formula-dark.png`
+    stem, dot, ext = output_file.rpartition('.')
+    if not dot:
+        return '{}-{}'.format(output_file, name)
+    return '{}-{}.{}'.format(stem, name, ext)
+
+
+def color_values(color):
+    # tex2png color, e.g. `gold` or `rgb 1 0.5 0`, to an (r, g, b) of bytes
+    value = css_color(rgb_arg(color))
+    return tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+
+
+def recolor_png(data, foreground, background, variants):
+    """
+    PNG `data` rendered with `foreground` on `background`, recolored with
+    each (foreground, background) of `variants`.
+    Returns the list of PNG data, in the order of `variants`.
+    """
+    image = decode(data)
+    if image is None:
+        raise Exception('Cannot recolor this PNG image, 16-bit or '
+                        'interlaced images are not supported.')
+    width, height, rgba = image
+    foreground = color_values(foreground)
+    background = color_values(background)
+    # the channel that tells the two colors apart best
+    channel = max(range(3), key=lambda c: abs(foreground[c] - background[c]))
+    low, high = background[channel], foreground[channel]
+    assert low != high, 'foreground and background colors are the same'
+    coverage = bytes(min(255, max(0, int(round((level - low) * 255 
+                                                / (high - low)))))
+                     for level in range(256))
+    return paint_mask(width, height, rgba[channel::4].translate(coverage),
+                      variants)
+
+
+def paint_mask(width, height, mask, variants):
+    """
+    PNG images of a coverage `mask`, one byte per pixel from 0 (background)
+    to 255 (foreground), painted with each (foreground, background) of 
+    `variants`.
+    """
+    levels = sorted(set(mask))
+    # one palette index per level
+    table = bytearray(256)
+    for i, level in enumerate(levels):
+        table[level] = i
+    samples = mask.translate(bytes(table))
+    bit_depth = next(depth for depth in (1, 2, 4, 8)
+                     if len(levels) <= 1 << depth)
+    rows = [samples[y * width:(y + 1) * width] for y in range(height)]
+    if bit_depth < 8:
+        rows = [pack_samples(row, bit_depth) for row in rows]
+    images = []
+    for foreground, background in variants:
+        foreground = color_values(foreground)
+        background = color_values(background)
+        palette = bytes(int(round(back + level * (fore - back) / 255))
+                        for level in levels
+                        for fore, back in zip(foreground, background))
+        images.append(encode(width, height, bit_depth, 3, rows,
+                             [(b'PLTE', palette)]))
+    return images
+
+
+def recolor_svg(data, variants):
+    """
+    SVG `data` painted by tex2png.paint_svg_data(), painted again with each
+    (foreground, background) of `variants`.
+    """
+    match = svg_tag_re.search(data)
+    if match:
+        tag = painted_fill_re.sub(b'<svg', match.group())
+        rest = painted_rect_re.sub(b'', data[match.end():])
+        data = data[:match.start()] + tag + rest
+    return [paint_svg_data(data, rgb_arg(foreground), rgb_arg(background))
+            for foreground, background in variants]
+
+
+def recolor_file(image_file, foreground, background, variants):
+    """
+    Write the color variants of `image_file`, a PNG or SVG image rendered
+    with `foreground` on `background`.
+    variants: list of (output file, foreground, background)
+    """
+    with open(image_file, 'rb') as f:
+        data = f.read()
+    colors = [(new_foreground, new_background)
+              for _, new_foreground, new_background in variants]
+    with stage('recolor', image_file=image_file):
+        if image_file.endswith('.svg'):
+            images = recolor_svg(data, colors)
+        else:
+            images = recolor_png(data, foreground, background, colors)
+    count('recolor.images', len(images))
+    for (output_file, _, _), image in zip(variants, images):
+        write_file(output_file, image)
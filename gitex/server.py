@@ -0,0 +1,322 @@
+"""
+Local HTTP render service, `gitex serve`.
+GET /render?formula=x%5E2&math_mode=inline&dpi=200 returns the image, so does
+POST /render with a JSON object of the same parameters. GET /stats returns
+the cache counters as JSON.
+Images are looked up in an in-memory LRU, then in the image folder
+(`tex_<md5>.png`, the same files `gitex` generates), and only then rendered.
+"""
+import os
+import json
+import threading
+import argparse
+import subprocess as pc
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from gitex.tex2png import (tex2png_image, attrdict, RenderSession, FORMATS,
+                           rgb_arg)
+from gitex.imgsize import get_png_size, get_svg_size
+from gitex.compile import gen_job, save_image, load_manifest
+
+# request parameters besides `formula`
+REQUEST_OPTIONS = ['math_mode', 'dpi', 'packages', 'foreground', 'background',
+                   'format']
+MATH_MODES = ['inline', 'display', 'headless', 'none']
+CONTENT_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+COLOR_OPTIONS = ['foreground', 'background']
+
+
+def check_color(color):
+    """
+    False unless `color` is a color name or `rgb <R> <G> <B>`, see rgb_arg().
+    """
+    try:
+        rgbs = rgb_arg(color).split()
+        [float(value) for value in rgbs[1:]]
+    except (AttributeError, AssertionError, ValueError):
+        return False
+    return rgbs[0] == 'rgb'
+
+
+class LRUCache(object):
+    """
+    Thread-safe, holds at most `capacity` items.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+
+class RenderService(object):
+    """
+    Thread-safe formula renderer behind the HTTP handler.
+    cache_size: number of images kept in memory
+    max_renders: number of renders running at once
+    dpi: default resolution
+    precompile, worker: see tex2png()
+    Identical requests in flight are coalesced into a single render.
+    """
+    def __init__(self, image_folder='', cache_size=256, max_renders=4,
+                 dpi=200, precompile=False, worker=False):
+        self.image_folder = image_folder
+        self.dpi = dpi
+        self.render_options = dict(precompile=precompile, worker=worker)
+        self.memory = LRUCache(cache_size)
+        self.session = RenderSession(pool_size=max_renders)
+        self.semaphore = threading.BoundedSemaphore(max_renders)
+        # image file -> Future of the render in flight
+        self.inflight = {}
+        self.lock = threading.Lock()
+        # only read, for the depth of images rendered by earlier builds
+        self.manifest = load_manifest(image_folder)
+        self.counters = dict(requests=0, memory_hits=0, disk_hits=0,
+                             renders=0, coalesced=0, errors=0)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, inflight=len(self.inflight))
+
+    def render(self, formula, math_mode='inline', **options):
+        """
+        options: tex2png() options, `dpi` defaults to the service DPI
+        Returns the image, see tex2png_image()
+        """
+        self.count('requests')
+        options.setdefault('dpi', self.dpi)
+        job, _, _ = gen_job(formula, math_mode, image_folder=self.image_folder,
+                            redraw=False, **options)
+        key = job.png_file
+        image = self.memory.get(key)
+        if image is not None:
+            self.count('memory_hits')
+            return image
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+            else:
+                self.counters['coalesced'] += 1
+        if not owner:
+            return future.result()
+        try:
+            image = self.load(job.png_file)
+            if image is None:
+                image = self.render_job(job)
+            self.memory.put(key, image)
+            future.set_result(image)
+            return image
+        except Exception as exc:
+            self.count('errors')
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def load(self, png_file):
+        # image generated before, by this service or by `gitex`
+        try:
+            with open(png_file, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if png_file.endswith('.svg'):
+            size = get_svg_size(data)
+        else:
+            size = get_png_size(data)
+        if size is None:
+            return None
+        self.count('disk_hits')
+        entry = self.manifest.entries.get(os.path.basename(png_file)) or {}
+        depth = entry.get('depth') if entry.get('size') == len(data) else None
+        return attrdict(data=data, width=size[0], height=size[1], depth=depth)
+
+    def render_job(self, job):
+        options = job.options.copy()
+        options.pop('output_file')
+        options.update(self.render_options)
+        with self.semaphore:
+            self.count('renders')
+            image = tex2png_image(session=self.session, **options)
+        save_image(job.png_file, image.data)
+        return image
+
+    def close(self):
+        self.session.close()
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    server_version = 'GiTeX'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/render':
+            params = {key: values[-1]
+                      for key, values in parse_qs(url.query).items()}
+            self.handle_render(params)
+        elif url.path == '/stats':
+            self.send(200, json.dumps(self.server.service.stats()).encode(),
+                      'application/json')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/render':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length).decode('utf-8'))
+            assert isinstance(params, dict)
+        except (ValueError, AssertionError):
+            self.send_error(400, 'Body must be a JSON object')
+            return
+        self.handle_render(params)
+
+    def handle_render(self, params):
+        formula = params.pop('formula', None)
+        if not formula:
+            self.send_error(400, 'Missing `formula`')
+            return
+        if not isinstance(formula, str):
+            self.send_error(400, '`formula` must be a string')
+            return
+        unknown = set(params) - set(REQUEST_OPTIONS)
+        if unknown:
+            self.send_error(400, 'Unknown parameters: {}'
+                            .format(', '.join(sorted(unknown))))
+            return
+        if params.get('math_mode', 'inline') not in MATH_MODES:
+            self.send_error(400, 'math_mode must be one of {}'
+                            .format(', '.join(MATH_MODES)))
+            return
+        if params.get('format', 'png') not in FORMATS:
+            self.send_error(400, 'format must be one of {}'
+                            .format(', '.join(FORMATS)))
+            return
+        if 'dpi' in params:
+            try:
+                params['dpi'] = int(params['dpi'])
+                assert 10 <= params['dpi'] <= 4000
+            except (ValueError, AssertionError):
+                self.send_error(400, 'dpi must be an integer in [10, 4000]')
+                return
+        for name in COLOR_OPTIONS:
+            if name in params and not check_color(params[name]):
+                self.send_error(400, '{} must be a color name or '
+                                '`rgb <R> <G> <B>`'.format(name))
+                return
+        if not isinstance(params.get('packages', ''), str):
+            self.send_error(400, 'packages must be a string')
+            return
+        try:
+            image = self.server.service.render(formula, **params)
+        except pc.CalledProcessError as exc:
+            # LaTeX error, the log goes back to the client
+            self.send(422, exc.output or b'render failed',
+                      'text/plain; charset=utf-8')
+            return
+        except Exception as exc:
+            # e.g. a missing TeX binary, the connection must not just drop
+            self.send(500, '{}: {}'.format(type(exc).__name__, exc).encode(),
+                      'text/plain; charset=utf-8')
+            return
+        headers = {'X-Gitex-Width': image.width,
+                   'X-Gitex-Height': image.height}
+        if image.depth is not None:
+            headers['X-Gitex-Depth'] = image.depth
+        self.send(200, image.data, 
+                  CONTENT_TYPES[params.get('format', 'png')], headers)
+
+    def send(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class RenderServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections of concurrent clients
+    request_queue_size = 128
+
+
+def make_server(host='127.0.0.1', port=0, verbose=False, **service_options):
+    """
+    HTTP server with a RenderService, port 0 picks a free port.
+    service_options: see RenderService
+    """
+    server = RenderServer((host, port), RenderHandler)
+    server.service = RenderService(**service_options)
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gitex serve',
+                                     description='Render formulas over HTTP.')
+    parser.add_argument('-H', '--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8765,
+                        help='port to listen on')
+    parser.add_argument('-i', '--image-folder', default='',
+                        help='folder of the on-disk image cache')
+    parser.add_argument('-d', '--dpi', type=int, default=200,
+                        help='default DPI of the images')
+    parser.add_argument('-c', '--cache-size', type=int, default=256,
+                        help='number of images cached in memory')
+    parser.add_argument('-j', '--max-renders', type=int,
+                        default=os.cpu_count() or 4,
+                        help='number of renders running at once')
+    parser.add_argument('-P', '--precompile', action='store_true',
+                        help='load the LaTeX preamble from a cached '
+                        'precompiled format')
+    parser.add_argument('-w', '--worker', action='store_true',
+                        help='render on resident LaTeX processes')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args(argv)
+    if args.image_folder:
+        os.makedirs(args.image_folder, exist_ok=True)
+
+    server = make_server(**vars(args))
+    print('GiTeX render service on http://{}:{}/render'
+          .format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
@@ -0,0 +1,310 @@
+"""
+Spool directory: a render queue on a filesystem shared by several build
+hosts, e.g. an NFS mount.
+`gitex --spool DIR` (the coordinator) writes a job file for every missing
+image into DIR/queue, then waits. `gitex worker DIR`, on any number of
+hosts, claims jobs by renaming them into DIR/claimed, renders them with
+tex2png and publishes the image, then the result in DIR/done. A rename is
+atomic within one filesystem, also on NFS, so each job is claimed once.
+A claim that isn't done within the claim timeout, e.g. of a worker that
+died, goes back to the queue. Claims are named after their worker,
+`<job>.<worker token>`, so that a slow worker finishing a job that was
+queued again never removes the claim of the worker that took it over.
+Images and results are written to a temporary file, then renamed into
+place, so nobody reads half a file.
+Jobs are named after their image, `tex_<md5>.json`: a formula is queued
+once, whatever the number of coordinators waiting for it. Image paths are
+relative to the spool directory, so that hosts may mount the share at
+different paths.
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from gitex.tex2png import tex2png_image, attrdict, RenderSession
+from gitex.stats import stage, count
+from gitex.atomic import write_file, remove
+
+QUEUE, CLAIMED, DONE = 'queue', 'claimed', 'done'
+# seconds between two looks at the spool directory
+POLL_INTERVAL = 0.2
+# seconds before the claim of a silent worker is given to another one
+CLAIM_TIMEOUT = 120
+# job options that each worker chooses for itself
+WORKER_OPTIONS = ['precompile', 'worker', 'dvi_cache']
+
+
+def spool_path(spool, state, name=''):
+    return os.path.join(spool, state, name)
+
+
+def make_spool(spool):
+    for state in [QUEUE, CLAIMED, DONE]:
+        os.makedirs(spool_path(spool, state), exist_ok=True)
+
+
+def job_name(png_file):
+    # `img/tex_<md5>.png` -> `tex_<md5>.json`
+    return os.path.splitext(os.path.basename(png_file))[0] + '.json'
+
+
+def claim_job(claim_name):
+    # `tex_<md5>.json.<worker token>` -> `tex_<md5>.json`
+    return claim_name[:claim_name.index('.json') + len('.json')]
+
+
+def list_claims(spool):
+    # job name -> names of its claims
+    claims = {}
+    for claim_name in os.listdir(spool_path(spool, CLAIMED)):
+        if '.json.' in claim_name:
+            claims.setdefault(claim_job(claim_name), []).append(claim_name)
+    return claims
+
+
+def write_json(path, data):
+    write_file(path, json.dumps(data))
+
+
+def read_json(path):
+    # None if `path` doesn't exist (anymore)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def submit(spool, job):
+    # queue a job of compile.gen_job()
+    options = {key: value for key, value in job.options.items()
+               if key not in ['formula', 'output_file', 'math_mode']
+               + WORKER_OPTIONS}
+    write_json(spool_path(spool, QUEUE, job_name(job.png_file)),
+               dict(formula=job.formula, math_mode=job.math_mode,
+                    options=options,
+                    output_file=os.path.relpath(job.png_file, spool)))
+    count('spool.submitted')
+
+
+def render_spool(jobs, spool, claim_timeout=CLAIM_TIMEOUT):
+    """
+    Coordinator: queue `jobs` and wait until workers rendered all of them.
+    Claims older than `claim_timeout` seconds go back to the queue.
+    Returns [(exception, render time, image)] in the order of `jobs`, see
+    compile.render_jobs(). The image is None if another coordinator
+    collected the result, the manifest reads the image then.
+    """
+    make_spool(spool)
+    pending = {job_name(job.png_file): job for job in jobs}
+    for name, job in pending.items():
+        if not any(os.path.exists(spool_path(spool, state, name))
+                   for state in [QUEUE, CLAIMED, DONE]):
+            submit(spool, job)
+    print('Queued {} formulas in {}, waiting for `gitex worker {}`.'
+          .format(len(pending), spool, spool))
+    results = {}
+    with stage('spool', formulas=len(pending)):
+        while pending:
+            # states are listed in the order jobs go through them, so that
+            # a job moving on meanwhile is never missed
+            queued = set(os.listdir(spool_path(spool, QUEUE)))
+            claims = list_claims(spool)
+            for name, job in list(pending.items()):
+                if name in queued:
+                    continue
+                if name in claims:
+                    for claim_name in claims[name]:
+                        requeue(spool, claim_name, claim_timeout, job)
+                    continue
+                done = spool_path(spool, DONE, name)
+                result = read_json(done)
+                if result is not None:
+                    remove(done)
+                elif os.path.exists(job.png_file):
+                    # collected by another coordinator
+                    result = {}
+                else:
+                    submit(spool, job)
+                    continue
+                results[name] = result
+                del pending[name]
+            if pending:
+                time.sleep(POLL_INTERVAL)
+
+    outcomes = []
+    for job in jobs:
+        result = results[job_name(job.png_file)]
+        exc, image = None, None
+        if 'error' in result:
+            print('Worker {} failed to render {} formula `{}`:\n{}'.format(
+                result['worker'], job.math_mode, job.formula,
+                result['error']))
+            exc = Exception('{} formula `{}` failed to render'
+                            .format(job.math_mode, job.formula))
+        elif 'width' in result:
+            image = attrdict(data=None, width=result['width'],
+                             height=result['height'], depth=result['depth'])
+        outcomes.append((exc, result.get('render_time', 0), image))
+    return outcomes
+
+
+def requeue(spool, claim_name, claim_timeout, job):
+    # coordinator: queue a claim again if it is older than `claim_timeout`
+    claimed = spool_path(spool, CLAIMED, claim_name)
+    try:
+        if time.time() - os.stat(claimed).st_mtime <= claim_timeout:
+            return
+        os.rename(claimed, spool_path(spool, QUEUE, claim_job(claim_name)))
+    except OSError:
+        # done or queued again meanwhile
+        return
+    count('spool.requeued')
+    print('Claim of `{}` timed out, queued again.'.format(job.formula))
+
+
+def claim(spool, token):
+    """
+    Worker: move a queued job to the claims, as `<job>.<token>`. Returns
+    the name of the claim, None if the queue is empty.
+    """
+    queue = spool_path(spool, QUEUE)
+    for name in sorted(os.listdir(queue)):
+        if not name.endswith('.json'):
+            continue
+        claim_name = '{}.{}'.format(name, token)
+        claimed = spool_path(spool, CLAIMED, claim_name)
+        try:
+            os.rename(os.path.join(queue, name), claimed)
+        except OSError:
+            # claimed by another worker
+            continue
+        try:
+            # start of the claim timeout, rename keeps the submit time
+            os.utime(claimed)
+        except OSError:
+            # queued again already
+            continue
+        return claim_name
+    return None
+
+
+def error_message(exc):
+    # the LaTeX log of a failed render, the exception otherwise
+    output = getattr(exc, 'output', None)
+    if output:
+        return output.decode('utf-8', 'replace')[-2000:]
+    return '{}: {}'.format(type(exc).__name__, exc)
+
+
+def process(spool, claim_name, session, worker_id, **render_options):
+    """
+    Worker: render a claimed job, publish the image and then the result.
+    """
+    claimed = spool_path(spool, CLAIMED, claim_name)
+    record = read_json(claimed)
+    if record is None:
+        # queued again by a coordinator meanwhile
+        return
+    output_file = os.path.join(spool, record['output_file'])
+    start = time.time()
+    try:
+        image = tex2png_image(record['formula'], record['math_mode'],
+                              session=session,
+                              **dict(record['options'], **render_options))
+        write_file(output_file, image.data)
+        result = dict(width=image.width, height=image.height,
+                      depth=image.depth)
+    except Exception as exc:
+        result = dict(error=error_message(exc))
+    result.update(worker=worker_id, render_time=time.time() - start)
+    write_json(spool_path(spool, DONE, claim_job(claim_name)), result)
+    # only this claim: if the job was queued again meanwhile, the claim of
+    # the worker that took it over has another name
+    remove(claimed)
+
+
+def work(spool, jobs=1, idle_exit=None, **render_options):
+    """
+    Worker loop: claim and render up to `jobs` formulas at once, until
+    interrupted, or idle for `idle_exit` seconds.
+    render_options: see WORKER_OPTIONS
+    Returns the number of formulas processed.
+    """
+    make_spool(spool)
+    worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    # unique claim names, also after a requeue to this same worker
+    tokens = ('{}-{}-{}'.format(socket.gethostname(), os.getpid(), i)
+              for i in itertools.count())
+    processed = 0
+    idle_since = time.time()
+    in_flight = set()
+    lock = threading.Lock()
+
+    def run(name):
+        try:
+            process(spool, name, session, worker_id, **render_options)
+        finally:
+            with lock:
+                in_flight.discard(name)
+
+    print('Worker {} polling {}, Ctrl-C to stop.'.format(worker_id, spool))
+    try:
+        with RenderSession(pool_size=jobs) as session, \
+                ThreadPoolExecutor(jobs) as pool:
+            while True:
+                names = []
+                while len(names) < jobs:
+                    name = claim(spool, next(tokens))
+                    if name is None:
+                        break
+                    names.append(name)
+                if not names:
+                    if (idle_exit is not None
+                            and time.time() - idle_since > idle_exit):
+                        break
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                with lock:
+                    in_flight.update(names)
+                list(pool.map(run, names))
+                processed += len(names)
+                idle_since = time.time()
+    except KeyboardInterrupt:
+        # give the unfinished claims back
+        for name in list(in_flight):
+            try:
+                os.rename(spool_path(spool, CLAIMED, name),
+                          spool_path(spool, QUEUE, claim_job(name)))
+            except OSError:
+                pass
+    print('Worker {} rendered {} formulas.'.format(worker_id, processed))
+    return processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gitex worker',
+                                     description='Render the formulas that '
+                                     '`gitex --spool SPOOL` queues, on any '
+                                     'host that mounts the spool directory '
+                                     'and the image folder.')
+    parser.add_argument('spool', help='spool directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of formulas rendered in parallel')
+    parser.add_argument('--idle-exit', type=float, metavar='SECS',
+                        help='exit once the queue has been empty for SECS '
+                        'seconds, by default run until Ctrl-C')
+    parser.add_argument('-P', '--precompile', action='store_true',
+                        help='load the LaTeX preamble from a cached '
+                        'precompiled format')
+    parser.add_argument('-w', '--worker', action='store_true',
+                        help='render on resident LaTeX processes')
+    parser.add_argument('--no-dvi-cache', dest='dvi_cache',
+                        action='store_false',
+                        help='always run latex')
+    args = parser.parse_args(argv)
+    work(**vars(args))
@@ -0,0 +1,158 @@
+"""
+Build instrumentation: wall time per stage and per formula, cache hits and
+misses and subprocess counts.
+Disabled unless a Recorder is installed with enable(). While disabled,
+stage() returns a shared no-op context manager and count() returns at once.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+_recorder = None
+_null_stage = contextlib.nullcontext()
+
+
+class Recorder(object):
+    """
+    stages: name -> [calls, total seconds]
+    counters: name -> count
+    formulas: list of (seconds, formula, math_mode, locations)
+    events: Chrome trace events, None if no trace is kept
+    """
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.formulas = []
+        self.events = [] if trace else None
+
+    def add_stage(self, name, start, elapsed, args):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.])
+            stage[0] += 1
+            stage[1] += elapsed
+            if self.events is not None:
+                # complete event, timestamps in microseconds
+                self.events.append({'name': name,
+                                    'cat': 'gitex',
+                                    'ph': 'X',
+                                    'ts': (start - self.start) * 1e6,
+                                    'dur': elapsed * 1e6,
+                                    'pid': os.getpid(),
+                                    'tid': threading.get_ident(),
+                                    'args': args})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_formula(self, job, elapsed):
+        with self.lock:
+            self.formulas.append((elapsed, job.formula, job.math_mode,
+                                  list(job.locations)))
+
+    def report(self, top=10):
+        total = time.perf_counter() - self.start
+        lines = ['Build stats: {:.3f}s total'.format(total),
+                 '{:20s} {:>7s} {:>10s} {:>10s}'
+                 .format('stage', 'calls', 'total', 'mean')]
+        for name, (calls, seconds) in sorted(self.stages.items(),
+                                             key=lambda item: -item[1][1]):
+            lines.append('{:20s} {:7d} {:9.3f}s {:8.2f}ms'
+                         .format(name, calls, seconds, seconds / calls * 1000))
+        if self.counters:
+            lines.append(', '.join('{} {}'.format(name, n) for name, n
+                                   in sorted(self.counters.items())))
+        if self.formulas and top:
+            lines.append('Slowest {} formulas:'.format(
+                min(top, len(self.formulas))))
+            for elapsed, formula, math_mode, locations in sorted(
+                    self.formulas, key=lambda f: -f[0])[:top]:
+                where = ', '.join('{}:{}'.format(*location)
+                                  for location in locations[:3])
+                if len(locations) > 3:
+                    where += ', ...'
+                lines.append('{:9.1f}ms  {}  {} `{}`'.format(
+                    elapsed * 1000, where or '-', math_mode,
+                    formula.strip().replace('\n', ' ')[:60]))
+        return '\n'.join(lines)
+
+    def write_trace(self, path):
+        # Chrome trace format, open in chrome://tracing or Perfetto
+        with self.lock:
+            trace = {'traceEvents': self.events or [],
+                     'displayTimeUnit': 'ms',
+                     'otherData': {'counters': self.counters}}
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+
+
+class Stage(object):
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add_stage(self.name, self.start,
+                                time.perf_counter() - self.start, self.args)
+
+
+def enable(trace=False):
+    global _recorder
+    _recorder = Recorder(trace)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def stage(name, **args):
+    """
+    with stage('latex'): ...
+    `args` only go to the trace.
+    """
+    if _recorder is None:
+        return _null_stage
+    return Stage(_recorder, name, args)
+
+
+def count(name, n=1):
+    if _recorder is not None:
+        _recorder.count(name, n)
+
+
+def record_formula(job, elapsed):
+    # render time of a compile job, see compile.render_jobs()
+    if _recorder is not None:
+        _recorder.add_formula(job, elapsed)
+
+
+@contextlib.contextmanager
+def instrument(stats=0, trace=None):
+    """
+    Record everything inside the `with` block.
+    stats: print a report with the `stats` slowest formulas at the end
+    trace: write a Chrome trace to this file at the end
+    """
+    if not stats and not trace:
+        yield None
+        return
+    recorder = enable(trace=bool(trace))
+    try:
+        yield recorder
+    finally:
+        disable()
+        if stats:
+            print(recorder.report(stats))
+        if trace:
+            recorder.write_trace(trace)
@@ -3,11 +3,57 @@
 @author: jimfan
 """
 import os
+import re
+import json
 import shutil
+import hashlib
+import sys
+import time
 import argparse
 import tempfile
+import threading
 import subprocess as pc
 from gitex.colors import CSS3_COLOR_RGB
+from gitex.imgsize import get_png_size, get_svg_size, svg_tag_re
+from gitex.pngopt import optimize_file
+from gitex.dvi import DviReader
+from gitex.stats import stage, count
+from gitex.atomic import write_file, publish_file, temp_path, remove
+
+# precompiled LaTeX formats: format key -> format name, or None if failed
+_formats = {}
+# format key -> lock held while that format is dumped
+_format_locks = {}
+_formats_lock = threading.Lock() # guards both dicts, never held for a dump
+# program -> first line of `<program> --version`
+_versions = {}
+# bytes written to the DVI cache by this process since its last trim
+_dvi_stored = 0
+_dvi_stored_lock = threading.Lock()
+
+# image formats: png from dvipng, resolution independent svg from dvisvgm
+FORMATS = ['png', 'svg']
+# `optimize` levels: the in-process pass of gitex.pngopt, then also optipng
+OPTIMIZERS = ['python', 'optipng']
+# the exhaustive -zc1-9 -zm1-9 -zs0-3 -f0-5 search is far too slow per image
+OPTIPNG_ARGS = ['-o2', '-quiet']
+# checkmsg of get_binary() for the programs of every TeX distribution
+INSTALL_TEX = 'Install MacTeX: http://www.tug.org/mactex/'
+# version of the DVI cache keys, bumped when the DVI of a formula changes,
+# 2: batch pages and worker jobs reset the LaTeX counters
+DVI_VERSION = 2
+# bytes, the DVI cache evicts its least recently used files beyond, see
+# trim_dvi_cache(), overridden by $GITEX_DVI_CACHE_SIZE, e.g. `200M`
+DVI_CACHE_SIZE = 1 << 30
+# seconds between two trims of the DVI cache, unless much was written since
+DVI_TRIM_INTERVAL = 3600
+# defines \gitexresetcounters, which zeroes every LaTeX counter but the page
+# number. Counters are global, e.g. equation numbers would otherwise carry
+# over from one formula to the next of a batch or of a worker.
+RESET_COUNTERS = (r"\makeatletter\def\gitexresetcounters{\begingroup"
+                  r"\count@=\c@page"
+                  r"\def\@elt##1{\global\csname c@##1\endcsname\z@}"
+                  r"\cl@@ckpt\global\c@page=\count@\endgroup}\makeatother")
 
 
 class attrdict(dict):
@@ -17,23 +63,336 @@ class attrdict(dict):
 
 
 def get_binary(program, checkmsg=''):
-    binary = shutil.which(program)
+    """
+    Full path of `program`. Folders in $GITEX_BIN_PATH are searched before
+    $PATH, e.g. to substitute the fake toolchain of benchmarks/fake_tex.
+    """
+    binary = None
+    if os.environ.get('GITEX_BIN_PATH'):
+        binary = shutil.which(program, path=os.environ['GITEX_BIN_PATH'])
+    binary = binary or shutil.which(program)
     if checkmsg and not binary:
         raise Exception('Required program {} not found. {}'
                         .format(program, checkmsg))
     return binary
 
 
-def gen_latex_file(temp_dir, formula, packages, math_mode):
+def get_scratch_root():
+    # $GITEX_SCRATCH_DIR, defaults to RAM-backed /dev/shm when available
+    scratch_root = os.environ.get('GITEX_SCRATCH_DIR')
+    if scratch_root:
+        os.makedirs(scratch_root, exist_ok=True)
+        return scratch_root
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def clean_dir(folder):
+    # remove everything inside `folder`, but keep `folder` itself
+    for entry in os.scandir(folder):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+class RenderSession(object):
+    """
+    Toolchain and scratch directories shared by many tex2png() calls.
+    The binaries are resolved once, on their first use, so that a build
+    that renders nothing (or only with in-process backends) doesn't need
+    TeX. Up to `pool_size` scratch directories are kept, see
+    get_scratch_root(), and emptied between jobs instead of being
+    recreated. Use it as a context manager or call close().
+    """
+    def __init__(self, pool_size=8, scratch_root=None):
+        self.binaries = {}
+        self.scratch_root = scratch_root or get_scratch_root()
+        self.pool_size = pool_size
+        self.idle_dirs = []
+        self.lock = threading.Lock()
+
+    def binary(self, program, checkmsg=''):
+        # see get_binary(), a missing program is looked up again next time
+        if not self.binaries.get(program):
+            self.binaries[program] = get_binary(program, checkmsg)
+        return self.binaries[program]
+
+    @property
+    def latex(self):
+        return self.binary('latex', INSTALL_TEX)
+
+    @property
+    def dvipng(self):
+        return self.binary('dvipng', INSTALL_TEX)
+
+    @property
+    def dvisvgm(self):
+        # only required by the svg format
+        return self.binary('dvisvgm')
+
+    def acquire_dir(self):
+        with self.lock:
+            if self.idle_dirs:
+                return self.idle_dirs.pop()
+        return tempfile.mkdtemp('gitex', dir=self.scratch_root)
+
+    def release_dir(self, temp_dir):
+        # a failed run removes its directory
+        if not os.path.isdir(temp_dir):
+            return
+        with self.lock:
+            keep = len(self.idle_dirs) < self.pool_size
+        if not keep:
+            shutil.rmtree(temp_dir)
+            return
+        clean_dir(temp_dir)
+        with self.lock:
+            self.idle_dirs.append(temp_dir)
+
+    def close(self):
+        with self.lock:
+            idle_dirs, self.idle_dirs = self.idle_dirs, []
+        for temp_dir in idle_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_version(program):
+    # first line of `<program> --version`, computed once
+    if program not in _versions:
+        binary = get_binary(program)
+        try:
+            output = pc.check_output([binary, '--version'], stderr=pc.STDOUT)
+            _versions[program] = output.decode('utf-8').strip().splitlines()[0]
+        except (TypeError, OSError, IndexError, pc.CalledProcessError):
+            _versions[program] = program + ' unknown'
+    return _versions[program]
+
+
+def get_cache_dir(*subdirs):
+    # $GITEX_CACHE_DIR, defaults to ~/.cache/gitex
+    cache_dir = os.environ.get('GITEX_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'gitex')
+    cache_dir = os.path.join(cache_dir, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_delimiter(math_mode):
     # math_mode: 'inline', 'display', 'headless', or 'none'
     if math_mode == 'inline':
-        delimiter = '$'
+        return '$'
     elif math_mode == 'display':
-        delimiter = '$$'
+        return '$$'
     else:
-        delimiter = '\n'
+        return '\n'
+
+
+def gen_preamble(packages):
     packages = packages.replace('+', ',') # alternative `+` separated list
     packages = 'amsmath,amssymb,' + packages # ams pkgs will always be included
+    return (r"\documentclass[12pt]{{article}}"
+            r"\usepackage{{{_packages}}}\pagestyle{{empty}}"
+            .format(_packages=packages))
+
+
+def dump_format(packages):
+    """
+    Precompile the preamble of `packages` into a LaTeX format (.fmt), cached
+    on disk and keyed by the package list and the TeX version.
+    Returns the format name to pass to `latex -fmt`, or None if the preamble 
+    cannot be dumped (some packages don't support it).
+    """
+    preamble = gen_preamble(packages)
+    key = md5(preamble + get_version('latex'))
+    fmt_name = 'gitex_' + key
+    with _formats_lock:
+        if key in _formats:
+            return _formats[key]
+        key_lock = _format_locks.setdefault(key, threading.Lock())
+    # builds needing other package sets don't wait for this dump
+    with key_lock:
+        with _formats_lock:
+            if key in _formats: # dumped while we waited for key_lock
+                return _formats[key]
+        fmt_dir = get_cache_dir('fmt')
+        if not os.path.exists(os.path.join(fmt_dir, fmt_name + '.fmt')):
+            latex = get_binary('latex', INSTALL_TEX)
+            temp_dir = tempfile.mkdtemp('gitex')
+            temp_tex = os.path.join(temp_dir, fmt_name + '.tex')
+            with open(temp_tex, 'w') as f:
+                # LaTeX may have redefined \dump, the primitive is \@@dump
+                print(preamble + r"\makeatletter\ifx\@@dump\undefined"
+                      r"\makeatother\expandafter\dump"
+                      r"\else\makeatother\expandafter\@@dump\fi", 
+                      end='', file=f)
+            try:
+                count('subprocess.latex')
+                with stage('dump_format'):
+                    pc.check_output([latex, '-ini', 
+                                     '-halt-on-error',
+                                     '-jobname=' + fmt_name,
+                                     '-output-directory={}'.format(temp_dir),
+                                     '&latex', temp_tex], stderr=pc.STDOUT)
+                # rename is atomic, concurrent builds never see half a format
+                fmt_file = os.path.join(fmt_dir, fmt_name + '.fmt')
+                part_file = '{}.{}.part'.format(fmt_file, os.getpid())
+                shutil.copy(os.path.join(temp_dir, fmt_name + '.fmt'), 
+                            part_file)
+                os.replace(part_file, fmt_file)
+            except (pc.CalledProcessError, OSError):
+                print('Cannot precompile LaTeX format for packages `{}`, '
+                      'fall back to the full preamble.'.format(packages))
+                fmt_name = None
+            shutil.rmtree(temp_dir)
+        with _formats_lock:
+            _formats[key] = fmt_name
+        return fmt_name
+
+
+def dvi_key(formulas, packages):
+    """
+    Key of the DVI of `formulas`, a list of (formula, math_mode), in the DVI
+    cache. Only the input of latex is hashed: the DPI and the colors only
+    matter to dvipng, so changing them skips latex.
+    """
+    # gitex.canon imports this module
+    from gitex.canon import canonical_formula, canonical_packages
+    return md5(json.dumps([[[canonical_formula(formula), math_mode]
+                            for formula, math_mode in formulas],
+                           canonical_packages(packages),
+                           get_version('latex'), DVI_VERSION]))
+
+
+def cached_dvi(key):
+    """
+    Path of the cached DVI file of `key`, see dvi_key(), None if not cached.
+    The DVI cache is in get_cache_dir('dvi').
+    """
+    dvi_file = os.path.join(get_cache_dir('dvi'), key + '.dvi')
+    try:
+        # the mtime is the last use, see trim_dvi_cache()
+        os.utime(dvi_file)
+    except OSError:
+        count('dvi_cache.miss')
+        return None
+    count('dvi_cache.hit')
+    return dvi_file
+
+
+def store_dvi(key, temp_dvi):
+    # copy then rename, concurrent builds never see half a DVI
+    global _dvi_stored
+    dvi_file = os.path.join(get_cache_dir('dvi'), key + '.dvi')
+    part_file = '{}.{}.{}.part'.format(dvi_file, os.getpid(), 
+                                       threading.get_ident())
+    try:
+        shutil.copy(temp_dvi, part_file)
+        os.replace(part_file, dvi_file)
+        size = os.path.getsize(dvi_file)
+    except OSError:
+        return
+    with _dvi_stored_lock:
+        _dvi_stored += size
+    trim_dvi_cache()
+
+
+def get_dvi_cache_size():
+    # bytes, see DVI_CACHE_SIZE
+    size = os.environ.get('GITEX_DVI_CACHE_SIZE')
+    if not size:
+        return DVI_CACHE_SIZE
+    # gitex.prune imports this module
+    from gitex.prune import parse_size
+    return parse_size(size)
+
+
+def trim_dvi_cache(max_size=None, force=False):
+    """
+    Evict the least recently used DVIs, and the temporary files of dead
+    writers, while the DVI cache is larger than `max_size` bytes, by
+    default get_dvi_cache_size(). Unless `force`, it only runs when the
+    cache wasn't trimmed for DVI_TRIM_INTERVAL seconds, or when this
+    process wrote a sixteenth of `max_size` since its last trim. Concurrent
+    trims only delete a file twice, which is harmless.
+    Returns the number of files evicted.
+    """
+    global _dvi_stored
+    max_size = get_dvi_cache_size() if max_size is None else max_size
+    cache_dir = get_cache_dir('dvi')
+    stamp = os.path.join(cache_dir, '.trimmed')
+    now = time.time()
+    with _dvi_stored_lock:
+        if not force and _dvi_stored < max_size // 16:
+            try:
+                if now - os.stat(stamp).st_mtime < DVI_TRIM_INTERVAL:
+                    return 0
+            except OSError:
+                pass
+        _dvi_stored = 0
+    with open(stamp, 'w'):
+        pass
+    files = []
+    evicted = 0
+    for entry in os.scandir(cache_dir):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if (entry.name.endswith('.part')
+                and now - stat.st_mtime > DVI_TRIM_INTERVAL):
+            remove(entry.path)
+            evicted += 1
+        elif entry.name.endswith('.dvi'):
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    # least recently used first
+    for _, size, path in sorted(files):
+        if total <= max_size:
+            break
+        remove(path)
+        evicted += 1
+        total -= size
+    if evicted:
+        count('dvi_cache.evicted', evicted)
+    return evicted
+
+
+def store_batch_dvi(key, temp_dvi, formulas, packages):
+    """
+    Cache the DVI of a batch, and each of its pages as the DVI of a single
+    formula, for later renders outside of this batch.
+    formulas: list of (formula, math_mode), one per page
+    """
+    store_dvi(key, temp_dvi)
+    try:
+        reader = DviReader(temp_dvi)
+        reader.read()
+    except (OSError, ValueError):
+        return
+    if len(reader.pages) != len(formulas):
+        return
+    page_dvi = os.path.join(os.path.dirname(temp_dvi), 'page.dvi')
+    for i, formula in enumerate(formulas):
+        reader.write_page(i, page_dvi)
+        store_dvi(dvi_key([formula], packages), page_dvi)
+
+
+def gen_latex_file(temp_dir, formula, packages, math_mode, fmt=None):
+    """
+    fmt: precompiled format that already contains the preamble
+    """
+    delimiter = get_delimiter(math_mode)
     with tempfile.NamedTemporaryFile(suffix='.tex', 
                                      delete=False,
                                      mode='w',
@@ -41,60 +400,239 @@ def gen_latex_file(temp_dir, formula, packages, math_mode):
         if math_mode == 'headless':
             codestr = formula
         else:
-            codestr = (r"\documentclass[12pt]{{article}}"
-                       r"\usepackage{{{_packages}}}\pagestyle{{empty}}"
+            codestr = ('' if fmt else gen_preamble(packages)) + (
                        r"\begin{{document}}{_delimiter}"
                        r"{_formula}"
                        r"{_delimiter}\end{{document}}"
-                      .format(_packages=packages, 
-                              _formula=formula,
+                      .format(_formula=formula,
                               _delimiter=delimiter))
         print(codestr, end='', file=temp_tex)
     # print(pc.check_output(['cat', temp_tex.name]))
     return temp_tex
 
 
-def run_latex(temp_dir, temp_tex):
+def gen_batch_latex_file(temp_dir, formulas, packages, fmt=None):
+    """
+    One page per formula, all pages share the same preamble.
+    formulas: list of (formula, math_mode), math_mode cannot be `headless`
+    fmt: precompiled format that already contains the preamble
+    """
+    pages = []
+    for formula, math_mode in formulas:
+        assert math_mode != 'headless', 'headless formula cannot be batched'
+        delimiter = get_delimiter(math_mode)
+        # group each page so that local definitions don't leak, and number
+        # its equations from 1 as when rendered alone
+        pages.append(r"\gitexresetcounters"
+                     r"\begingroup{_delimiter}{_formula}{_delimiter}"
+                     r"\endgroup\clearpage"
+                     .format(_formula=formula, _delimiter=delimiter))
+    with tempfile.NamedTemporaryFile(suffix='.tex', 
+                                     delete=False,
+                                     mode='w',
+                                     dir=temp_dir) as temp_tex:
+        codestr = (('' if fmt else gen_preamble(packages)) 
+                   + r"\begin{document}" + RESET_COUNTERS
+                   + '\n'.join(pages) + r"\end{document}")
+        print(codestr, end='', file=temp_tex)
+    return temp_tex
+
+
+def latex_command(temp_dir, tex_file, fmt=None, latex=None):
+    """
+    Returns the arguments and the environment (None to inherit) of the 
+    `latex` run of run_latex().
+    """
+    env = None
+    fmt_args = []
+    if fmt:
+        # trailing separator keeps the default format search path
+        env = dict(os.environ, TEXFORMATS=get_cache_dir('fmt') + os.pathsep)
+        fmt_args = ['-fmt=' + fmt]
+    return ([latex or get_binary('latex', INSTALL_TEX), '-halt-on-error']
+            + fmt_args + 
+            ['-output-directory={}'.format(temp_dir), tex_file]), env
+
+
+def report_latex_error(temp_dir, tex_file, output):
     try:
-        pc.check_output(['latex',
-                         '-halt-on-error', 
-                         '-output-directory={}'.format(temp_dir), 
-                         temp_tex.name])
+        print('\nTEX SOURCE:')
+        with open(tex_file) as f:
+            print(f.read(), '\n')
+    except: pass
+    print('LaTeX ERROR!!!\n', 
+          'Clean up temp dir', temp_dir, '\n',
+          '-'*50, '\n', 
+          output.decode('utf-8'),
+          '-'*50) # exc.returncode
+    print('Clean up temp dir', temp_dir)
+
+
+def run_latex(temp_dir, temp_tex, verbose=True, fmt=None, latex=None):
+    """
+    fmt: name of a precompiled format, see dump_format()
+    latex: path of the `latex` binary, looked up if not given
+    """
+    args, env = latex_command(temp_dir, temp_tex.name, fmt, latex)
+    count('subprocess.latex')
+    try:
+        with stage('latex'):
+            pc.check_output(args, env=env)
     except pc.CalledProcessError as exc:                                                                                                   
-        try:
-            print('\nTEX SOURCE:')
-            print(pc.check_output(['cat', temp_tex.name]).decode('utf-8'),'\n')
-        except: pass
-        print('LaTeX ERROR!!!\n', 
-              'Clean up temp dir', temp_dir, '\n',
-              '-'*50, '\n', 
-              exc.output.decode('utf-8'),
-              '-'*50) # exc.returncode
-        print('Clean up temp dir', temp_dir)
+        if verbose:
+            report_latex_error(temp_dir, temp_tex.name, exc.output)
         shutil.rmtree(temp_dir)
         raise
 
 
-def run_dvipng(temp_dir, temp_tex, output_file, dpi, foreground, background):
+def run_dvipng(temp_dir, temp_tex, output_file, dpi, foreground, background,
+               dvipng=None, report=False):
     temp_dvi = os.path.splitext(temp_tex.name)[0] + '.dvi'
+    return convert_dvi(temp_dir, temp_dvi, output_file, dpi, 
+                       foreground, background, dvipng=dvipng, report=report)
+
+
+def dvipng_command(temp_dvi, output_file, dpi, foreground, background,
+                   dvipng=None, report=False):
+    # arguments of the `dvipng` run of convert_dvi()
+    # the metrics are printed on stdout, which -q would silence
+    report_args = ['--depth', '--height', '--width'] if report else ['-q']
+    return ([dvipng or get_binary('dvipng', INSTALL_TEX), 
+             '-D', str(dpi),
+             '-fg', foreground,
+             '-bg', background,
+             '-o', output_file] + report_args + [
+             '--strict', '-T', 'tight',
+             temp_dvi])
+
+
+def report_dvipng_error(temp_dir, output):
+    print('dvipng ERROR!!!\n', 
+          'Clean up temp dir', temp_dir, '\n',
+          '-'*50, '\n', 
+          output.decode('utf-8'),
+          '-'*50) # exc.returncode
+
+
+def convert_dvi(temp_dir, temp_dvi, output_file, dpi, foreground, background,
+                dvipng=None, report=False):
+    """
+    dvipng: path of the `dvipng` binary, looked up if not given
+    report: return the baseline metrics of the pages, see parse_dvipng_report()
+    """
     assert os.path.exists(temp_dvi), \
         "LaTeX generated DVI file {} doesn't exist".format(temp_dvi)
+    count('subprocess.dvipng')
     try:
-        pc.check_output(['dvipng', 
-                         '-D', str(dpi),
-                         '-fg', foreground,
-                         '-bg', background,
-                         '-o', output_file,
-                         '-q', '--strict', '-T', 'tight',
-                         temp_dvi])
+        with stage('dvipng'):
+            output = pc.check_output(dvipng_command(
+                temp_dvi, output_file, dpi, foreground, background, 
+                dvipng=dvipng, report=report))
     except pc.CalledProcessError as exc:                                                                                                   
-        print('dvipng ERROR!!!\n', 
+        report_dvipng_error(temp_dir, exc.output)
+        shutil.rmtree(temp_dir)
+        raise
+    if report:
+        return parse_dvipng_report(output.decode('utf-8', 'replace'))
+
+
+def convert_dvi_svg(temp_dir, temp_dvi, output_file, foreground, background,
+                    dvisvgm=None, pages='1'):
+    """
+    SVG counterpart of convert_dvi(), glyphs are converted to paths so that
+    the image doesn't depend on fonts.
+    output_file: may contain `%p`, replaced with the page number
+    pages: dvisvgm page range, e.g. `1-` for all pages
+    Returns the SVG files written, in page order.
+    """
+    assert os.path.exists(temp_dvi), \
+        "LaTeX generated DVI file {} doesn't exist".format(temp_dvi)
+    dvisvgm = dvisvgm or get_binary('dvisvgm', 
+                                    'The svg format needs dvisvgm, '
+                                    'included in TeX Live.')
+    count('subprocess.dvisvgm')
+    try:
+        with stage('dvisvgm'):
+            pc.check_output([dvisvgm, '--no-fonts', '--exact-bbox',
+                             '--page=' + pages, '-o', output_file, temp_dvi],
+                            stderr=pc.STDOUT)
+    except pc.CalledProcessError as exc:
+        print('dvisvgm ERROR!!!\n', 
               'Clean up temp dir', temp_dir, '\n',
               '-'*50, '\n', 
               exc.output.decode('utf-8'),
               '-'*50) # exc.returncode
         shutil.rmtree(temp_dir)
         raise
+    if '%p' in output_file:
+        # dvisvgm may zero-pad the page numbers
+        folder, pattern = os.path.split(output_file)
+        prefix, suffix = pattern.split('%p', 1)
+        page_re = re.compile(re.escape(prefix) + r'(\d+)' 
+                             + re.escape(suffix) + '$')
+        svg_files = {}
+        for name in os.listdir(folder):
+            match = page_re.match(name)
+            if match:
+                svg_files[int(match.group(1))] = os.path.join(folder, name)
+        svg_files = [svg_files[page] for page in sorted(svg_files)]
+    else:
+        svg_files = [output_file] if os.path.exists(output_file) else []
+    for svg_file in svg_files:
+        paint_svg(svg_file, foreground, background)
+    return svg_files
+
+
+def css_color(color_arg):
+    # dvipng color arg to CSS, e.g. `rgb 1.0000 0.5000 0.0000` to `#ff8000`
+    model, *values = color_arg.split()
+    values = [float(value) for value in values]
+    if model == 'RGB' or any(value > 1 for value in values):
+        values = [value / 255 for value in values]
+    return '#' + ''.join('{:02x}'.format(int(round(value * 255))) 
+                         for value in values)
+
+
+def paint_svg(svg_file, foreground, background):
+    """
+    dvisvgm draws black glyphs on a transparent page. Apply the colors that
+    dvipng would use, see paint_svg_data().
+    foreground, background: dvipng color args, see rgb_arg()
+    """
+    with open(svg_file, 'rb') as f:
+        data = f.read()
+    with open(svg_file, 'wb') as f:
+        f.write(paint_svg_data(data, foreground, background))
+
+
+def paint_svg_data(data, foreground, background):
+    # a `fill` on the root element and a background rectangle covering 
+    # the viewBox
+    match = svg_tag_re.search(data)
+    if not match:
+        return data
+    tag = match.group().decode('utf-8')
+    foreground, background = css_color(foreground), css_color(background)
+    if foreground != '#000000':
+        tag = tag.replace('<svg', "<svg fill='{}'".format(foreground), 1)
+    viewbox = re.search(r"""viewBox\s*=\s*['"]([^'"]*)['"]""", tag)
+    if viewbox:
+        tag += ("<rect x='{}' y='{}' width='{}' height='{}' fill='{}'/>"
+                .format(*viewbox.group(1).replace(',', ' ').split()[:4], 
+                        background))
+    return data[:match.start()] + tag.encode('utf-8') + data[match.end():]
+
+
+def parse_dvipng_report(output):
+    """
+    Metrics of every page printed by `dvipng --depth --height --width`, 
+    e.g. `[1 depth=5 height=21 width=40]`, in pixels. `height` is above the
+    baseline, `depth` below.
+    Returns a list of dicts {'depth': 5, 'height': 21, 'width': 40}
+    """
+    return [{key: int(value) for key, value 
+             in re.findall(r'(depth|height|width)=(-?\d+)', page)}
+            for page in re.findall(r'\[\d+[^\]]*\]', output)]
 
 
 def run_optipng(output_file):
@@ -105,7 +643,14 @@ def run_optipng(output_file):
         if not optipng:
             print('optipng not found, skip optimization. ')
             return
-        pc.check_output([bin, '-zc1-9', '-zm1-9', '-zs0-3', '-f0-5', output_file])
+        count('subprocess.optipng')
+        # optimized next to the image, then renamed over it
+        temp_file = temp_path(output_file)
+        with stage('optipng'):
+            pc.check_output([optipng] + OPTIPNG_ARGS 
+                            + ['-out', temp_file, output_file])
+        if os.path.exists(temp_file):
+            os.replace(temp_file, output_file)
     except pc.CalledProcessError as exc:                                                                                                   
         print('optipng ERROR!!!\n', 
               '-'*50, '\n', 
@@ -114,6 +659,41 @@ def run_optipng(output_file):
         raise
 
 
+def report_image(metrics):
+    """
+    Image size of a page from parse_dvipng_report(), without its data.
+    None if dvipng didn't report the whole size.
+    """
+    if not metrics or not {'depth', 'height', 'width'} <= set(metrics):
+        return None
+    return attrdict(data=None, width=metrics['width'], 
+                    height=metrics['height'] + metrics['depth'], 
+                    depth=metrics['depth'])
+
+
+def optimize_image(png_file, optimize=True):
+    """
+    optimize: `optipng` runs optipng after the in-process pass of 
+      gitex.pngopt, any other true value only the in-process pass
+    Returns (size before, size after)
+    """
+    if not optimize or optimize == 'False': # handle string version
+        size = os.path.getsize(png_file)
+        return size, size
+    with stage('pngopt'):
+        before, after = optimize_file(png_file)
+    if optimize == 'optipng':
+        run_optipng(png_file)
+        after = os.path.getsize(png_file)
+    return before, after
+
+
+def md5(s):
+    h = hashlib.new('MD5')
+    h.update(s.encode('utf-8'))
+    return h.hexdigest()
+
+
 def rgb_arg(rgb_str):
     if rgb_str in CSS3_COLOR_RGB:
         # color name in CSS3, e.g. `darksalmon`
@@ -140,28 +720,274 @@ def tex2png(formula,
             packages='',
             foreground='rgb 0.0 0.0 0.0',
             background='rgb 1.0 1.0 1.0',
-            optimize=False):
-    # check required binaries
-    get_binary('latex', 'Install MacTeX: http://www.tug.org/mactex/')
-    get_binary('dvipng', 'Install MacTeX: http://www.tug.org/mactex/')
-    
-    # make a temporary directory
-    temp_dir = tempfile.mkdtemp('gitex')
-    temp_tex = gen_latex_file(temp_dir, formula, packages, math_mode)
-    run_latex(temp_dir, temp_tex)
-    run_dvipng(temp_dir, temp_tex, output_file, dpi, 
-               foreground=rgb_arg(foreground), 
-               background=rgb_arg(background))
-    if optimize and not optimize == 'False': # handle string version
-        run_optipng(output_file)
-    # clean up
-    shutil.rmtree(temp_dir)
-    
+            optimize=False,
+            precompile=False,
+            worker=False,
+            session=None,
+            format='png',
+            dvi_cache=True,
+            variants=None,
+            backend='tex'):
+    """
+    output_file: path or binary file-like object
+    precompile: load the preamble from a cached precompiled LaTeX format
+    worker: render on a resident LaTeX process, see gitex.worker
+    session: RenderSession shared with other calls, a new one otherwise
+    optimize: see optimize_image()
+    format: `png`, or `svg` rendered with dvisvgm, which ignores `dpi` 
+      and `optimize`
+    dvi_cache: reuse the DVI of an earlier render of the same formula and
+      packages, so that only dvipng runs, see dvi_key()
+    variants: list of (name, foreground, background), each written next to
+      `output_file` as `<output_file>-<name>.png` by recoloring the image
+      in-process, see gitex.recolor
+    backend: `tex`, an in-process backend like `mathtext` for the formulas
+      it accepts, or `auto` for the first one that accepts the formula, see
+      gitex.backends
+    Returns the image, see tex2png_image()
+    """
+    image = tex2png_image(formula, math_mode, dpi, packages, 
+                          foreground, background, optimize, precompile, 
+                          worker, session, format, dvi_cache, backend)
+    if hasattr(output_file, 'write'):
+        output_file.write(image.data)
+    else:
+        write_file(output_file, image.data)
+    if variants:
+        assert not hasattr(output_file, 'write'), \
+            'variants need an output file path'
+        # gitex.recolor imports this module
+        from gitex.recolor import recolor_file, variant_file
+        recolor_file(output_file, rgb_arg(foreground), rgb_arg(background),
+                     [(variant_file(output_file, name), 
+                       variant_foreground, variant_background)
+                      for name, variant_foreground, variant_background 
+                      in variants])
+    return image
+
+
+def tex2png_image(formula,
+                  math_mode='inline',
+                  dpi=300,
+                  packages='',
+                  foreground='rgb 0.0 0.0 0.0',
+                  background='rgb 1.0 1.0 1.0',
+                  optimize=False,
+                  precompile=False,
+                  worker=False,
+                  session=None,
+                  format='png',
+                  dvi_cache=True,
+                  backend='tex'):
+    """
+    Render in scratch space only, nothing is written for the caller.
+    Same options as tex2png().
+    Returns attrdict(data=<image bytes>, width, height, depth), `depth` is the
+    number of pixels below the baseline, None if dvipng didn't report it.
+    The size of svg images is in points, see imgsize.get_svg_size().
+    """
+    assert format in FORMATS, 'format must be one of {}'.format(FORMATS)
+    if backend != 'tex':
+        # gitex.backends imports this module
+        from gitex.backends import BACKENDS, resolve_backend
+        backend = resolve_backend(backend, formula, math_mode, packages, 
+                                  format)
+        if backend != 'tex':
+            count('backend.' + backend)
+            return BACKENDS[backend].render(formula, math_mode, dpi, 
+                                            packages, foreground, background,
+                                            format)
+    if session is None:
+        # also checks the required binaries
+        with RenderSession(pool_size=0) as session:
+            return tex2png_image(formula, math_mode, dpi, packages,
+                                 foreground, background, optimize, 
+                                 precompile, worker, session, format,
+                                 dvi_cache)
+
+    key = dvi_key([(formula, math_mode)], packages) if dvi_cache else None
+    dvi_file = cached_dvi(key) if dvi_cache else None
+    # scratch directory from the session pool
+    temp_dir = session.acquire_dir()
+    png_file = os.path.join(temp_dir, 'formula.' + format)
+    try:
+        if dvi_file is None and worker and math_mode != 'headless':
+            from gitex.worker import acquire_worker, release_worker
+            latex_worker = acquire_worker(packages, precompile)
+            try:
+                report = latex_worker.render(formula, png_file, math_mode, dpi,
+                                             foreground=rgb_arg(foreground),
+                                             background=rgb_arg(background),
+                                             report=True, format=format,
+                                             dvi_key=key)
+            finally:
+                release_worker(latex_worker)
+        else:
+            if dvi_file is None:
+                fmt = None
+                if precompile and math_mode != 'headless':
+                    fmt = dump_format(packages)
+                temp_tex = gen_latex_file(temp_dir, formula, packages, 
+                                          math_mode, fmt=fmt)
+                run_latex(temp_dir, temp_tex, fmt=fmt, latex=session.latex)
+                dvi_file = os.path.splitext(temp_tex.name)[0] + '.dvi'
+                if key:
+                    store_dvi(key, dvi_file)
+            if format == 'svg':
+                report = None
+                convert_dvi_svg(temp_dir, dvi_file, png_file, 
+                                rgb_arg(foreground), rgb_arg(background), 
+                                dvisvgm=session.dvisvgm)
+            else:
+                report = convert_dvi(temp_dir, dvi_file, png_file, dpi, 
+                                     foreground=rgb_arg(foreground), 
+                                     background=rgb_arg(background),
+                                     dvipng=session.dvipng, report=True)
+        if format == 'png':
+            optimize_image(png_file, optimize)
+        with open(png_file, 'rb') as f:
+            data = f.read()
+    finally:
+        # clean up
+        session.release_dir(temp_dir)
+    if format == 'svg':
+        width, height = get_svg_size(data)
+    else:
+        width, height = get_png_size(data)
+    depth = report[0].get('depth') if report else None
+    return attrdict(data=data, width=width, height=height, depth=depth)
+
+
+def tex2png_batch(jobs,
+                  dpi=300,
+                  packages='',
+                  foreground='rgb 0.0 0.0 0.0',
+                  background='rgb 1.0 1.0 1.0',
+                  optimize=False,
+                  precompile=False,
+                  worker=False,
+                  session=None,
+                  format='png',
+                  dvi_cache=True,
+                  backend='tex'):
+    """
+    Render many formulas with a single `latex` and a single `dvipng` (or
+    `dvisvgm`) run. All formulas in a batch must share the same options.
+    jobs: list of (formula, output_file, math_mode)
+    session, format, dvi_cache: see tex2png(). The DVI of the batch is
+      cached as a whole, and page by page for single formulas.
+    backend: see tex2png(), formulas of in-process backends are rendered
+      one by one
+    If the batch fails (e.g. one bad formula), every formula is rendered 
+    separately with tex2png() so that the error is reported individually.
+    Returns the images in the order of `jobs`, see tex2png_image(). Images
+    of the batch have no `data`, their size comes from the dvipng report,
+    and is None when not reported.
+    """
+    options = dict(dpi=dpi, packages=packages, optimize=optimize,
+                   foreground=foreground, background=background,
+                   precompile=precompile, worker=worker, format=format,
+                   dvi_cache=dvi_cache, backend=backend)
+    if session is None:
+        with RenderSession(pool_size=0) as session:
+            return tex2png_batch(jobs, session=session, **options)
+    options['session'] = session
+
+    # output file -> image
+    images = {}
+    all_jobs = jobs
+
+    def render_each(jobs):
+        # try every formula, then raise the first error
+        errors = []
+        for formula, output_file, math_mode in jobs:
+            try:
+                images[output_file] = tex2png(formula, output_file, 
+                                              math_mode, **options)
+            except Exception as exc:
+                errors.append(exc)
+        if errors:
+            raise errors[0]
+        return [images.get(output_file) for _, output_file, _ in all_jobs]
+
+    # rendered separately: headless formulas are complete documents of 
+    # their own
+    separate = [job for job in jobs if job[2] == 'headless']
+    jobs = [job for job in jobs if job[2] != 'headless']
+    if backend != 'tex':
+        # gitex.backends imports this module
+        from gitex.backends import resolve_backend
+        # and formulas rendered in-process, without latex
+        separate += [job for job in jobs 
+                     if resolve_backend(backend, job[0], job[2], packages,
+                                        format) != 'tex']
+        jobs = [job for job in jobs if job not in separate]
+    if len(jobs) <= 1:
+        return render_each(separate + jobs)
+
+    formulas = [(formula, math_mode) for formula, _, math_mode in jobs]
+    key = dvi_key(formulas, packages) if dvi_cache else None
+    dvi_file = cached_dvi(key) if dvi_cache else None
+    temp_dir = session.acquire_dir()
+    try:
+        batch_failed = False
+        if dvi_file is None:
+            fmt = dump_format(packages) if precompile else None
+            temp_tex = gen_batch_latex_file(temp_dir, formulas, packages, 
+                                            fmt=fmt)
+            try:
+                run_latex(temp_dir, temp_tex, verbose=False, fmt=fmt, 
+                          latex=session.latex)
+                dvi_file = os.path.splitext(temp_tex.name)[0] + '.dvi'
+                if key:
+                    store_batch_dvi(key, dvi_file, formulas, packages)
+            except pc.CalledProcessError:
+                batch_failed = True
+        if not batch_failed and format == 'svg':
+            # dvisvgm replaces %p with the page number, starting from 1
+            page_files = convert_dvi_svg(
+                temp_dir, dvi_file, os.path.join(temp_dir, 'page%p.svg'), 
+                rgb_arg(foreground), rgb_arg(background), 
+                dvisvgm=session.dvisvgm, pages='1-')
+            # e.g. an empty formula doesn't produce a page
+            page_mismatch = len(page_files) != len(jobs)
+        elif not batch_failed:
+            # dvipng replaces %d with the page number, starting from 1
+            page_file = os.path.join(temp_dir, 'page%d.png')
+            report = convert_dvi(temp_dir, dvi_file, page_file, dpi,
+                                 foreground=rgb_arg(foreground), 
+                                 background=rgb_arg(background),
+                                 dvipng=session.dvipng, report=True)
+            page_files = [page_file % (i + 1) for i in range(len(jobs))]
+            page_mismatch = (not all(map(os.path.exists, page_files)) 
+                             or os.path.exists(page_file % (len(jobs) + 1)))
+            for metrics, (_, output_file, _) in zip(report, jobs):
+                images[output_file] = report_image(metrics)
+        if not batch_failed and not page_mismatch:
+            for page_file, (_, output_file, _) in zip(page_files, jobs):
+                publish_file(page_file, output_file)
+    finally:
+        session.release_dir(temp_dir)
+    if batch_failed:
+        print('LaTeX batch of {} formulas failed, '
+              'render one by one.'.format(len(jobs)))
+        return render_each(separate + jobs)
+    if page_mismatch:
+        print('LaTeX batch page count mismatch, render one by one.')
+        return render_each(separate + jobs)
+    if format == 'png':
+        for _, output_file, _ in jobs:
+            optimize_image(output_file, optimize)
+    return render_each(separate)
+
 
 def main():
+    from gitex.recolor import parse_variant
+    from gitex.backends import BACKENDS
     parser = argparse.ArgumentParser(prog='tex2png')
     parser.add_argument('formula', help='LaTeX formula text')
-    parser.add_argument('output_file', help='output png file')
+    parser.add_argument('output_file', 
+                        help='output image file, `-` for stdout')
     parser.add_argument('-m', '--math-mode', default='inline',
                         help='LaTeX math mode: [inline, display, headless, none]')
     parser.add_argument('-d', '--dpi', type=int, default=300,
@@ -173,10 +999,36 @@ def main():
                     help='Set the foreground color (rgb or CSS3 color name, e.g. `gold`)')
     parser.add_argument('-bg', '--background', default='rgb 1.0 1.0 1.0',
                     help='Set the background color (rgb or CSS3 color name, e.g. `deepskyblue`)')
-    parser.add_argument('-O', '--optimize', action='store_true',
-                        help='Optimize output image using `optipng`')
+    parser.add_argument('-O', '--optimize', nargs='?', const='python',
+                        choices=OPTIMIZERS, default=False,
+                        help='Optimize the output image in-process, '
+                        '`optipng` also runs optipng when available')
+    parser.add_argument('-f', '--format', default='png', choices=FORMATS,
+                        help='Image format, svg is rendered with `dvisvgm` '
+                        'and doesn\'t depend on the DPI')
+    parser.add_argument('-P', '--precompile', action='store_true',
+                        help='Load the preamble from a cached precompiled '
+                        'LaTeX format, much faster for short formulas')
+    parser.add_argument('--no-dvi-cache', dest='dvi_cache', 
+                        action='store_false',
+                        help='Always run latex, even if the DVI of the '
+                        'formula is cached')
+    parser.add_argument('--backend', default='tex', 
+                        choices=list(BACKENDS) + ['auto'],
+                        help='Render with `tex`, with matplotlib `mathtext` '
+                        'if it can draw the formula like TeX, or `auto` to '
+                        'pick the fastest backend for the formula')
+    parser.add_argument('-V', '--variant', dest='variants', action='append',
+                        type=parse_variant, metavar='NAME=FG:BG',
+                        help='Also write the formula recolored with FG on BG '
+                        'to <output_file>-NAME.png, without running latex '
+                        'again, e.g. `dark=white:rgb 13 17 23`. Repeatable.')
 
     args = parser.parse_args()
+    assert not (args.variants and args.output_file == '-'), \
+        'variants need an output file'
+    if args.output_file == '-':
+        args.output_file = sys.stdout.buffer
     tex2png(**vars(args))
 
 
@@ -0,0 +1,216 @@
+"""
+GiTeX markdown syntax and its single-pass tokenizer.
+"""
+import re
+from collections import namedtuple
+
+# http://stackoverflow.com/questions/36391979/find-markdown-image-syntax-in-string-in-java
+# match Markdown image syntax ![alt](image_link)
+# group 1: `alt`; group 2 `image_link`
+image_re = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+
+# http://stackoverflow.com/questions/17767251/how-to-ignore-escaped-character-in-regex
+# negative lookahead: In general, (?<!Y)X matches an X that is not preceded by Y.
+# inline math: $ .... $ but \$ escapes dollar sign
+inline_re = re.compile(r'(?<!\\)\$([^\$]+)(?<!\\)\$')
+# extended: match $ ... $[optional_args]
+inline_re = re.compile(r'(?<!\\)\$([^\$]+)(?<!\\)\$(\[[^\]]*\])?')
+# non-standard regex support for named group
+inline_re = re.compile(r'(?<!\\)\$(?P<formula>[^\$]+)(?<!\\)\$(\[(?P<options>[^\]]*)\])?')
+
+# diplay mode math: $$ .... $$ but \$ escapes dollar sign
+display_re = re.compile(r'(?<!\\)\$\$([^\$]+)(?<!\\)\$\$')
+# extended; match $$ ... $$[optional_args]
+display_re = re.compile(r'(?<!\\)\$\$(?P<formula>[^\$]+)(?<!\\)\$\$(\[(?P<options>[^\]]*)\])?')
+
+# match \include[...] on its own line
+include_re = re.compile(r'[\s]*\\include\[(?P<options>[^\]]*)\][\s]*')
+
+# match \begin[...] on its own line
+begin_re = re.compile(r'^[\s]*\\begin\[([^\])]*)\][\s]*$')
+# make [...] optional
+begin_re = re.compile(r'^[\s]*\\begin(\[(?P<options>[^\]]*)\])?[\s]*$')
+
+# match \end on its own line
+end_re = re.compile(r'^[\s]*\\end[\s]*$')
+
+# `\\` escape to match literals
+escape_re = [
+    # ('$$', r'\\\$\$'),
+    ('$', r'\\\$'),
+    (r'\\end', r'\\\\end'),
+    (r'\\begin', r'\\\\begin'),
+    (r'\\include', r'\\\\include')
+]
+escape_re = [(literal, re.compile(regex)) for literal, regex in escape_re]
+# escaped source text -> literal
+ESCAPES = {'\\$': '$',
+           '\\\\end': '\\end',
+           '\\\\begin': '\\begin',
+           '\\\\include': '\\include'}
+# all escapes in one pass
+escapes_re = re.compile(r'\\\$|\\\\(?:end|begin|include)')
+
+# the inline syntax, one regex per pass of the original scanner, in its
+# order: images, then display math, then inline math and escapes. A pass
+# only searches the text between the matches of the previous passes, so
+# `$$a$$` wins over an inline formula that would start further left, e.g.
+# `$x$$a$$` is `$x` then the display formula, see find_tokens().
+image_token_re = re.compile(
+    r'(?P<image>!\[(?P<alt>[^\]]*)\]\((?P<url>[^)]+)\))')
+display_token_re = re.compile(
+    r'(?P<display>(?<!\\)\$\$(?P<dformula>[^\$]+)(?<!\\)\$\$'
+    r'(\[(?P<doptions>[^\]]*)\])?)')
+inline_token_re = re.compile(
+    r'(?P<inline>(?<!\\)\$(?P<iformula>[^\$]+)(?<!\\)\$'
+    r'(\[(?P<ioptions>[^\]]*)\])?)'
+    r'|(?P<escape>\\\$|\\\\(?:end|begin|include))')
+TOKEN_PASSES = [image_token_re, display_token_re, inline_token_re]
+# same without images, for text generated from an image
+MATH_PASSES = TOKEN_PASSES[1:]
+
+# a display formula that starts a line and continues on the next lines
+display_start_re = re.compile(r'^[\s]*(?<!\\)\$\$[^\$]*$')
+# the line that closes a multi-line display formula
+display_end_re = re.compile(r'(?<!\\)\$\$')
+
+# kind: 'text', 'inline', 'display', 'image', 'begin', 'include' or 'escape'
+# text: source text of the segment
+# value: formula for 'inline', 'display' and 'begin', alt text for 'image',
+#   file path for 'include', the literal for 'escape'
+# options: option string `[...]`, or the url of an 'image'
+# lineno: line number where the segment starts
+Segment = namedtuple('Segment', 'kind text value options lineno')
+
+
+def find_tokens(line, passes, start=0, end=None):
+    """
+    Matches of the regexes of `passes` in line[start:end], in the order of
+    the line. The first regex is searched first, the next ones only
+    between its matches.
+    """
+    end = len(line) if end is None else end
+    if len(passes) > 1 and '$$' not in line and '![' not in line:
+        # nothing for the earlier passes, the usual case
+        passes = passes[-1:]
+    if len(passes) == 1:
+        for match in passes[0].finditer(line, start, end):
+            yield match
+        return
+    pos = start
+    for match in passes[0].finditer(line, start, end):
+        for token in find_tokens(line, passes[1:], pos, match.start()):
+            yield token
+        yield match
+        pos = match.end()
+    for token in find_tokens(line, passes[1:], pos, end):
+        yield token
+
+
+def tokenize_line(line, lineno=0, images=True):
+    """
+    Split one line (or a multi-line display formula) into segments.
+    images: whether markdown images are recognized
+    """
+    pos = 0
+    for match in find_tokens(line, TOKEN_PASSES if images else MATH_PASSES):
+        start = match.start()
+        if start > pos:
+            yield Segment('text', line[pos:start], None, None, lineno)
+        text = match.group()
+        # the outermost group of every alternative closes last
+        kind = match.lastgroup
+        if kind == 'escape':
+            yield Segment('escape', text, ESCAPES[text], None, lineno)
+        elif kind == 'image':
+            yield Segment('image', text, match.group('alt'),
+                          match.group('url'), lineno)
+        elif kind == 'display':
+            yield Segment('display', text, match.group('dformula'),
+                          match.group('doptions'), lineno)
+        else:
+            yield Segment('inline', text, match.group('iformula'),
+                          match.group('ioptions'), lineno)
+        pos = match.end()
+        lineno += text.count('\n')
+    if pos < len(line):
+        yield Segment('text', line[pos:], None, None, lineno)
+
+
+def tokenize(src):
+    """
+    Single pass over the lines of `src` (a file or any iterable of lines),
+    yields Segment tuples. Concatenating the `text` of all segments gives
+    back `src`.
+    """
+    lines = iter(src)
+    # lines read ahead while looking for the end of a display formula
+    pending = []
+
+    def read_line():
+        if pending:
+            return pending.pop()
+        return next(lines, None)
+
+    lineno = 0
+    while True:
+        line = read_line()
+        if line is None:
+            return
+        lineno += 1
+
+        # \begin \end syntax
+        begin_stmt = begin_re.match(line)
+        if begin_stmt:
+            start = lineno
+            text = [line]
+            formula = []
+            while True:
+                line = read_line()
+                if line is None:
+                    raise Exception(r'\begin[] statement has no \end')
+                lineno += 1
+                text.append(line)
+                if end_re.match(line):
+                    break
+                formula.append(line)
+            yield Segment('begin', ''.join(text), ''.join(formula),
+                          begin_stmt.group('options'), start)
+            continue
+
+        include_stmt = include_re.match(line)
+        if include_stmt:
+            options = include_stmt.group('options')
+            # \include[file_path, arg1=xx, arg2=...]
+            if ',' in options:
+                latex_src, options = options.split(',', 1)
+            else:
+                latex_src, options = options, ''
+            yield Segment('include', line, latex_src, options, lineno)
+            continue
+
+        # $$ starting a line, then the formula and a closing $$ later on
+        if display_start_re.match(line):
+            block = [line]
+            while True:
+                next_line = read_line()
+                if next_line is None:
+                    break
+                block.append(next_line)
+                # display math can't contain an empty line
+                if not next_line.strip() or display_end_re.search(next_line):
+                    break
+            block_text = ''.join(block)
+            match = display_re.search(block_text)
+            if (len(block) > 1 and match
+                    and match.start() == block_text.index('$$')
+                    and match.end() > len(block_text) - len(block[-1])):
+                for segment in tokenize_line(block_text, lineno):
+                    yield segment
+                lineno += len(block) - 1
+                continue
+            # not a multi-line formula, go on line by line
+            pending.extend(reversed(block[1:]))
+
+        for segment in tokenize_line(line, lineno):
+            yield segment
@@ -0,0 +1,124 @@
+"""
+Watch mode, `gitex --watch`: rebuild the output whenever the source or one
+of its `\\include`d files is saved.
+The manifest, the build graph (the regions of the parsed source) and the
+render session, with its resident LaTeX workers under `--worker`, stay in
+memory between builds. Only the regions changed by an edit are scanned
+again and only their new formulas are rendered, see compile.build().
+Files are polled with os.stat(), which works on every platform and
+filesystem. A burst of saves triggers a single build. The watched files are
+those of the last build, or after a failed build the files that the source
+includes at that point, so that creating a missing `\\include` rebuilds.
+"""
+import os
+import time
+import subprocess as pc
+from gitex.tex2png import RenderSession
+from gitex.buildgraph import BuildGraph, split_regions
+from gitex.tokenizer import tokenize
+from gitex.spool import CLAIM_TIMEOUT
+from gitex.stats import instrument
+from gitex.compile import build, load_manifest
+
+
+def snapshot(paths):
+    # path -> (mtime, size), None for missing files
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def source_files(src_md):
+    """
+    The source and the files it includes, read without a build, e.g. after
+    a failed one. An included file may not exist, it is watched all the
+    same. Up to the first tokenizer error, like an unclosed \\begin.
+    """
+    paths = [src_md]
+    try:
+        with open(src_md) as src:
+            for segments in split_regions(tokenize(src)):
+                paths += [segment.value for segment in segments
+                          if segment.kind == 'include']
+    except Exception:
+        pass
+    return paths
+
+
+def wait_for_change(paths, interval=0.05, debounce=0.1):
+    """
+    Block until one of `paths` changes, then until none of them changed for
+    `debounce` seconds. Polls every `interval` seconds.
+    """
+    last = snapshot(paths)
+    while True:
+        time.sleep(interval)
+        current = snapshot(paths)
+        if current != last:
+            break
+    quiet_since = time.time()
+    while time.time() - quiet_since < debounce:
+        time.sleep(interval)
+        latest = snapshot(paths)
+        if latest != current:
+            current = latest
+            quiet_since = time.time()
+
+
+def watch(src_md, output_md, interval=0.05, debounce=0.1, batch=False,
+          jobs=1, stats=0, trace=None, optimize=False, baseline=False,
+          spool=None, claim_timeout=CLAIM_TIMEOUT, **tex2png_options):
+    """
+    Build `output_md`, then rebuild it after every change of its source and
+    included files, until interrupted. A failed build is reported and the
+    files are watched again.
+    interval: seconds between two polls
+    debounce: seconds without change before a rebuild
+    Other options: see compile.compile()
+    """
+    image_folder = tex2png_options['image_folder']
+    manifest = load_manifest(image_folder)
+    graph = BuildGraph(image_folder)
+    paths = [src_md]
+    first = True
+    with RenderSession(pool_size=jobs) as session:
+        try:
+            while True:
+                start = time.time()
+                try:
+                    with instrument(stats, trace):
+                        doc = build(src_md, output_md, manifest, graph,
+                                    session, batch=batch, jobs=jobs,
+                                    optimize=optimize, baseline=baseline,
+                                    spool=spool, claim_timeout=claim_timeout,
+                                    **tex2png_options)
+                    paths = graph.deps(output_md) or paths
+                    if doc is not None:
+                        print('Built {} in {:.0f} ms, {} formulas rendered.'
+                              .format(output_md, (time.time() - start) * 1000,
+                                      len(doc.rendered)))
+                except pc.CalledProcessError:
+                    # the LaTeX error is already reported
+                    print('Build of {} failed, waiting for a fix.'
+                          .format(output_md))
+                    paths = source_files(src_md)
+                except Exception as exc:
+                    # e.g. a missing \include file or an unclosed \begin
+                    print('Build of {} failed: {}'.format(output_md, exc))
+                    paths = source_files(src_md)
+                manifest.save()
+                graph.save()
+                # only the first build redraws
+                tex2png_options['redraw'] = False
+                if first:
+                    print('Watching {} files, Ctrl-C to stop.'
+                          .format(len(paths)))
+                    first = False
+                wait_for_change(paths, interval, debounce)
+        except KeyboardInterrupt:
+            pass
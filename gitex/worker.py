@@ -0,0 +1,204 @@
+"""
+Warm LaTeX workers.
+A worker is a resident `latex` process with the preamble of one package set
+already loaded. It reads formulas over a pipe and ships one DVI page for each,
+which is cut out of the growing DVI file and converted by dvipng.
+"""
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+import subprocess as pc
+from gitex.dvi import DviReader
+from gitex.stats import stage, count
+from gitex.tex2png import (get_binary, get_cache_dir, get_delimiter,
+                           gen_preamble, dump_format, convert_dvi,
+                           convert_dvi_svg, store_dvi, RESET_COUNTERS,
+                           INSTALL_TEX)
+
+# TeX only writes its DVI buffer when half of it is full. A small buffer
+# plus a padding page after every formula flushes each page to disk.
+DVI_BUF_SIZE = 800
+PAD_SIZE = 1024
+# restart a worker after so many formulas, its DVI file keeps growing
+MAX_JOBS = 1000
+
+# the driver loops forever: read a command from stdin, run it
+# the counters are reset for every job, see RESET_COUNTERS
+DRIVER = (r"\begin{document}" + RESET_COUNTERS
+          + r"\def\gitexjob#1{\global\count9=#1\relax\gitexresetcounters"
+          r"\begingroup\input{gitexjob#1}\endgroup\clearpage"
+          r"\begingroup\count9=-1 \shipout\hbox{\special{" + 'x' * PAD_SIZE
+          + r"}}\endgroup\immediate\write16{GITEX-DONE #1}}"
+          r"\def\gitexloop{\read-1 to\gitexcmd\gitexcmd\gitexloop}"
+          r"\immediate\write16{GITEX-READY}\gitexloop")
+
+
+class LatexWorker(object):
+    """
+    One resident `latex` process for formulas that share the same packages.
+    The process is restarted after a fatal TeX error.
+    """
+    def __init__(self, packages='', precompile=False):
+        self.packages = packages
+        self.precompile = bool(precompile)
+        self.fmt = dump_format(packages) if precompile else None
+        self.process = None
+        self.temp_dir = None
+        self.job_id = 0
+
+    def start(self):
+        latex = get_binary('latex', INSTALL_TEX)
+        self.temp_dir = tempfile.mkdtemp('gitex-worker')
+        driver = os.path.join(self.temp_dir, 'gitexworker.tex')
+        with open(driver, 'w') as f:
+            print(('' if self.fmt else gen_preamble(self.packages)) + DRIVER,
+                  file=f)
+        env = dict(os.environ,
+                   dvi_buf_size=str(DVI_BUF_SIZE),
+                   max_print_line='10000')
+        fmt_args = []
+        if self.fmt:
+            env['TEXFORMATS'] = get_cache_dir('fmt') + os.pathsep
+            fmt_args = ['-fmt=' + self.fmt]
+        count('subprocess.latex')
+        self.process = pc.Popen([latex, '-halt-on-error'] + fmt_args
+                                + [driver],
+                                cwd=self.temp_dir, env=env,
+                                stdin=pc.PIPE, stdout=pc.PIPE,
+                                stderr=pc.STDOUT)
+        self.dvi = DviReader(os.path.join(self.temp_dir, 'gitexworker.dvi'))
+        with stage('worker_start'):
+            ok, output = self.wait_for('GITEX-READY')
+        if not ok:
+            self.stop()
+            print('LaTeX worker ERROR!!!\n',
+                  '-'*50, '\n',
+                  output,
+                  '-'*50)
+            raise pc.CalledProcessError(self.returncode, 'latex',
+                                        output.encode('utf-8'))
+
+    def wait_for(self, marker):
+        # read the terminal output until `marker`, returns (found, output)
+        lines = []
+        for line in self.process.stdout:
+            line = line.decode('utf-8', 'replace')
+            lines.append(line)
+            if line.startswith(marker):
+                return True, ''.join(lines)
+        self.returncode = self.process.wait()
+        return False, ''.join(lines)
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process.stdin.close()
+            self.process = None
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def render(self, formula, output_file, math_mode,
+               dpi, foreground, background, report=False, format='png',
+               dvi_key=None):
+        """
+        foreground, background: dvipng color args, see tex2png.rgb_arg()
+        report: return the baseline metrics, see tex2png.convert_dvi()
+        format: `png` or `svg`, see tex2png.tex2png()
+        dvi_key: store the DVI of the formula in the DVI cache under this key,
+          see tex2png.dvi_key()
+        """
+        assert math_mode != 'headless', 'headless formula needs its own run'
+        if (self.process is None or self.process.poll() is not None 
+                or self.job_id % MAX_JOBS == 0):
+            self.stop()
+            self.start()
+        self.job_id += 1
+        job_id = self.job_id
+        job_tex = os.path.join(self.temp_dir, 'gitexjob{}.tex'.format(job_id))
+        delimiter = get_delimiter(math_mode)
+        with open(job_tex, 'w') as f:
+            print(delimiter + formula + delimiter, end='', file=f)
+        try:
+            self.process.stdin.write(
+                r'\gitexjob{{{}}}'.format(job_id).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except OSError:
+            pass
+        with stage('worker_latex'):
+            ok, output = self.wait_for('GITEX-DONE {}'.format(job_id))
+        pages = []
+        if ok:
+            self.dvi.read()
+            pages = [i for i, (counts, _) in enumerate(self.dvi.pages)
+                     if counts[9] == job_id]
+        if len(pages) != 1:
+            # restart the worker, its TeX state can't be trusted anymore
+            self.stop()
+            print('LaTeX worker ERROR!!! formula `{}`\n'.format(formula),
+                  '-'*50, '\n',
+                  output if not ok else
+                  'formula produced {} pages\n'.format(len(pages)),
+                  '-'*50)
+            try:
+                self.start()
+            except pc.CalledProcessError:
+                pass
+            raise pc.CalledProcessError(1, 'latex', output.encode('utf-8'))
+        os.remove(job_tex)
+        job_dir = tempfile.mkdtemp('gitex', dir=self.temp_dir)
+        job_dvi = os.path.join(job_dir, 'page.dvi')
+        self.dvi.write_page(pages[0], job_dvi)
+        if dvi_key:
+            store_dvi(dvi_key, job_dvi)
+        if format == 'svg':
+            metrics = None
+            convert_dvi_svg(job_dir, job_dvi, output_file, 
+                            foreground, background)
+        else:
+            metrics = convert_dvi(job_dir, job_dvi, output_file, dpi, 
+                                  foreground, background, report=report)
+        shutil.rmtree(job_dir)
+        return metrics
+
+
+# package key -> idle workers
+_idle_workers = {}
+_all_workers = []
+_workers_lock = threading.Lock()
+
+
+def acquire_worker(packages='', precompile=False):
+    """
+    An idle worker for `packages`, a new one is started if all are busy.
+    Give it back with release_worker().
+    """
+    key = (packages, bool(precompile))
+    with _workers_lock:
+        idle = _idle_workers.setdefault(key, [])
+        if idle:
+            return idle.pop()
+    worker = LatexWorker(packages, precompile)
+    with _workers_lock:
+        _all_workers.append(worker)
+    return worker
+
+
+def release_worker(worker):
+    key = (worker.packages, worker.precompile)
+    with _workers_lock:
+        _idle_workers.setdefault(key, []).append(worker)
+
+
+@atexit.register
+def stop_workers():
+    with _workers_lock:
+        for worker in _all_workers:
+            worker.stop()
+        del _all_workers[:]
+        _idle_workers.clear()
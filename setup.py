@@ -33,6 +33,7 @@ setup(name='gitex',
           "Programming Language :: Python :: 3"
       ],
       install_requires=read('requirements.txt').strip().splitlines(),
+      extras_require={'mathtext': ['matplotlib']},
       include_package_data=True,
       zip_safe=False
 )
\ No newline at end of file